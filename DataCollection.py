@@ -3,81 +3,214 @@
 Created on Fri Jul 18 12:12:11 2025
 
 @author: Zakary.Gruber
+
+Sensor characterization: captures the cumulative pulse counts of both flow
+sensors at a fixed rate and plots them afterwards.
+
+Samples are taken on a monotonic-clock deadline and streamed to a CSV file
+(t,count1,count2 with t in seconds since the start and cumulative counts)
+through a bounded queue, so a capture can run for hours at 20 ms resolution
+without holding anything in memory. The file is the format
+hardware.load_trace() replays in the simulator.
+
+Usage:
+    python3 DataCollection.py capture FILE [--interval 0.02] [--duration SECONDS]
+    python3 DataCollection.py plot FILE [--bin SECONDS]
+    python3 DataCollection.py            (one-second capture to data_capture.csv, then plot)
 """
 
-import RPi.GPIO as GPIO
+import argparse
+import queue
+import signal
+import threading
 import time
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 
+from pulse_counter import PulseCounter
+from hardware import get_backend
 
-# Initialize GPIO pins
-GPIO.setmode(GPIO.BCM)
 SENSOR1_PIN = 17
 SENSOR2_PIN = 18
 SOLENOID_PIN = 27
 
+PULSES_PER_GALLON = 2840
+
+sleep_time = .02 # Default seconds between samples
+BATCH_SECONDS = 1.0 # Rows are handed to the writer about once a second
+QUEUE_BATCHES = 60 # Writer may fall this many batches behind before rows are dropped
 
-# Activate GPIO pins
-GPIO.setup(SENSOR1_PIN, GPIO.IN)
-GPIO.setup(SENSOR2_PIN, GPIO.IN)
-GPIO.setup(SOLENOID_PIN, GPIO.OUT)
 
-PULSES_PER_GALLON = 2840
+class CaptureWriter(threading.Thread):
+    """
+    Writes batches of (t, count1, count2) rows to a CSV file. The queue is
+    bounded; if the disk stalls for longer than it can hold, whole batches
+    are dropped and counted rather than letting memory grow. Counts are
+    cumulative, so a dropped batch costs time resolution but no pulses.
+    """
+
+    def __init__(self, path, max_batches=QUEUE_BATCHES):
+        super().__init__(name="capture-writer", daemon=True)
+        self.path = path
+        self.dropped_rows = 0
+        self.written_rows = 0
+        self._queue = queue.Queue(maxsize=max_batches)
+
+    def submit(self, rows):
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            self.dropped_rows += len(rows)
+
+    def close(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        with open(self.path, "w") as f:
+            f.write("t,count1,count2\n")
+            while True:
+                rows = self._queue.get()
+                if rows is None:
+                    return
+                f.write("".join(f"{t:.6f},{count1},{count2}\n" for t, count1, count2 in rows))
+                f.flush()
+                self.written_rows += len(rows)
+
+
+def capture(path, interval=sleep_time, duration=None, backend=None):
+    """
+    Records both sensors every `interval` seconds until `duration` has passed
+    (or forever), or until Ctrl+C / SIGTERM. Returns the writer with its row counts.
+    """
+    # FLOW_MONITOR_BACKEND=sim uses the pulse simulator
+    backend = backend or get_backend()
+    backend.setup_output(SOLENOID_PIN)
+
+    # Pulse counters fed by the flow monitor interrupts
+    flow_counter1 = PulseCounter()
+    flow_counter2 = PulseCounter()
+    backend.setup_pulse_input(SENSOR1_PIN, flow_counter1.pulse)
+    backend.setup_pulse_input(SENSOR2_PIN, flow_counter2.pulse)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    writer = CaptureWriter(path)
+    writer.start()
+
+    batch_size = max(1, int(BATCH_SECONDS / interval))
+    batch = []
+    start = time.monotonic()
+    base1, base2 = flow_counter1.total(), flow_counter2.total()
+    deadline = start
+    try:
+        while not stop.is_set():
+            now = time.monotonic()
+            batch.append((now - start, flow_counter1.total() - base1, flow_counter2.total() - base2))
+            if len(batch) >= batch_size:
+                writer.submit(batch)
+                batch = []
+            if duration is not None and now - start >= duration:
+                break
+
+            deadline += interval
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                stop.wait(delay)
+            else:
+                # Fell behind: skip the missed slots rather than bursting
+                deadline += (-delay // interval) * interval
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if batch:
+            writer.submit(batch)
+        writer.close()
+        backend.cleanup()
+    return writer
+
+
+def load_capture(path):
+    """Returns (t, count1, count2) NumPy arrays from a capture file."""
+    import numpy as np
+    data = np.loadtxt(path, delimiter=",", skiprows=1, ndmin=2)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+
+def plot(path, bin_seconds=None):
+    """
+    Plots the flow rate of both sensors from a capture file. With bin_seconds
+    the rate is averaged over bins of that length, which keeps hour-long
+    captures readable.
+    """
+    import numpy as np
+    import matplotlib.pyplot as plt
+
+    t, count1, count2 = load_capture(path)
+    if len(t) < 2:
+        raise ValueError(f"{path} holds fewer than two samples")
+    if bin_seconds:
+        edges = np.arange(t[0], t[-1] + bin_seconds, bin_seconds)
+        index = np.searchsorted(t, edges)
+        index = np.unique(np.minimum(index, len(t) - 1))
+        t, count1, count2 = t[index], count1[index], count2[index]
+
+    # Rates from the cumulative counts over the real time between samples
+    dt = np.diff(t)
+    time_axis = t[1:]
+    flow_rate_1 = np.diff(count1) / PULSES_PER_GALLON / dt
+    flow_rate_2 = np.diff(count2) / PULSES_PER_GALLON / dt
+    marker = 'o' if len(time_axis) <= 200 else None
+
+    # Plot flow_rate_1
+    plt.figure(figsize=(10, 5))
+    plt.subplot(2, 1, 1)
+    plt.plot(time_axis, flow_rate_1, marker=marker, color='blue', label='Flow Rate 1')
+    plt.title('Flow Rate 1 over Time')
+    plt.xlabel('Time (seconds)')
+    plt.ylabel('Flow Rate (gallons/sec)')
+    plt.grid(True)
+    plt.legend()
+
+    # Plot flow_rate_2
+    plt.subplot(2, 1, 2)
+    plt.plot(time_axis, flow_rate_2, marker=marker, color='green', label='Flow Rate 2')
+    plt.title('Flow Rate 2 over Time')
+    plt.xlabel('Time (seconds)')
+    plt.ylabel('Flow Rate (gallons/sec)')
+    plt.grid(True)
+    plt.legend()
+
+    plt.tight_layout()
+    plt.show()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flow sensor capture and plotting")
+    commands = parser.add_subparsers(dest="command")
+    capture_parser = commands.add_parser("capture", help="record pulse counts to a CSV file")
+    capture_parser.add_argument("file")
+    capture_parser.add_argument("--interval", type=float, default=sleep_time, help="seconds between samples")
+    capture_parser.add_argument("--duration", type=float, help="seconds to record (default: until Ctrl+C)")
+    plot_parser = commands.add_parser("plot", help="plot a recorded CSV file")
+    plot_parser.add_argument("file")
+    plot_parser.add_argument("--bin", type=float, help="average the rate over bins of this many seconds")
+    args = parser.parse_args()
+
+    if args.command == "plot":
+        plot(args.file, args.bin)
+        return
+    if args.command == "capture":
+        path, interval, duration = args.file, args.interval, args.duration
+    else:
+        # Quick look, like the original 50-sample run
+        path, interval, duration = "data_capture.csv", sleep_time, 50 * sleep_time
+
+    writer = capture(path, interval, duration)
+    print(f"Wrote {writer.written_rows} samples to {path}")
+    if writer.dropped_rows:
+        print(f"Dropped {writer.dropped_rows} samples while the disk was behind")
+    if args.command is None:
+        plot(path)
+
 
-flow_count1 = 0
-flow_count2 = 0
-start_time = None
-sleep_time = .02
-
-# Functions to recieve a signal from the flow monitors
-def pulse_detected1(channel):
-    global flow_count1
-    flow_count1 += 1
-
-def pulse_detected2(channel):
-    global flow_count2
-    flow_count2 += 1
-
-GPIO.add_event_detect(SENSOR1_PIN, GPIO.RISING, callback=pulse_detected1)
-GPIO.add_event_detect(SENSOR2_PIN, GPIO.RISING, callback=pulse_detected2)
-
-flow_rate_1 = []
-flow_rate_2 = []
-for i in range(0, 50):
-    rate1 = flow_count1 / PULSES_PER_GALLON
-    rate2 = flow_count2 / PULSES_PER_GALLON
-    flow_count1 = 0
-    flow_count2 = 0
-    flow_rate_1.append(rate1)
-    flow_rate_2.append(rate2)
-    time.sleep(sleep_time)
-    
-for n in range(len(flow_rate_1)):
-    print(f"rate 1: {flow_rate_1[n]}")
-    print(f"rate 2: {flow_rate_2[n]}")
-    
-# Create time axis based on number of samples and sleep_time
-time_axis = [n * sleep_time for n in range(len(flow_rate_1))]
-
-# Plot flow_rate_1
-plt.figure(figsize=(10, 5))
-plt.subplot(2, 1, 1)
-plt.plot(time_axis, flow_rate_1, marker='o', color='blue', label='Flow Rate 1')
-plt.title('Flow Rate 1 over Time')
-plt.xlabel('Time (seconds)')
-plt.ylabel('Flow Rate (gallons/sec)')
-plt.grid(True)
-plt.legend()
-
-# Plot flow_rate_2
-plt.subplot(2, 1, 2)
-plt.plot(time_axis, flow_rate_2, marker='o', color='green', label='Flow Rate 2')
-plt.title('Flow Rate 2 over Time')
-plt.xlabel('Time (seconds)')
-plt.ylabel('Flow Rate (gallons/sec)')
-plt.grid(True)
-plt.legend()
-
-plt.tight_layout()
-plt.show()
+if __name__ == "__main__":
+    main()
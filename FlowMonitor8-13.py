@@ -5,125 +5,103 @@ Created on Wed Jul 2 2025
 
 @author: Zakary.Gruber
 """
-import RPi.GPIO as GPIO
-import tkinter as tk
-import tkinter.simpledialog as sd
-from tkinter import messagebox
 import time
-import datetime
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+STARTED = time.perf_counter()
 import sys
 import signal
-
-# Initialize GPIO pins
-GPIO.setmode(GPIO.BCM)
-SENSOR1_PIN = 17
-SENSOR2_PIN = 18
-SOLENOID_PIN = 27
+from monitor_service import MonitorError, SOCKET_PATH, connect
+
+# Only what is needed to arm the monitor is imported up here. Tk comes after the
+# valves are monitored, and matplotlib only once the graph is actually shown.
+
+SAMPLE_INTERVAL = 1.0 # Seconds between counter snapshots
+GRAPH_POINTS = 100 # Most recent samples shown on the graph
+GRAPH_MAX_FPS = 1.0 # Cap on graph redraws, independent of SAMPLE_INTERVAL
+# Zoom levels of the graph; spans beyond GRAPH_POINTS samples are drawn from the downsampled tiers
+GRAPH_SPANS = {"100 s": GRAPH_POINTS * SAMPLE_INTERVAL, "1 hour": 3600, "1 day": 86400, "1 week": 604800}
+
+# When flow_daemon.py is running, this window is only a client of it.
+# Otherwise the monitor runs inside this process like it always did.
+client = connect(SOCKET_PATH)
+
+if client is not None:
+    monitor = client
+    history = client.history
+    tiers = client.tiers
+else:
+    from hardware import get_backend
+    from racks import RackMonitor, find_racks, DEFAULT_HISTORY_DIR
+    from telemetry import TELEMETRY_PATH
+    from instrumentation import METRICS, start_exporters
+
+    # Rack table: racks.json next to this script, or a path given on the command line.
+    # Without one, the original single rack (sensors on 17/18, solenoid on 27) is used.
+    racks = find_racks(sys.argv[1] if len(sys.argv) > 1 else None)
+
+    # Initialize and activate GPIO pins for every rack
+    # (FLOW_MONITOR_BACKEND=sim runs against the pulse simulator instead)
+    backend = get_backend()
+    monitor = RackMonitor(racks, backend, interval=SAMPLE_INTERVAL, history_dir=DEFAULT_HISTORY_DIR,
+                          telemetry_path=TELEMETRY_PATH)
+    monitor.setup_gpio()
+    history = monitor.engine.history
+    tiers = monitor.engine.tiers.sources()
+    monitor.start()
+    start_exporters(METRICS)
+
+shut_down = False
+
+def shutdown():
+    # Runs from the signal handler and again from the finally at the bottom
+    global shut_down
+    if shut_down:
+        return
+    shut_down = True
+    if client is not None:
+        client.close()
+        return
+    monitor.stop()
+    time.sleep(1)
+    backend.cleanup()
 
 def graceful_exit(signum, frame):
-    GPIO.output(SOLENOID_PIN, GPIO.HIGH)
-    time.sleep(1)
-    GPIO.cleanup()
+    shutdown()
     sys.exit(0)
 
-# Activate GPIO pins
-GPIO.setup(SENSOR1_PIN, GPIO.IN)
-GPIO.setup(SENSOR2_PIN, GPIO.IN)
-GPIO.setup(SOLENOID_PIN, GPIO.OUT)
-
 signal.signal(signal.SIGINT, graceful_exit)
 signal.signal(signal.SIGTERM, graceful_exit)
 
-PULSES_PER_GALLON = 2840
+if client is None:
+    print(f"Armed {len(racks)} rack(s) in {(time.perf_counter() - STARTED) * 1000:.0f} ms", flush=True)
+
+import tkinter as tk
+import tkinter.simpledialog as sd
+from tkinter import messagebox
 
 # Global Variables
 current_password = "admin123"
-ignore_threshold = False
-last_shutoff_date = "No shutoff recorded"
-current_status = "Inactive"
-current_tolerance = 0
-system_name = "Flow Monitor 1"
-duration_threshold = 10
-
-# Active variables
-sensor_differences = []
-time_stamps = []
-flow_count1 = 0
-flow_count2 = 0
-start_time = None
-
-
-# Functions to recieve a signal from the flow monitors
-def pulse_detected1(channel):
-    global flow_count1
-    flow_count1 += 1
-
-def pulse_detected2(channel):
-    global flow_count2
-    flow_count2 += 1
-
-GPIO.add_event_detect(SENSOR1_PIN, GPIO.RISING, callback=pulse_detected1)
-GPIO.add_event_detect(SENSOR2_PIN, GPIO.RISING, callback=pulse_detected2)
+selected_rack = 0 # Rack shown in the window
+graph = None # Created by show_graph() once the window is up
 
 # Automatic functions
 def update_labels():
-    status_label.config(text=f"Current cooling state: {current_status}")
-    shutoff_label.config(text=f"Last shutoff logged at: {last_shutoff_date}")
-    current_tolerance_label.config(text=f"Current accepted flow difference: {current_tolerance} (gal)")
-    activation_delay_label.config(text=f"Current activation delay: {duration_threshold} (sec)")
-
-def monitor_sensor_values():
-    global last_shutoff_date, start_time, current_status, ignore_threshold
-    global sensor_differences, time_stamps, flow_count1, flow_count2
-
-    rate1 = flow_count1 / PULSES_PER_GALLON
-    rate2 = flow_count2 / PULSES_PER_GALLON
-    flow_count1 = 0
-    flow_count2 = 0
-
-    difference = abs(rate1 - rate2)
-
-    if not ignore_threshold:
-        sensor_differences.append(difference)
-        time_stamps.append(time.time())
-
-        if len(sensor_differences) > 100:
-            sensor_differences.pop(0)
-            time_stamps.pop(0)
-
-    if difference > abs(current_tolerance):
-        if start_time is None:
-            start_time = time.time()
-        elapsed_time = time.time() - start_time
-        if elapsed_time >= duration_threshold:
-            GPIO.output(SOLENOID_PIN, GPIO.HIGH)
-            last_shutoff_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            current_status = "Inactive"
-            update_labels()
-            start_time = None
-    else:
-        start_time = None
-
-    root.after(1000, update_graph)
-
-def update_graph():
-    global time_stamps, sensor_differences
-
-    if time_stamps and sensor_differences and len(time_stamps) == len(sensor_differences):
-        normalized_t = [t - time_stamps[0] for t in time_stamps]
-        ax.clear()
-        ax.plot(normalized_t, sensor_differences, label="Flow Rate Difference (gal/s)")
-        ax.set_xlabel("Time (s)")
-        ax.set_ylabel("Amount (gallons)")
-        ax.set_ylim(bottom=0)
-        ax.legend()
-        ax.relim()
-        ax.autoscale_view()
-        canvas.draw()
-
-    root.after(1000, monitor_sensor_values)
+    info_label.config(text=monitor.names[selected_rack])
+    status_label.config(text=f"Current cooling state: {monitor.status[selected_rack]}")
+    shutoff_label.config(text=f"Last shutoff logged at: {monitor.last_shutoff_date[selected_rack]}")
+    current_tolerance_label.config(text=f"Current accepted flow difference: {monitor.tolerance(selected_rack)} (gal/s)")
+    activation_delay_label.config(text=f"Current activation delay: {monitor.duration_threshold(selected_rack)} (sec)")
+
+# The GUI only reads what the sampling engine produced
+def refresh_gui():
+    try:
+        if client is not None:
+            client.refresh()
+        update_labels()
+        if graph is not None:
+            graph.update()
+    except (OSError, MonitorError):
+        status_label.config(text="Monitor service unavailable")
+    root.after(int(1000 / max(GRAPH_MAX_FPS, 1.0)), refresh_gui)
 
 # GUI
 # Main window
@@ -131,19 +109,32 @@ root = tk.Tk()
 root.title("Water Flow Monitor")
 root.geometry("600x650")
 
-info_label = tk.Label(root, text=system_name, font=("Arial", 14, "bold"))
+# Rack selector, only needed when more than one rack is configured
+if len(monitor.names) > 1:
+    rack_choice = tk.StringVar(value=monitor.names[0])
+
+    def select_rack(name):
+        global selected_rack
+        selected_rack = monitor.names.index(name)
+        if graph is not None:
+            graph.set_rack(selected_rack)
+        update_labels()
+
+    tk.OptionMenu(root, rack_choice, *monitor.names, command=select_rack).pack()
+
+info_label = tk.Label(root, font=("Arial", 14, "bold"))
 info_label.pack()
 
-status_label = tk.Label(root, text=f"Current cooling state: {current_status}", font=("Arial",20))
+status_label = tk.Label(root, font=("Arial",20))
 status_label.pack()
 
-shutoff_label = tk.Label(root, text=f"Last shutoff logged at: {last_shutoff_date}")
+shutoff_label = tk.Label(root)
 shutoff_label.pack()
 
-current_tolerance_label = tk.Label(root, text=f"Current accepted flow difference: {current_tolerance} (gal)")
+current_tolerance_label = tk.Label(root)
 current_tolerance_label.pack()
 
-activation_delay_label = tk.Label(root, text=f"Current activation delay: {duration_threshold} (sec)")
+activation_delay_label = tk.Label(root)
 activation_delay_label.pack()
 
 # Admin Password Entry
@@ -155,7 +146,19 @@ pw_entry = tk.Entry(pw_frame, show="*")
 pw_entry.pack()
 
 def check_password():
-    if pw_entry.get() == current_password:
+    global current_password
+    entered = pw_entry.get()
+    if client is None:
+        accepted = entered == current_password
+    else:
+        # The service holds the admin password and checks every configure against it
+        try:
+            accepted = client.check_password(entered)
+        except OSError as e:
+            messagebox.showerror("Error", f"Could not reach the monitor service: {e}")
+            return
+    if accepted:
+        current_password = entered
         pw_entry.delete(0, tk.END)
         show_admin_panel()
     else:
@@ -165,25 +168,22 @@ tk.Button(pw_frame, text="Enter", command=check_password).pack(pady=5)
 
 # Open solenoid to send monitored cooling
 def activate_system():
-    global current_status, ignore_threshold
-    GPIO.output(SOLENOID_PIN, GPIO.LOW)
-    current_status = "Active"
+    try:
+        monitor.activate(selected_rack)
+    except (OSError, MonitorError) as e:
+        messagebox.showerror("Error", f"Could not reach the monitor service: {e}")
+        return
     update_labels()
-    ignore_threshold = True
-    root.after(10000, reset_ignore_threshold)
 
 # Close solenoid, no more monitored cooling
 def deactivate_system():
-    global current_status, last_shutoff_date
-    GPIO.output(SOLENOID_PIN, GPIO.HIGH)
-    current_status = "Inactive"
-    last_shutoff_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        monitor.deactivate(selected_rack)
+    except (OSError, MonitorError) as e:
+        messagebox.showerror("Error", f"Could not reach the monitor service: {e}")
+        return
     update_labels()
 
-def reset_ignore_threshold():
-    global ignore_threshold
-    ignore_threshold = False
-
 # Password protected admin control panel
 def show_admin_panel():
     admin_win = tk.Toplevel(root)
@@ -202,32 +202,38 @@ def show_admin_panel():
 
     tk.Label(admin_win, text="System name:").pack(pady=(10, 0))
     name_entry = tk.Entry(admin_win)
-    name_entry.insert(0, system_name)
+    name_entry.insert(0, monitor.names[selected_rack])
     name_entry.pack()
 
-    tk.Label(admin_win, text="Acceptable flow difference:").pack(pady=(10, 0))
+    tk.Label(admin_win, text="Acceptable flow difference (gal/s):").pack(pady=(10, 0))
     tol_entry = tk.Entry(admin_win)
-    tol_entry.insert(0, str(current_tolerance))
+    tol_entry.insert(0, str(monitor.tolerance(selected_rack)))
     tol_entry.pack()
 
     tk.Label(admin_win, text="Activation Delay (sec):").pack(pady=(10, 0))
     dur_entry = tk.Entry(admin_win)
-    dur_entry.insert(0, str(duration_threshold))
+    dur_entry.insert(0, str(monitor.duration_threshold(selected_rack)))
     dur_entry.pack()
 
     def save_admin_settings():
-        global current_password, system_name, current_tolerance, duration_threshold
-        current_password = pwd_entry.get()
-        system_name = name_entry.get()
+        global current_password
+        new_password = pwd_entry.get()
         try:
             current_tolerance = float(tol_entry.get())
             duration_threshold = float(dur_entry.get())
-            update_labels()
         except ValueError:
             messagebox.showerror("Error", "Acceptable flow difference and duration must be numbers")
             return
 
-        info_label.config(text=system_name)
+        credentials = {} if client is None else {"password": current_password, "new_password": new_password}
+        try:
+            monitor.configure(selected_rack, name=name_entry.get(), tolerance=current_tolerance,
+                              duration_threshold=duration_threshold, **credentials)
+        except (OSError, MonitorError) as e:
+            messagebox.showerror("Error", f"Could not reach the monitor service: {e}")
+            return
+        current_password = new_password
+        update_labels()
         messagebox.showinfo("Admin", "Settings saved.")
         admin_win.destroy()
 
@@ -242,15 +248,25 @@ tk.Button(control_frame, text="ON", command=activate_system).pack(side=tk.LEFT,
 tk.Button(control_frame, text="OFF", command=deactivate_system).pack(side=tk.LEFT, padx=5)
 
 # Graph
-fig, ax = plt.subplots(figsize=(6, 5))
-canvas = FigureCanvasTkAgg(fig, master=root)
-canvas.get_tk_widget().pack()
+span_choice = tk.StringVar(value=next(iter(GRAPH_SPANS)))
 
-monitor_sensor_values()
+def select_span(name):
+    if graph is not None:
+        graph.set_span(GRAPH_SPANS[name])
+
+tk.OptionMenu(root, span_choice, *GRAPH_SPANS, command=select_span).pack()
+
+def show_graph():
+    global graph
+    from graph_renderer import FlowGraph # Pulls in matplotlib, so only imported here
+    graph = FlowGraph(root, history, points=GRAPH_POINTS, rack=selected_rack,
+                      sample_interval=SAMPLE_INTERVAL, max_fps=GRAPH_MAX_FPS, tiers=tiers)
+
+refresh_gui()
+# Let the window and labels appear before matplotlib is loaded
+root.after(100, show_graph)
 
 try:
     root.mainloop()
 finally:
-    GPIO.output(SOLENOID_PIN, GPIO.HIGH)
-    time.sleep(1)
-    GPIO.cleanup()
+    shutdown()
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+AD5592R driver with a shadow copy of the chip's configuration registers.
+
+The driver remembers the last value written to ADC_CONFIG, GPIO_CONFIG,
+GEN_CTRL_REG, ADC_SEQ and GPIO_OUTPUT, so:
+
+    - a write that would not change a register is skipped (no SPI traffic)
+    - writes made inside `with chip.batch():` are sent together on flush,
+      one 16-bit frame per changed register, clocked back to back without
+      the per-frame sleeps and log formatting of the original script
+    - verify() reads every shadowed register back in one burst and rewrites
+      any that no longer match (a brown-out or a glitch on the bus resets
+      the chip); check() does that every `verify_interval` seconds
+
+The chip latches one 16-bit word per SYNC rising edge, so a burst is still
+one SYNC pulse per frame; what it saves are the sleeps, the redundant
+frames and the bus round trips between them.
+
+Several chips can share a Pi. Each AD5592R is either on its own spidev
+chip-select (sync_pin=None: the SPI controller's CE line drives SYNC), or
+selected by a GPIO SYNC line on a spidev device shared through `spi=`.
+Chips on the same bus take the same lock, so their frames never interleave.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import spi_log
+from instrumentation import METRICS
+
+REG_ADDR = {
+    "NOP": 0x0, # NOP register is used here to clock out ADC results
+    "SW_RESET": 0xF,
+    "ADC_CONFIG": 0x4,
+    "GPIO_CONFIG": 0x8,  # GPIO Write Configuration Register
+    "GEN_CTRL_REG": 0x3,
+    "ADC_SEQ": 0x2,
+    "GPIO_OUTPUT": 0x9,  # GPIO Write Data Register
+    "READBACK": 0x7,     # Readback and LDAC mode register
+}
+
+ADC_SEQ_REP = 1 << 9  # ADC_SEQ bit 9: repeat the sequence continuously
+ADC_SEQ_TEMP = 1 << 8 # ADC_SEQ bit 8: include the temperature indicator
+READBACK_ENABLE = 1 << 6 # READBACK bit 6: clock out the register in bits 5:2 on the next frame
+SW_RESET_CODE = 0x5AC
+DATA_MASK = 0x7FF # Bits 10:0 of a control word
+
+# Registers kept in the shadow, in the order a flush writes them: pins are
+# configured before outputs are driven and before the sequence starts
+SHADOWED = ("GPIO_CONFIG", "ADC_CONFIG", "GEN_CTRL_REG", "ADC_SEQ", "GPIO_OUTPUT")
+RESET_VALUES = dict.fromkeys(SHADOWED, 0)
+VERIFY_INTERVAL = 60.0 # Seconds between readbacks in check()
+
+log = spi_log.logger_from_env()
+
+# SPI throughput and transfer times, exported with the monitor's other metrics
+spi_transactions = METRICS.counter("spi_transactions", "16-bit SPI frames exchanged with the AD5592R")
+spi_transfer_timer = METRICS.timer("spi_transfer", "One burst of SPI frames, from the first SYNC low to the last SYNC high")
+spi_sequence_timer = METRICS.timer("spi_sequence_read", "One read_adc_sequence() block")
+spi_skipped_writes = METRICS.counter("spi_skipped_writes", "AD5592R register writes skipped because the shadow already matched")
+readback_mismatches = METRICS.counter("ad5592r_readback_mismatches", "Shadowed AD5592R registers found changed on readback")
+
+_bus_locks = {}
+_bus_locks_guard = threading.Lock()
+
+
+def bus_lock(bus):
+    """The lock every chip on SPI bus `bus` holds while it clocks frames."""
+    with _bus_locks_guard:
+        return _bus_locks.setdefault(bus, threading.RLock())
+
+
+def command(register, data=0):
+    """16-bit control word writing `data` to `register` (bit 15 = 0)."""
+    return (REG_ADDR[register] << 11) | (data & DATA_MASK)
+
+
+class AD5592R:
+    """
+    One AD5592R. `registers` is the shadow: the value each SHADOWED register
+    holds on the chip, or None while unknown (before reset() or the first
+    write). Writes go out immediately unless made inside batch().
+    """
+
+    def __init__(self, backend, sync_pin=None, bus=0, device=0, speed_hz=1000000, spi=None,
+                 verify_interval=VERIFY_INTERVAL, clock=time.monotonic):
+        self.backend = backend
+        self.sync_pin = sync_pin
+        self.bus = bus
+        self.device = device
+        if sync_pin is not None:
+            backend.setup_output(sync_pin, initial=backend.HIGH) # Ensure SYNC is high initially
+        self.spi = spi if spi is not None else backend.open_spi(bus, device, speed_hz, 0b00) # SPI Mode 0
+        self.lock = bus_lock(bus)
+        self.verify_interval = verify_interval
+        self.clock = clock
+
+        self.registers = dict.fromkeys(SHADOWED)
+        self._staged = {}
+        self._batch_depth = 0
+        self._verified = clock()
+
+    def __repr__(self):
+        select = f"GPIO{self.sync_pin}" if self.sync_pin is not None else f"CE{self.device}"
+        return f"AD5592R(bus {self.bus}, {select})"
+
+    # --- SPI frames ---
+
+    def transfer(self, words, descriptions=()):
+        """
+        Clocks 16-bit words out back to back, one SYNC frame each, and
+        returns the words clocked in. Raises on SPI errors.
+        """
+        received = []
+        output = self.backend.output
+        xfer2 = self.spi.xfer2
+        sync = self.sync_pin
+        low = self.backend.LOW
+        high = self.backend.HIGH
+        with self.lock:
+            started = time.perf_counter()
+            try:
+                for word in words:
+                    if sync is not None:
+                        output(sync, low)
+                    try:
+                        data = xfer2([(word >> 8) & 0xFF, word & 0xFF])
+                    finally:
+                        if sync is not None:
+                            output(sync, high)
+                    received.append((data[0] << 8) | data[1])
+            finally:
+                spi_transfer_timer.record(time.perf_counter() - started)
+                spi_transactions.inc(len(received))
+        if log.recording:
+            descriptions = list(descriptions)
+            for i, word in enumerate(words):
+                log.transaction(spi_log.TX, word, descriptions[i] if i < len(descriptions) else None)
+        return received
+
+    # --- Shadowed registers ---
+
+    @property
+    def adc_configured(self):
+        return bool(self._value("ADC_CONFIG"))
+
+    @property
+    def gpio_configured(self):
+        return bool(self._value("GPIO_CONFIG"))
+
+    def _value(self, register):
+        """The value the register will hold after the next flush."""
+        return self._staged.get(register, self.registers[register])
+
+    def write(self, register, value):
+        """
+        Sets a shadowed register. Skipped when the chip already holds the
+        value; otherwise staged and, outside batch(), flushed at once.
+        """
+        value &= DATA_MASK
+        if self.registers[register] == value:
+            self._staged.pop(register, None)
+            spi_skipped_writes.inc()
+            return
+        self._staged[register] = value
+        if not self._batch_depth:
+            self.flush()
+
+    @contextmanager
+    def batch(self):
+        """Collects the writes made inside the block into one flush at its end."""
+        self._batch_depth += 1
+        try:
+            yield self
+        finally:
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.flush()
+
+    def flush(self):
+        """Sends every staged register in one burst. Returns the number of frames sent."""
+        staged = [(register, self._staged[register]) for register in SHADOWED if register in self._staged]
+        if not staged:
+            return 0
+        descriptions = [("Write %s = 0x%03X", register, value) for register, value in staged] if log.recording else ()
+        self.transfer([command(register, value) for register, value in staged], descriptions)
+        for register, value in staged:
+            self.registers[register] = value
+            del self._staged[register]
+        return len(staged)
+
+    def reset(self):
+        """Software reset; every register returns to its power-on value."""
+        with self.lock:
+            self.transfer([(REG_ADDR["SW_RESET"] << 11) | SW_RESET_CODE], ["Software Reset AD5592R"])
+            time.sleep(0.00025) # Wait for reset to complete (250 us max)
+        self.registers = dict(RESET_VALUES)
+        self._staged.clear()
+        self._verified = self.clock()
+
+    def configure(self, adc_inputs=None, gpio_outputs=None, gen_ctrl=None, sequence=None):
+        """
+        Sets the pin functions (bit n = I/On), GEN_CTRL_REG and the ADC
+        sequence in one burst. Arguments left at None are not touched.
+        """
+        with self.batch():
+            for register, value in (("ADC_CONFIG", adc_inputs), ("GPIO_CONFIG", gpio_outputs),
+                                    ("GEN_CTRL_REG", gen_ctrl), ("ADC_SEQ", sequence)):
+                if value is not None:
+                    self.write(register, value)
+
+    def set_outputs(self, levels):
+        """Drives the GPIO outputs in {io: 0 or 1}; the others keep their level."""
+        value = self._value("GPIO_OUTPUT") or 0
+        for io, level in levels.items():
+            value = value | (1 << io) if level else value & ~(1 << io)
+        self.write("GPIO_OUTPUT", value)
+
+    # --- Readback ---
+
+    def read_registers(self, registers=SHADOWED):
+        """
+        Reads registers back from the chip in one burst: each readback
+        request clocks out the register requested by the frame before it.
+        Returns {register: value}.
+        """
+        words = [command("READBACK", READBACK_ENABLE | (REG_ADDR[register] << 2)) for register in registers]
+        # A NOP would start a conversion and shift the ADC sequence; rewriting
+        # ADC_SEQ clocks out the last register and restarts the sequence instead
+        sequence = self.registers["ADC_SEQ"]
+        last = command("ADC_SEQ", sequence) if sequence is not None else command("NOP")
+        received = self.transfer(words + [last], [("Read back %s", register) for register in registers])
+        return {register: word & DATA_MASK for register, word in zip(registers, received[1:])}
+
+    def verify(self):
+        """
+        Compares the chip with the shadow and rewrites registers that
+        differ. Returns the names of the registers that had changed.
+        """
+        known = [register for register in SHADOWED if self.registers[register] is not None]
+        with self.lock:
+            actual = self.read_registers(known)
+            changed = [register for register in known if actual[register] != self.registers[register]]
+            for register in changed:
+                log.log('warning', "AD5592R %r: %s reads 0x%03X, expected 0x%03X; rewriting",
+                        self, register, actual[register], self.registers[register])
+                self._staged.setdefault(register, self.registers[register])
+                self.registers[register] = actual[register]
+            readback_mismatches.inc(len(changed))
+            self.flush()
+        self._verified = self.clock()
+        return changed
+
+    def check(self):
+        """Runs verify() when the last one is verify_interval seconds old. Cheap to call often."""
+        if self.clock() - self._verified < self.verify_interval:
+            return []
+        return self.verify()
+
+    # --- ADC ---
+
+    def read_adc_channel(self, adc_address):
+        """
+        Initiates a conversion and reads the result for a single ADC channel.
+        Note: The AD5592R clocks out the *previous* conversion result, so
+        ADC_SEQ is first pointed at the one channel, a NOP starts its
+        conversion, and rewriting ADC_SEQ from the shadow clocks the result
+        out and restores the sequence.
+        The data format is: Bit 15 = 0, Bits[14:12] = ADC Address, Bits[11:0] = ADC Data
+        """
+        if not self.adc_configured:
+            log.log('warning', "ADCs not configured. Please run configure() first.")
+            return None
+        if not 0 <= adc_address <= 7:
+            raise ValueError(f"No ADC{adc_address} on the AD5592R")
+
+        sequence = self.registers["ADC_SEQ"]
+        last = command("ADC_SEQ", sequence) if sequence is not None else command("NOP")
+        with self.lock:
+            self.transfer([command("ADC_SEQ", 1 << adc_address), command("NOP")],
+                          [("Select ADC%d", adc_address), "NOP (to start the conversion)"])
+            time.sleep(0.000002) # Conversion time is 2 us, wait for it to complete
+            (received_word,) = self.transfer([last])
+        log.transaction(spi_log.RX, received_word, "ADC Conversion Result")
+
+        received_adc_address = (received_word >> 12) & 0x7 # Bits 14:12
+        adc_data = received_word & 0xFFF # Bits 11:0
+        if received_adc_address != adc_address:
+            log.log('warning', "Warning: Expected ADC%d, but received result for ADC%d. This might indicate a sequence mismatch.",
+                    adc_address, received_adc_address)
+        return adc_data
+
+    def read_adc_sequence(self, channel_mask, num_samples):
+        """
+        Reads num_samples conversions from the channels in channel_mask (bit n = ADCn)
+        using the ADC_SEQ repeat mode, and returns (channels, codes) as NumPy arrays.
+        channels holds the address bits (14:12) each sample was tagged with by the
+        chip, codes the 12-bit result.
+
+        The chip starts a conversion on every SYNC falling edge, so each sample is
+        still its own 16-bit frame. The frames are clocked back to back with no
+        sleeps or logging, and decoding happens once for the whole block.
+        Afterwards ADC_SEQ is restored from the shadow.
+        """
+        if not self.adc_configured:
+            log.log('warning', "ADCs not configured. Please run configure() first.")
+            return None
+
+        sequence_command = command("ADC_SEQ", ADC_SEQ_REP | (channel_mask & 0xFF))
+        nop = [0x00, 0x00]
+        words = np.empty(num_samples, dtype=np.uint16)
+
+        # Local names keep attribute lookups out of the frame loop
+        output = self.backend.output if self.sync_pin is not None else (lambda pin, value: None)
+        xfer2 = self.spi.xfer2
+        low = self.backend.LOW
+        high = self.backend.HIGH
+        sync = self.sync_pin
+
+        with self.lock:
+            started = time.perf_counter()
+            try:
+                output(sync, low)
+                xfer2([(sequence_command >> 8) & 0xFF, sequence_command & 0xFF])
+                output(sync, high)
+
+                # The first frame only starts the first conversion; its data is stale
+                output(sync, low)
+                xfer2(nop)
+                output(sync, high)
+
+                for i in range(num_samples):
+                    output(sync, low)
+                    received = xfer2(nop)
+                    output(sync, high)
+                    words[i] = (received[0] << 8) | received[1]
+            except Exception as e:
+                log.log('error', "SPI bulk read error: %s", e)
+                return None
+            finally:
+                spi_sequence_timer.record(time.perf_counter() - started)
+                spi_transactions.inc(num_samples + 2)
+                # Stop repeating and restore the sequence read_adc_channel() expects
+                self.transfer([command("ADC_SEQ", self.registers["ADC_SEQ"] or 0)], ["Restore ADC sequence"])
+
+        channels = (words >> 12) & 0x7
+        codes = words & 0xFFF
+        return channels, codes
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Block conversion of AD5592R samples from 4-20 mA sensors.
+
+read_adc_sequence() returns whole blocks of (channel, code) pairs. The
+pipeline turns such a block into calibrated engineering values with a few
+NumPy operations, whatever its length and however the channels interleave:
+
+    code -> mA     code / 4096 * VREF across the channel's shunt resistor,
+                   then the channel's calibration gain and offset
+    mA -> value    linear 4-20 mA mapping onto the sensor's low..high range
+                   (e.g. 0..100 psi); currents outside the loop's fault band
+                   (broken wire, shorted transmitter) become NaN, and so
+                   does a saturated ADC (code 4095), whatever it converts to
+
+Each channel can then be smoothed with a moving average or decimated by
+block averaging. Filter state carries over between blocks, so a stream read
+block by block gives the same output as one long block.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+ADC_RESOLUTION = 4096 # 12-bit codes
+REF_VOLTAGE = 2.5 # AD5592R internal reference, ADC range 0 V to VREF
+ADC_CHANNELS = 8
+MIN_CURRENT = 4.0 # mA
+MAX_CURRENT = 20.0 # mA
+# Loop currents outside this band mean a wiring or transmitter fault (NAMUR NE 43)
+FAULT_LOW = 3.6 # mA
+FAULT_HIGH = 21.0 # mA
+SATURATED = ADC_RESOLUTION - 1 # The ADC's top code: the real current is unknown
+# 100 ohm puts full scale (4095 codes) at 25 mA, so currents up to FAULT_HIGH and
+# a bit beyond can be told apart. 125 ohm would top out at 20 mA, right at the
+# loop's upper limit, and hide every high fault.
+DEFAULT_SHUNT_OHMS = 100.0
+
+# adc is the AD5592R input (I/On) the sensor is wired to. low and high are
+# the values at 4 mA and 20 mA. gain and offset correct the measured current:
+# true mA = gain * measured mA + offset (see calibrate()). The default
+# DEFAULT_SHUNT_OHMS shunt puts 25 mA at the top of the 0-2.5 V range.
+AnalogChannel = namedtuple(
+    "AnalogChannel",
+    ["name", "adc", "low", "high", "unit", "gain", "offset", "shunt_ohms"],
+    defaults=(MIN_CURRENT, MAX_CURRENT, "mA", 1.0, 0.0, DEFAULT_SHUNT_OHMS),
+)
+
+
+def codes_to_mA(codes, shunt_ohms=DEFAULT_SHUNT_OHMS, ref_voltage=REF_VOLTAGE):
+    """Uncalibrated loop current for raw 12-bit codes (scalars or arrays)."""
+    return np.asarray(codes) * (ref_voltage / ADC_RESOLUTION / shunt_ohms * 1000.0)
+
+
+def calibrate(measured_mA, reference_mA):
+    """
+    Returns the (gain, offset) that map currents measured by a channel onto
+    the reference currents injected with a loop calibrator at two or more points.
+    """
+    gain, offset = np.polyfit(np.asarray(measured_mA, dtype=float), np.asarray(reference_mA, dtype=float), 1)
+    return float(gain), float(offset)
+
+
+class _ChannelFilter:
+    """Moving average ("mean") or block-average decimation ("decimate") with state between blocks."""
+
+    def __init__(self, kind, window):
+        if kind not in (None, "mean", "decimate"):
+            raise ValueError(f"Unknown analog filter: {kind}")
+        self.kind = kind if window > 1 else None
+        self.window = window
+        self._tail = np.empty(0)
+
+    def __call__(self, values):
+        if self.kind is None:
+            return values
+        values = np.concatenate((self._tail, values))
+        if self.kind == "mean":
+            if len(values) < self.window:
+                self._tail = values
+                return values[:0]
+            self._tail = values[len(values) - self.window + 1:]
+            # Sum finite samples and count faulted ones separately, so a NaN
+            # only blanks the windows it falls in instead of every later one
+            faults = np.isnan(values)
+            sums = self._window_sums(np.where(faults, 0.0, values))
+            averages = sums / self.window
+            averages[self._window_sums(faults.astype(float)) > 0] = np.nan
+            return averages
+        usable = len(values) - len(values) % self.window
+        self._tail = values[usable:]
+        return values[:usable].reshape(-1, self.window).mean(axis=1)
+
+    def _window_sums(self, values):
+        sums = np.cumsum(values)
+        sums[self.window:] = sums[self.window:] - sums[:-self.window]
+        return sums[self.window - 1:]
+
+    def reset(self):
+        self._tail = np.empty(0)
+
+
+class AnalogPipeline:
+    """
+    Converts blocks of (channel, code) samples for the configured channels.
+
+    smoothing is None, "mean" (moving average over `window` samples) or
+    "decimate" (one output per `window` samples). `latest` holds the newest
+    filtered value of every channel, in channel order, for callers that only
+    want the current reading (e.g. a detector fed once per sample interval).
+    """
+
+    def __init__(self, channels, smoothing=None, window=1, ref_voltage=REF_VOLTAGE):
+        self.channels = list(channels)
+        self.names = [channel.name for channel in self.channels]
+        adcs = [channel.adc for channel in self.channels]
+        if len(set(adcs)) != len(adcs):
+            raise ValueError("ADC input used by more than one analog channel")
+
+        # Per-ADC-address lookup tables: code -> calibrated mA, mA -> value.
+        # Unconfigured addresses map to NaN.
+        self._mA_scale = np.full(ADC_CHANNELS, np.nan)
+        self._mA_offset = np.full(ADC_CHANNELS, np.nan)
+        self._value_scale = np.full(ADC_CHANNELS, np.nan)
+        self._value_offset = np.full(ADC_CHANNELS, np.nan)
+        for channel in self.channels:
+            per_code = codes_to_mA(1, channel.shunt_ohms, ref_voltage)
+            full_scale = channel.gain * per_code * (SATURATED - 1) + channel.offset
+            if full_scale <= FAULT_HIGH:
+                raise ValueError(f"Analog channel {channel.name}: the ADC tops out at {full_scale:.2f} mA, "
+                                 f"so currents above {FAULT_HIGH} mA cannot be detected; use a smaller shunt")
+            self._mA_scale[channel.adc] = channel.gain * per_code
+            self._mA_offset[channel.adc] = channel.offset
+            slope = (channel.high - channel.low) / (MAX_CURRENT - MIN_CURRENT)
+            self._value_scale[channel.adc] = slope
+            self._value_offset[channel.adc] = channel.low - MIN_CURRENT * slope
+
+        self._filters = [_ChannelFilter(smoothing, window) for _ in self.channels]
+        self.latest = np.full(len(self.channels), np.nan)
+
+    def current(self, channels, codes):
+        """Calibrated loop current in mA of every sample, NaN outside the fault band."""
+        channels = np.asarray(channels, dtype=np.intp)
+        codes = np.asarray(codes)
+        current = codes * self._mA_scale[channels] + self._mA_offset[channels]
+        current[(current < FAULT_LOW) | (current > FAULT_HIGH) | (codes >= SATURATED)] = np.nan
+        return current
+
+    def convert(self, channels, codes):
+        """Engineering value of every sample, in input order (unfiltered)."""
+        channels = np.asarray(channels, dtype=np.intp)
+        return self.current(channels, codes) * self._value_scale[channels] + self._value_offset[channels]
+
+    def process(self, channels, codes):
+        """
+        Converts and filters one block, e.g. read_adc_sequence()'s result.
+        Returns {name: values} with each channel's filtered output, oldest first.
+        """
+        channels = np.asarray(channels, dtype=np.intp)
+        values = self.convert(channels, codes)
+        result = {}
+        for index, channel in enumerate(self.channels):
+            filtered = self._filters[index](values[channels == channel.adc])
+            if len(filtered):
+                self.latest[index] = filtered[-1]
+            result[channel.name] = filtered
+        return result
+
+    def reset(self):
+        for channel_filter in self._filters:
+            channel_filter.reset()
+        self.latest[:] = np.nan
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Leak detector benchmark: detection latency and false trips.
+
+Replays flow traces through every detector at the monitor's sample rate and
+reports, per scenario, how long after the leak started each detector tripped
+and how many times it tripped before the leak (false trips, per hour).
+
+Built-in scenarios are generated with the simulator's flow profiles and
+Poisson pulse noise. Recorded captures (CSV in the hardware.load_trace
+format, e.g. from DataCollection.py) can be added with --trace; pass the
+time the leak started with --leak-at, or leave it out for a leak-free trace.
+
+Usage: python benchmarks/detector_latency.py [--tolerance GAL_S] [--delay S]
+                                             [--trace FILE [--leak-at S]] [--seed N]
+"""
+
+import argparse
+import csv
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hardware import gallons_per_minute, load_trace, noisy, ramp, step
+from leak_detector import DETECTORS, make_detector
+from sampling_engine import PULSES_PER_GALLON
+
+SAMPLE_INTERVAL = 1.0
+
+
+def sample_counts(profiles, duration, interval=SAMPLE_INTERVAL, rng=None):
+    """
+    Pulse counts per sample window for each profile (pulses per second as a
+    function of time). With rng the counts get Poisson noise like real pulses.
+    """
+    t = np.arange(0.0, duration, interval)
+    counts = []
+    for profile in profiles:
+        expected = np.array([profile(start) for start in t]) * interval
+        counts.append(rng.poisson(expected) if rng is not None else np.round(expected))
+    return t + interval, np.array(counts, dtype=float)
+
+
+def scenarios(tolerance, seed):
+    """Yields (name, t, imbalance, leak_start) for the built-in scenarios."""
+    rng = np.random.default_rng(seed)
+    supply = gallons_per_minute(1.0)
+    leak_pulses = tolerance * PULSES_PER_GALLON
+    hour = 3600.0
+    leak_at = 1800.0
+
+    def run(name, sensor1, sensor2, duration, leak_start):
+        t, counts = sample_counts([sensor1, sensor2], duration, rng=rng)
+        rates = counts / (PULSES_PER_GALLON * SAMPLE_INTERVAL)
+        return name, t, rates[0] - rates[1], leak_start
+
+    yield run("no leak", supply, supply, hour, None)
+    yield run("no leak, 20% jitter", noisy(supply, 0.2, seed), noisy(supply, 0.2, seed + 1), hour, None)
+    for factor in (2.0, 1.0, 0.5):
+        leak = step(supply, lambda t, f=factor: supply(t) + f * leak_pulses, leak_at)
+        yield run(f"step leak {factor:g}x tolerance", leak, supply, hour, leak_at)
+    yield run("creeping leak", ramp(supply, leak_pulses / 1800.0, leak_at), supply, hour, leak_at)
+
+
+def trace_scenario(path, leak_at):
+    """Builds a scenario from a recorded capture (sensor 1 and 2 of its first rack)."""
+    profiles = load_trace(path)[:2]
+    if len(profiles) < 2:
+        raise ValueError(f"{path} needs two count columns")
+    with open(path, newline="") as f:
+        times = [float(row["t"]) for row in csv.DictReader(f)]
+    t, counts = sample_counts(profiles, times[-1] - times[0])
+    rates = counts / (PULSES_PER_GALLON * SAMPLE_INTERVAL)
+    return os.path.basename(path), t, rates[0] - rates[1], leak_at
+
+
+def evaluate(kind, t, imbalance, leak_start, tolerance, delay):
+    """Returns (latency in seconds or None, false trips before the leak)."""
+    detector = make_detector([kind], tolerance, delay)
+    latency = None
+    false_trips = 0
+    for now, value in zip(t, imbalance):
+        if not detector.update(now, [value])[0]:
+            continue
+        if leak_start is None or now < leak_start:
+            false_trips += 1
+        elif latency is None:
+            latency = now - leak_start
+            break
+    return latency, false_trips
+
+
+def run(tolerance=0.01, delay=10.0, traces=(), seed=1):
+    """
+    Returns a list of (scenario, has_leak, {detector: (latency, false trips,
+    false trips per hour)}).
+    """
+    results = []
+    for name, t, imbalance, leak_start in list(scenarios(tolerance, seed)) + list(traces):
+        clean_hours = ((leak_start if leak_start is not None else t[-1]) - t[0]) / 3600.0
+        row = {}
+        for kind in DETECTORS:
+            latency, false_trips = evaluate(kind, t, imbalance, leak_start, tolerance, delay)
+            row[kind] = (latency, false_trips, false_trips / clean_hours if clean_hours > 0 else 0.0)
+        results.append((name, leak_start is not None, row))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tolerance", type=float, default=0.01, help="accepted difference in gal/s")
+    parser.add_argument("--delay", type=float, default=10.0, help="duration threshold in seconds")
+    parser.add_argument("--trace", action="append", default=[], help="recorded CSV capture to replay")
+    parser.add_argument("--leak-at", type=float, action="append", default=[],
+                        help="seconds into the matching --trace where its leak starts")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    leak_times = args.leak_at + [None] * (len(args.trace) - len(args.leak_at))
+    traces = [trace_scenario(path, leak_at) for path, leak_at in zip(args.trace, leak_times)]
+    results = run(args.tolerance, args.delay, traces, args.seed)
+
+    print(f"tolerance {args.tolerance} gal/s, duration threshold {args.delay:g} s, "
+          f"one sample per {SAMPLE_INTERVAL:g} s")
+    print(f"{'scenario':32}" + "".join(f"{kind:>22}" for kind in DETECTORS))
+    for name, has_leak, row in results:
+        cells = []
+        for kind in DETECTORS:
+            latency, false_trips, per_hour = row[kind]
+            detected = "-" if not has_leak else "missed" if latency is None else f"{latency:.0f} s"
+            cells.append(f"{detected} / {per_hour:.1f} FT/h")
+        print(f"{name:32}" + "".join(f"{cell:>22}" for cell in cells))
+    print("latency after the leak started / false trips per hour before it")
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Edge ingestion benchmark: process CPU per 1000 pulses, per-pulse callbacks
+versus batched edges.
+
+Drives two TimestampedCounters (the costlier counter) through a backend at
+increasing pulse rates and divides the process CPU time by the pulses
+counted. On the simulator (default) both paths are emulated: the callback
+path calls into Python once per pulse, the batched path once per
+EDGE_BATCH_INTERVAL with an array of edge times. The simulator's own thread
+is included in both, and on the board the callback path costs more (every
+RPi.GPIO callback is also a thread wakeup and a GIL handover).
+
+On the board (--board) the pulses must come from an external signal
+generator on --pins; the rate is whatever it produces, so pass --rates with
+the one value that describes it.
+
+Usage: python benchmarks/edge_ingestion.py [--seconds 3] [--rates 1000 10000 50000]
+                                           [--board --pins 17 18]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hardware import EDGE_BATCH_INTERVAL, SimulatedBackend, constant, get_backend
+from pulse_counter import TimestampedCounter
+
+RATES = (1000, 10000, 50000) # Pulses per second, across both sensors
+PINS = (17, 18)
+
+
+def measure(backend, pins, seconds, rate=None):
+    """Returns (cpu_ms_per_1k_pulses, pulses_per_second) for one backend."""
+    counters = [TimestampedCounter() for _ in pins]
+    if rate is not None:
+        for pin in pins:
+            backend.set_profile(pin, constant(rate / len(pins)))
+    if backend.batched_edges:
+        backend.setup_edge_inputs({pin: counter.add_edges for pin, counter in zip(pins, counters)})
+    else:
+        for pin, counter in zip(pins, counters):
+            backend.setup_pulse_input(pin, counter.pulse)
+    time.sleep(0.5) # Let the input threads settle
+    start_total = sum(counter.total() for counter in counters)
+    cpu = time.process_time()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu
+    pulses = sum(counter.total() for counter in counters) - start_total
+    backend.cleanup()
+    return (cpu * 1000 / (pulses / 1000) if pulses else float("nan")), pulses / seconds
+
+
+def run(seconds=3.0, rates=RATES, board=False, pins=PINS):
+    results = {}
+    for rate in rates:
+        row = {"pulses_per_second": rate}
+        for mode in ("callback", "batched"):
+            if board:
+                backend = get_backend("rpi", mode)
+                cpu, achieved = measure(backend, pins, seconds)
+            else:
+                # Batches arrive as often as GpiodBackend reads them
+                tick = EDGE_BATCH_INTERVAL if mode == "batched" else 0.001
+                backend = SimulatedBackend(tick=tick, batch_edges=mode == "batched")
+                cpu, achieved = measure(backend, pins, seconds, rate)
+            row[f"{mode}_cpu_ms_per_1k_pulses"] = cpu
+            row[f"{mode}_achieved_rate"] = achieved
+        results[str(rate)] = row
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--rates", type=int, nargs="+", default=list(RATES))
+    parser.add_argument("--board", action="store_true", help="use the real GPIO (RPi.GPIO vs gpiod)")
+    parser.add_argument("--pins", type=int, nargs="+", default=list(PINS))
+    args = parser.parse_args()
+    for rate, row in run(args.seconds, args.rates, args.board, args.pins).items():
+        print(f"{rate:>6} pulses/s  callback {row['callback_cpu_ms_per_1k_pulses']:.2f} ms/1k"
+              f" ({row['callback_achieved_rate']:.0f}/s)  batched {row['batched_cpu_ms_per_1k_pulses']:.2f} ms/1k"
+              f" ({row['batched_achieved_rate']:.0f}/s)")
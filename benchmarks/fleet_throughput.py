@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Fleet aggregator benchmark: ingest throughput and fan-in latency.
+
+Starts stand-in monitors in separate processes. Each speaks the monitor's
+subscribe protocol (hello, then sample and event messages built with the
+same helpers as monitor_service) on its own TCP port. One FleetAggregator
+then subscribes to all of them.
+
+Two measurements:
+    throughput  stand-ins send as fast as the aggregator takes them; merged messages/s
+    latency     stand-ins send `--rate` messages/s each; send-to-merge delay percentiles
+
+Usage: python benchmarks/fleet_throughput.py [--monitors 200] [--processes 4] [--racks 4]
+                                             [--rate 10] [--seconds 5]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from fleet_aggregator import FleetAggregator
+from monitor_service import event_message, sample_message
+
+EVENT_EVERY = 20 # One event per this many samples
+
+
+def rack_state(rack):
+    return {"name": f"Rack {rack + 1}", "status": "Active", "last_shutoff_date": "No shutoff recorded",
+            "tolerance": 0.01, "duration_threshold": 10.0, "rate1": None, "rate2": None, "difference": None}
+
+
+# --- Stand-in monitor (runs in the child processes) ---
+
+async def standin_client(reader, writer, racks, rate):
+    if not await reader.readline():
+        return
+    writer.write(json.dumps({"type": "hello", "ok": True, "host": "standin", "t": time.time(),
+                             "racks": [rack_state(rack) for rack in range(racks)]}).encode() + b"\n")
+    rng = random.Random()
+    interval = 1.0 / rate if rate else 0.0
+    deadline = time.monotonic()
+    sent = 0
+    try:
+        while True:
+            if sent % EVENT_EVERY == EVENT_EVERY - 1:
+                rack = rng.randrange(racks)
+                state = dict(rack_state(rack), status=rng.choice(["Active", "Inactive"]))
+                message = event_message(time.time(), rack, "leak", state)
+            else:
+                rates = [rng.random() * 0.02 for _ in range(racks)]
+                message = sample_message(time.time(), rates, rates, [0.0] * racks)
+            writer.write(json.dumps(message).encode() + b"\n")
+            sent += 1
+            await writer.drain() # TCP backpressure from the aggregator
+            # Unpaced clients still yield, or drain() would let one starve the rest
+            deadline += interval
+            await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+    except (ConnectionError, OSError):
+        pass
+
+
+async def run_standins(count, racks, rate):
+    servers = []
+    for _ in range(count):
+        servers.append(await asyncio.start_server(
+            lambda r, w: standin_client(r, w, racks, rate), "127.0.0.1", 0))
+    ports = [server.sockets[0].getsockname()[1] for server in servers]
+    print(json.dumps(ports), flush=True)
+    await asyncio.Event().wait()
+
+
+# --- Benchmark driver ---
+
+def start_standins(monitors, processes, racks, rate):
+    """Launches the stand-in processes; returns (processes, endpoints)."""
+    children = []
+    endpoints = []
+    per_process = [monitors // processes + (i < monitors % processes) for i in range(processes)]
+    for count in per_process:
+        if not count:
+            continue
+        child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--standin", str(count),
+                                  "--racks", str(racks), "--rate", str(rate)],
+                                 stdout=subprocess.PIPE, text=True)
+        children.append(child)
+    for child in children:
+        ports = json.loads(child.stdout.readline())
+        endpoints += [f"127.0.0.1:{port}" for port in ports]
+    return children, endpoints
+
+
+async def measure(endpoints, seconds, record_latency):
+    aggregator = FleetAggregator(endpoints, record_latency=record_latency)
+    await aggregator.start()
+    # Let every link connect and send its hello before timing
+    while not all(link.connected for link in aggregator.links.values()):
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(0.5)
+    aggregator.latencies.clear()
+    merged_before = aggregator.merged
+    events_before = len(aggregator.events)
+    begin = time.perf_counter()
+    await asyncio.sleep(seconds)
+    elapsed = time.perf_counter() - begin
+    result = {
+        "messages_per_second": (aggregator.merged - merged_before) / elapsed,
+        "events_per_second": (len(aggregator.events) - events_before) / elapsed,
+        "racks": len(aggregator.racks),
+    }
+    if record_latency and aggregator.latencies:
+        latencies = np.array(aggregator.latencies) * 1000
+        result.update(latency_p50_ms=float(np.percentile(latencies, 50)),
+                      latency_p99_ms=float(np.percentile(latencies, 99)),
+                      latency_max_ms=float(latencies.max()))
+    await aggregator.stop()
+    return result
+
+
+def run(monitors=200, processes=4, racks=4, rate=10.0, seconds=5.0):
+    results = {}
+    for name, send_rate, record_latency in (("throughput", 0, False), ("latency", rate, True)):
+        children, endpoints = start_standins(monitors, processes, racks, send_rate)
+        try:
+            results[name] = asyncio.run(measure(endpoints, seconds, record_latency))
+        finally:
+            for child in children:
+                child.kill()
+                child.wait()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--monitors", type=int, default=200)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--racks", type=int, default=4, help="racks per monitor")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages/s per monitor in the latency run")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--standin", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.standin:
+        try:
+            asyncio.run(run_standins(args.standin, args.racks, args.rate))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    results = run(args.monitors, args.processes, args.racks, args.rate, args.seconds)
+    print(f"{args.monitors} monitors x {args.racks} racks")
+    for name, result in results.items():
+        print(f"{name}: " + ", ".join(f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}"
+                                      for key, value in result.items()))
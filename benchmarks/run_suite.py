@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for the acquisition, detection and rendering paths.
+
+Runs off-device on the simulated backend and writes one JSON file, so runs
+from two versions can be compared with --compare:
+
+    pulse_callbacks  cost of one counter callback, and process CPU at
+                     increasing pulse rates next to a no-op callback
+    edge_ingestion   CPU per 1000 pulses, per-pulse callbacks versus batched
+                     edges (benchmarks/edge_ingestion.py)
+    detector         engine cycles per second for 1 to 500 racks, per detector
+    graph            FlowGraph frame time (blit and full redraw) versus the
+                     number of points shown; drawn on an off-screen Agg canvas,
+                     so Tk's copy to the screen is not included
+    graph_spans      FlowGraph frame time at zoom levels from 100 s to a week,
+                     drawn from the downsampled tiers, and the tiers' cost per
+                     sample
+    adc              AD5592R conversions per second, read_adc_channel() versus
+                     read_adc_sequence(), and SPI frames spent on configuration
+                     and output updates, against the emulated chip
+    analog           codes -> mA -> engineering units per second, one sample at
+                     a time versus AnalogPipeline on whole blocks
+    history          HistoryStore range queries over a month of 1 Hz samples
+                     of one rack, and varint decoding per value, a byte at a
+                     time versus decode_columns()
+    startup          time from launching flow_daemon.py until it is armed
+
+Usage: python benchmarks/run_suite.py [--output FILE] [--only NAME ...] [--quick]
+                                      [--compare OLD.json]
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, REPO)
+sys.path.insert(0, BENCHMARKS)
+
+# The suite never touches real hardware, and SPI chatter would only time the console
+os.environ["FLOW_MONITOR_BACKEND"] = "sim"
+os.environ.setdefault("SPI_LOG_LEVEL", "error")
+
+from analog_sensors import AnalogChannel, AnalogPipeline
+from hardware import SimulatedBackend, constant
+from history_store import HistoryStore, decode_columns, encode_column
+from history_tiers import TieredHistory
+from leak_detector import make_detector
+from pulse_counter import PulseCounter, TimestampedCounter
+from ring_buffer import RingBuffer
+from sampling_engine import SamplingEngine
+
+PULSE_RATES = (100, 1000, 10000, 50000) # Pulses per second, across both sensors
+RACK_COUNTS = (1, 10, 50, 100, 500)
+GRAPH_POINTS = (100, 1000, 10000, 100000)
+GRAPH_SPANS = (100, 3600, 86400, 604800) # Seconds, at one sample per second
+
+
+def median_ms(values):
+    return statistics.median(values) * 1000
+
+
+# --- Pulse callbacks ---
+
+def _simulated_cpu(callback, rate, seconds):
+    """
+    Process CPU seconds and pulses fired during `seconds` while the simulator
+    drives `callback` at `rate`, and the pulses fired in total.
+    """
+    backend = SimulatedBackend(tick=0.001)
+    for pin in (17, 18):
+        backend.set_profile(pin, constant(rate / 2))
+        backend.setup_pulse_input(pin, callback)
+    time.sleep(0.2) # Let the simulator thread reach its steady state
+    fired = backend.pulses_fired
+    cpu = time.process_time()
+    time.sleep(seconds)
+    cpu = time.process_time() - cpu
+    fired = backend.pulses_fired - fired
+    backend.cleanup()
+    return cpu, fired, backend.pulses_fired
+
+
+def bench_pulse_callbacks(seconds=2.0, calls=200000):
+    """
+    Direct cost of one callback, then the process CPU share at each pulse rate
+    with the plain and the timestamping counter and with a no-op callback.
+    """
+    results = {}
+    for name, counter in (("count", PulseCounter()), ("period", TimestampedCounter())):
+        pulse = counter.pulse
+        begin = time.perf_counter()
+        for _ in range(calls):
+            pulse(17)
+        results[f"{name}_call_us"] = (time.perf_counter() - begin) / calls * 1e6
+
+    for rate in PULSE_RATES:
+        cpu, fired, _ = _simulated_cpu(lambda pin: None, rate, seconds)
+        row = {"pulses_per_second": rate, "noop_cpu_percent": cpu / seconds * 100}
+        for name, counter in (("count", PulseCounter()), ("period", TimestampedCounter())):
+            cpu, fired, total = _simulated_cpu(counter.pulse, rate, seconds)
+            row[f"{name}_cpu_percent"] = cpu / seconds * 100
+            row[f"{name}_achieved_rate"] = fired / seconds
+            row[f"{name}_all_counted"] = counter.total() == total
+        results[str(rate)] = row
+    return results
+
+
+def bench_edge_ingestion(seconds=3.0):
+    import edge_ingestion
+    return edge_ingestion.run(seconds)
+
+
+# --- Detector ---
+
+def bench_detector(cycles=2000, kinds=("threshold", "cusum", "volume")):
+    results = {}
+    rng = np.random.default_rng(1)
+    for kind in kinds:
+        for racks in RACK_COUNTS:
+            counts = rng.poisson(47, size=(64, 2 * racks))
+            detector = make_detector([kind] * racks, tolerance=0.01, duration_threshold=10.0)
+            engine = SamplingEngine(lambda: counts[0], detector, lambda rack, sample: None,
+                                    racks=racks, history_capacity=4096)
+            begin = time.perf_counter()
+            for cycle in range(cycles):
+                engine.read_counts = lambda row=counts[cycle % len(counts)]: row
+                engine.sample(float(cycle), 1.0)
+            elapsed = time.perf_counter() - begin
+            results[f"{kind}/{racks}"] = {"racks": racks, "detector": kind, "cycles_per_second": cycles / elapsed,
+                                          "us_per_cycle": elapsed / cycles * 1e6}
+    return results
+
+
+# --- Graph ---
+
+def _offscreen_flow_graph():
+    """FlowGraph with its Tk canvas swapped for an Agg canvas, for machines without a display."""
+    import graph_renderer
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    class OffscreenCanvas(FigureCanvasAgg):
+        def __init__(self, figure, master=None):
+            super().__init__(figure)
+
+        def get_tk_widget(self):
+            return self
+
+        def pack(self):
+            pass
+
+    graph_renderer.FigureCanvasTkAgg = OffscreenCanvas
+    return graph_renderer.FlowGraph
+
+
+def bench_graph(frames=50):
+    FlowGraph = _offscreen_flow_graph()
+    rng = np.random.default_rng(2)
+    results = {}
+    for points in GRAPH_POINTS:
+        history = RingBuffer(["t", ("rate1", 1), ("rate2", 1), ("difference", 1)], points + frames + 1)
+        for i in range(points):
+            history.append(float(i), 0.0, 0.0, rng.uniform(0.0, 0.001))
+        graph = FlowGraph(None, history, points=points, max_fps=1e9)
+        graph.canvas.draw()
+
+        blit = []
+        for frame in range(frames):
+            history.append(float(points + frame), 0.0, 0.0, rng.uniform(0.0, 0.001))
+            begin = time.perf_counter()
+            graph.update(float(frame + 1))
+            blit.append(time.perf_counter() - begin)
+        full = []
+        for _ in range(max(frames // 5, 3)):
+            begin = time.perf_counter()
+            graph.canvas.draw()
+            full.append(time.perf_counter() - begin)
+        results[str(points)] = {"points": points, "blit_ms": median_ms(blit), "full_redraw_ms": median_ms(full),
+                                "full_redraws_during_blits": graph.full_redraws}
+    return results
+
+
+def bench_graph_spans(frames=20, samples=20000):
+    FlowGraph = _offscreen_flow_graph()
+    rng = np.random.default_rng(4)
+    tiers = TieredHistory()
+    zero = np.zeros(1)
+    begin = time.perf_counter()
+    for i in range(samples):
+        tiers.append(float(i), zero, zero, rng.uniform(0.0, 0.001, 1))
+    results = {"tier_append_us": (time.perf_counter() - begin) / samples * 1e6}
+
+    # A week of history: raw samples as far back as the engine keeps them, tiers filled directly
+    end = max(GRAPH_SPANS)
+    history = RingBuffer(["t", ("rate1", 1), ("rate2", 1), ("difference", 1)], 2 * 24 * 3600 + frames)
+    for t in range(end - history.capacity + frames, end):
+        history.append(float(t), 0.0, 0.0, rng.uniform(0.0, 0.001))
+    for width, buffer in tiers.sources():
+        buffer.clear()
+        for t in np.arange(end - width * buffer.capacity, end, width):
+            low, high = np.sort(rng.uniform(0.0, 0.001, 2))
+            buffer.append(t, zero, zero, zero, zero, zero, zero, low, high, (low + high) / 2)
+
+    for span in GRAPH_SPANS:
+        graph = FlowGraph(None, history, max_fps=1e9, tiers=tiers.sources())
+        graph.set_span(span)
+        width, _ = graph._source()
+        blit = []
+        for frame in range(frames):
+            history.append(float(end + frame), 0.0, 0.0, rng.uniform(0.0, 0.001))
+            graph._drawn = None
+            begin = time.perf_counter()
+            graph.update()
+            blit.append(time.perf_counter() - begin)
+        results[str(span)] = {"span_s": span, "bucket_s": width, "points": len(graph.line.get_xdata()),
+                              "blit_ms": median_ms(blit)}
+    return results
+
+
+# --- AD5592R ---
+
+def load_adc_module():
+    """Imports "ADC config code.py", whose name is not a valid module name."""
+    spec = importlib.util.spec_from_file_location("adc_config_code", os.path.join(REPO, "ADC config code.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def bench_adc(samples=2000):
+    adc = load_adc_module()
+    adc.open_device(SimulatedBackend())
+    adc.configure_ad5592r_minimal()
+    configure_frames = adc.spi.transfers
+
+    # Output updates go through the driver's register shadow: repeats send nothing
+    frames = adc.spi.transfers
+    begin = time.perf_counter()
+    for i in range(samples):
+        adc.set_digital_outputs(1, (i // 2) % 2)
+    outputs = time.perf_counter() - begin
+    output_frames = adc.spi.transfers - frames
+
+    begin = time.perf_counter()
+    for i in range(samples):
+        adc.read_adc_channel(i % 2)
+    single = time.perf_counter() - begin
+
+    begin = time.perf_counter()
+    adc.read_adc_sequence(0x03, samples)
+    batched = time.perf_counter() - begin
+    return {"samples": samples,
+            "single_shot_per_second": samples / single,
+            "batched_per_second": samples / batched,
+            "speedup": single / batched,
+            "configure_frames": configure_frames,
+            "output_updates_per_second": samples / outputs,
+            "output_frames_per_update": output_frames / samples}
+
+
+# --- Analog conversion ---
+
+def bench_analog(samples=200000, block=2000):
+    channels = [AnalogChannel("supply", 0, 0.0, 100.0, "psi"), AnalogChannel("return", 1, 0.0, 100.0, "psi")]
+    rng = np.random.default_rng(3)
+    addresses = np.tile(np.arange(len(channels)), samples // len(channels))
+    codes = rng.integers(700, 4096, size=len(addresses)).astype(np.uint16)
+
+    # One Python call per sample, the way S3V's convert_to_mA() is used
+    scale = [2.5 / 4096 / 125 * 1000] * len(channels)
+    begin = time.perf_counter()
+    for address, code in zip(addresses.tolist(), codes.tolist()):
+        current = code * scale[address]
+        channels[address].low + (current - 4.0) * (channels[address].high - channels[address].low) / 16.0
+    scalar = time.perf_counter() - begin
+
+    results = {"samples": len(codes), "scalar_per_second": len(codes) / scalar}
+    for smoothing in (None, "mean", "decimate"):
+        pipeline = AnalogPipeline(channels, smoothing, 8)
+        begin = time.perf_counter()
+        for start in range(0, len(codes), block):
+            pipeline.process(addresses[start:start + block], codes[start:start + block])
+        elapsed = time.perf_counter() - begin
+        results[f"{smoothing or 'unfiltered'}_per_second"] = len(codes) / elapsed
+    return results
+
+
+# --- History store ---
+
+def _decode_bytewise(data, pos, count):
+    # A byte at a time, the way HistoryStore decoded before decode_columns()
+    values = []
+    previous = 0
+    for _ in range(count):
+        n = 0
+        shift = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            n |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        previous += (n >> 1) ^ -(n & 1)
+        values.append(previous)
+    return values, pos
+
+
+def bench_history(days=30, queries=3):
+    scratch = tempfile.mkdtemp(prefix="flow-bench-")
+    store = HistoryStore(os.path.join(scratch, "history"), [1380.0], fsync=False)
+    samples = int(days * 86400)
+    rng = np.random.default_rng(5)
+    counts = rng.poisson(23, size=(samples, 2)).tolist()
+    start = 1.7e9
+    begin = time.perf_counter()
+    for i in range(samples):
+        store.append(start + i, 1.0, counts[i])
+    store.flush()
+    written = time.perf_counter() - begin
+
+    results = {"samples": samples, "stored_bytes": store.stored_bytes(),
+               "bytes_per_sample": store.stored_bytes() / samples, "write_per_second": samples / written}
+    for name, seconds in (("hour", 3600), ("day", 86400), ("all", samples)):
+        timings = []
+        for _ in range(queries):
+            begin = time.perf_counter()
+            rows = store.query(start + samples - seconds, start + samples)
+            timings.append(time.perf_counter() - begin)
+        results[f"query_{name}_seconds"] = min(timings)
+        results[f"query_{name}_samples"] = len(rows["t"])
+    store.close()
+
+    # One chunk's payload (ten minutes of the samples above), decoded both ways
+    chunk = 600
+    payload = bytearray()
+    for column in ([int((start + i) * 1000) for i in range(chunk)], [1000] * chunk,
+                   [row[0] for row in counts[:chunk]], [row[1] for row in counts[:chunk]]):
+        encode_column(column, payload)
+    payload = bytes(payload)
+    values = 4 * chunk
+    begin = time.perf_counter()
+    for _ in range(20):
+        pos = 0
+        for _ in range(4):
+            _, pos = _decode_bytewise(payload, pos, chunk)
+    bytewise = (time.perf_counter() - begin) / 20
+    begin = time.perf_counter()
+    for _ in range(20):
+        decode_columns(payload, 0, 4, chunk)
+    vectorized = (time.perf_counter() - begin) / 20
+    results.update({"bytewise_values_per_second": values / bytewise,
+                    "vectorized_values_per_second": values / vectorized, "decode_speedup": bytewise / vectorized})
+    return results
+
+
+# --- Startup ---
+
+def bench_startup(runs=5):
+    import startup_time
+    scratch = tempfile.mkdtemp(prefix="flow-bench-")
+    # Keep the daemon's socket, telemetry and history away from a monitor that may be running
+    os.environ["FLOW_MONITOR_SOCKET"] = os.path.join(scratch, "monitor.sock")
+    os.environ["FLOW_MONITOR_TELEMETRY"] = os.path.join(scratch, "telemetry")
+    os.environ["FLOW_MONITOR_HISTORY"] = os.path.join(scratch, "history")
+    return startup_time.run(runs)
+
+
+SUITE = {
+    "pulse_callbacks": (bench_pulse_callbacks, {"seconds": 0.5, "calls": 20000}),
+    "edge_ingestion": (bench_edge_ingestion, {"seconds": 0.5}),
+    "detector": (bench_detector, {"cycles": 300}),
+    "graph": (bench_graph, {"frames": 10}),
+    "graph_spans": (bench_graph_spans, {"frames": 5, "samples": 2000}),
+    "adc": (bench_adc, {"samples": 300}),
+    "analog": (bench_analog, {"samples": 20000}),
+    "history": (bench_history, {"days": 1}),
+    "startup": (bench_startup, {"runs": 2}),
+}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "describe", "--always", "--dirty"], cwd=REPO,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "machine": platform.machine(),
+            "platform": platform.platform(), "numpy": np.__version__, "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z")}
+
+
+def run(names=None, quick=False):
+    results = {"environment": environment()}
+    for name, (bench, quick_options) in SUITE.items():
+        if names and name not in names:
+            continue
+        print(f"{name}...", file=sys.stderr, flush=True)
+        results[name] = bench(**(quick_options if quick else {}))
+    return results
+
+
+def compare(old, new, path=()):
+    """Yields (path, old, new) for every number present in both result trees."""
+    for key, value in new.items():
+        if key == "environment" or key not in old:
+            continue
+        if isinstance(value, dict):
+            yield from compare(old[key], value, path + (key,))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield "/".join(path + (key,)), old[key], value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--only", nargs="+", choices=sorted(SUITE), help="run only these benchmarks")
+    parser.add_argument("--quick", action="store_true", help="short runs, for checking the suite itself")
+    parser.add_argument("--compare", help="earlier results file to print ratios against")
+    args = parser.parse_args()
+
+    results = run(args.only, args.quick)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print(f"{'':50} {'old':>12} {'new':>12} {'new/old':>8}")
+        for name, before, after in compare(old, results):
+            ratio = f"{after / before:8.2f}" if before else "       -"
+            print(f"{name:50} {before:12.4g} {after:12.4g} {ratio}")
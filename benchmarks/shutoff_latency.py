@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Time-to-shutoff benchmark for the sampling engine and its watchdog.
+
+Runs a RackMonitor on the simulated backend with a fast sample interval and
+measures:
+
+    leak path      a leak is switched on in the simulator; time until the
+                   solenoid is driven HIGH (the rack's delay is set to 0)
+    fail-safe      the engine thread is blocked (as a stuck listener would);
+                   time until the watchdog has closed the solenoid
+
+Optionally a busy thread competes for the interpreter the way a long Tk
+redraw does. The monitor's own latency report (histograms and worst-case
+bounds) is printed at the end.
+
+Usage: python benchmarks/shutoff_latency.py [--interval 0.1] [--runs 10] [--busy]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hardware import HIGH, SimulatedBackend, gallons_per_minute, step
+from racks import Rack, RackMonitor
+
+RACK = Rack("Bench", 17, 18, 27, tolerance=0.005, duration_threshold=0.0)
+
+
+class StallListener:
+    """Engine listener that blocks the engine thread when asked to."""
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.started = None
+
+    def __call__(self, sample):
+        if self.seconds:
+            seconds, self.seconds = self.seconds, 0.0
+            self.started = time.monotonic()
+            time.sleep(seconds)
+
+
+def wait_for_shutoff(backend, timeout):
+    end = time.monotonic() + timeout
+    while backend.outputs.get(RACK.solenoid_pin) != HIGH:
+        if time.monotonic() > end:
+            return None
+        time.sleep(0.0005)
+    return time.monotonic()
+
+
+def busy_loop(stop):
+    while not stop.is_set():
+        sum(range(10000))
+
+
+def run(interval=0.1, runs=10, busy=False):
+    backend = SimulatedBackend(tick=0.001)
+    normal = gallons_per_minute(1.0)
+    backend.set_profile(RACK.sensor1_pin, normal, RACK.solenoid_pin)
+    backend.set_profile(RACK.sensor2_pin, normal, RACK.solenoid_pin)
+    monitor = RackMonitor([RACK], backend, interval=interval)
+    stall = StallListener()
+    monitor.engine.listeners.append(stall)
+    monitor.setup_gpio()
+
+    stop_busy = threading.Event()
+    if busy:
+        threading.Thread(target=busy_loop, args=(stop_busy,), daemon=True).start()
+    monitor.start()
+
+    leak_times = []
+    fail_safe_times = []
+    try:
+        for _ in range(runs):
+            # Leak path: sensor 1 reads high from now on
+            monitor.activate(0)
+            monitor.engine.settle_until[0] = 0
+            time.sleep(2 * interval)
+            leak_start = time.monotonic()
+            backend.set_profile(RACK.sensor1_pin, step(normal, gallons_per_minute(3.0), backend.sim_time()),
+                                RACK.solenoid_pin)
+            shut = wait_for_shutoff(backend, 10 * interval + 1)
+            backend.set_profile(RACK.sensor1_pin, normal, RACK.solenoid_pin)
+            if shut is not None:
+                leak_times.append(shut - leak_start)
+
+            # Fail-safe path: block the engine for much longer than the watchdog timeout
+            monitor.activate(0)
+            time.sleep(2 * interval)
+            stall_seconds = monitor.watchdog.timeout * 3
+            stall.seconds = stall_seconds
+            shut = wait_for_shutoff(backend, stall_seconds + 1)
+            if shut is not None and stall.started is not None:
+                fail_safe_times.append(shut - stall.started)
+            time.sleep(stall_seconds + interval) # Let the engine recover before the next run
+    finally:
+        stop_busy.set()
+        monitor.stop()
+        backend.cleanup()
+    return leak_times, fail_safe_times, monitor.watchdog.report()
+
+
+def describe(values):
+    if not values:
+        return "none"
+    ms = [value * 1000 for value in values]
+    return f"median {statistics.median(ms):.1f} ms, max {max(ms):.1f} ms over {len(ms)}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--interval", type=float, default=0.1, help="sample interval in seconds")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--busy", action="store_true", help="add a CPU-bound thread competing for the GIL")
+    args = parser.parse_args()
+
+    leak_times, fail_safe_times, report = run(args.interval, args.runs, args.busy)
+    print(f"sample interval {args.interval * 1000:.0f} ms, watchdog timeout {report['timeout_ms']:.0f} ms")
+    print(f"leak -> shutoff:      {describe(leak_times)}")
+    print(f"stall -> fail-safe:   {describe(fail_safe_times)}")
+    for name in ("engine_lateness", "engine_cycle_time", "trip_latency", "check_lateness", "fail_safe_time"):
+        stats = report[name]
+        print(f"{name:20}  p50 {stats['p50_ms']:.2f}  p99 {stats['p99_ms']:.2f}  max {stats['max_ms']:.2f} ms"
+              f"  ({stats['count']} samples)")
+    print(f"worst case shutoff bound {report['worst_case_shutoff_ms']:.1f} ms, "
+          f"fail-safe bound {report['worst_case_fail_safe_ms']:.1f} ms, fail-safes {report['fail_safes']}")
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: time from launching the monitor until it is armed.
+
+Launches the monitor as a fresh process, waits for its "Armed ..." line
+(printed once GPIO, counters and the detector are running) and stops it
+again. Also times how long the deferred plotting stack takes to import, which
+is what used to sit in front of arming.
+
+Usage: python benchmarks/startup_time.py [--gui] [--runs N]
+"""
+
+import argparse
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def time_to_armed(script, timeout=60.0):
+    """Returns seconds from process launch until the script reports it is armed."""
+    begin = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(REPO, script)], cwd=REPO,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    try:
+        for line in proc.stdout:
+            if line.startswith("Armed"):
+                return time.perf_counter() - begin
+            if time.perf_counter() - begin > timeout:
+                break
+        raise RuntimeError(f"{script} did not arm: {proc.poll()}")
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def time_import(module):
+    """Returns seconds needed to import `module` in a fresh interpreter."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    result = subprocess.run([sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def summarize(values):
+    return {"median_ms": statistics.median(values) * 1000, "max_ms": max(values) * 1000, "runs": len(values)}
+
+
+def run(runs=5, gui=False):
+    results = {"daemon_time_to_armed": summarize([time_to_armed("flow_daemon.py") for _ in range(runs)])}
+    if gui:
+        results["gui_time_to_armed"] = summarize([time_to_armed("FlowMonitor8-13.py") for _ in range(runs)])
+    results["deferred_graph_import"] = summarize([time_import("graph_renderer") for _ in range(runs)])
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--gui", action="store_true", help="also time FlowMonitor8-13.py (needs a display)")
+    args = parser.parse_args()
+    for name, stats in run(args.runs, args.gui).items():
+        print(f"{name}: median {stats['median_ms']:.0f} ms, max {stats['max_ms']:.0f} ms over {stats['runs']} runs")
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Stress test for the pulse counters.
+
+Fires synthetic GPIO callbacks from many threads while a reader samples the
+counters the way the sampling engine does, then checks that every pulse was
+accounted for. Exits with status 1 if any pulse was lost.
+
+Usage: python benchmarks/stress_pulse_counter.py [threads] [pulses_per_thread]
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pulse_counter import PulseCounter, CounterReader
+
+
+def run(num_threads=16, pulses_per_thread=200000):
+    counters = [PulseCounter(), PulseCounter()]
+    reader = CounterReader(counters)
+    sampled = [0, 0]
+    done = threading.Event()
+    start_gate = threading.Barrier(num_threads + 1)
+
+    def fire(counter):
+        start_gate.wait()
+        for _ in range(pulses_per_thread):
+            counter.pulse(0)
+
+    def sample():
+        while not done.is_set():
+            for i, count in enumerate(reader.read()):
+                if count < 0:
+                    raise AssertionError("Counter went backwards")
+                sampled[i] += count
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=fire, args=(counters[i % 2],)) for i in range(num_threads)]
+    sampler = threading.Thread(target=sample)
+    for thread in threads:
+        thread.start()
+    sampler.start()
+
+    begin = time.perf_counter()
+    start_gate.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - begin
+    done.set()
+    sampler.join()
+
+    # Pick up whatever arrived after the sampler's last window
+    for i, count in enumerate(reader.read()):
+        sampled[i] += count
+
+    expected = [pulses_per_thread * len(threads[i::2]) for i in range(2)]
+    totals = [counter.total() for counter in counters]
+    print(f"Threads: {num_threads}, pulses fired: {sum(expected)}, "
+          f"{sum(expected) / elapsed:,.0f} pulses/s")
+    print(f"Expected: {expected}  Totals: {totals}  Sampled: {sampled}")
+    return totals == expected and sampled == expected
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:3]]
+    if run(*args):
+        print("OK: no pulses lost")
+    else:
+        print("FAIL: pulses lost")
+        sys.exit(1)
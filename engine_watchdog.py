@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Fail-safe watchdog for the sampling engine.
+
+Detection only protects a rack while the engine thread keeps running. The
+watchdog is a separate thread that checks the engine's heartbeat several
+times per sample interval. If a cycle is overdue by more than `timeout`
+seconds (a stuck listener, a hung counter read, a stalled process), it calls
+the fail-safe, which closes every solenoid. Racks stay closed until someone
+switches them back on.
+
+That bounds the time to shutoff even when detection stops:
+
+    normal path    interval + worst lateness + worst cycle time
+    fail-safe      timeout + check interval + fail-safe time
+
+report() gives both bounds together with the histograms they come from.
+
+The watchdog shares the interpreter with the engine, so it cannot help if
+the whole process is frozen; a hardware watchdog (/dev/watchdog) or an
+external supervisor covers that case.
+"""
+
+import threading
+
+from instrumentation import METRICS
+from latency_histogram import LatencyHistogram
+
+
+class Watchdog(threading.Thread):
+    """
+    Watches `engine.heartbeat` and calls fail_safe() once per stall.
+    timeout defaults to one missed sample interval beyond the expected one.
+    """
+
+    def __init__(self, engine, fail_safe, timeout=None, check_interval=None, clock=None):
+        super().__init__(name="watchdog", daemon=True)
+        self.engine = engine
+        self.fail_safe = fail_safe
+        self.timeout = timeout if timeout is not None else 2 * engine.interval
+        self.check_interval = check_interval if check_interval is not None else min(engine.interval, self.timeout) / 4
+        self.clock = clock or engine.clock
+        self.fail_safes = 0
+        self.stalled = False
+        # Heartbeat age at every check, and the time the fail-safe took
+        self.heartbeat_age = LatencyHistogram()
+        self.fail_safe_time = LatencyHistogram()
+        self.check_lateness = LatencyHistogram()
+        METRICS.timer("watchdog_heartbeat_age", "Time since the engine's last cycle, at every check",
+                      self.heartbeat_age)
+        METRICS.timer("watchdog_fail_safe", "Closing every solenoid after a stall", self.fail_safe_time)
+        METRICS.gauge("watchdog_fail_safes", lambda: self.fail_safes, "Stalls that triggered the fail-safe")
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        deadline = self.clock() + self.check_interval
+        while not self._stop_event.wait(max(deadline - self.clock(), 0.0)):
+            now = self.clock()
+            self.check_lateness.record(now - deadline)
+            deadline = max(deadline + self.check_interval, now)
+            self.check(now)
+
+    def check(self, now):
+        """One watchdog check at clock time `now`."""
+        age = now - self.engine.heartbeat
+        self.heartbeat_age.record(age)
+        if age <= self.timeout:
+            self.stalled = False
+            return
+        if self.stalled:
+            return # Already handled this stall
+        self.stalled = True
+        self.fail_safes += 1
+        begin = self.clock()
+        self.fail_safe()
+        self.fail_safe_time.record(self.clock() - begin)
+
+    def report(self):
+        """Latency histograms and the worst-case time-to-shutoff bounds, in milliseconds."""
+        engine = self.engine
+        interval_ms = engine.interval * 1000
+        lateness = engine.lateness.summary()
+        cycle = engine.cycle_time.summary()
+        return {
+            "interval_ms": interval_ms,
+            "timeout_ms": self.timeout * 1000,
+            "fail_safes": self.fail_safes,
+            "missed_deadlines": engine.missed_deadlines,
+            "engine_lateness": lateness,
+            "engine_cycle_time": cycle,
+            "trip_latency": engine.trip_latency.summary(),
+            "heartbeat_age": self.heartbeat_age.summary(),
+            "check_lateness": self.check_lateness.summary(),
+            "fail_safe_time": self.fail_safe_time.summary(),
+            # Worst observed so far: a leak starting just after a window opened
+            "worst_case_shutoff_ms": interval_ms + lateness["max_ms"] + cycle["max_ms"],
+            "worst_case_fail_safe_ms": (self.timeout + self.check_interval) * 1000
+                                       + self.check_lateness.max * 1000 + self.fail_safe_time.max * 1000,
+        }
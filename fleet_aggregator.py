@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fleet aggregator: one merged view of every rack on every flow monitor.
+
+Keeps a persistent subscription (see monitor_service.py) to each monitor,
+over TCP ("host:port", the monitor's FLOW_MONITOR_LISTEN) or a local Unix
+socket path, and reconnects with backoff when one drops. Incoming messages
+go through one bounded queue into a single merge task. When merging falls
+behind, the readers stop reading and the monitors start dropping samples for
+this subscriber (never events), so memory stays bounded.
+
+The merged state is indexed by (monitor, rack), by status, and by time for
+shutoff events. It is served to clients with the same JSON-lines protocol as
+the control socket:
+
+    {"cmd": "fleet"}                          every rack
+    {"cmd": "racks", "status": "Inactive"}    racks in one state
+    {"cmd": "events", "since": 1718000000.0}  events after a wall-clock time
+    {"cmd": "monitors"}                       connection state of every monitor
+
+Usage: python3 fleet_aggregator.py [--listen host:port] ENDPOINT [ENDPOINT ...]
+       ENDPOINT is host:port, a socket path, or name=either to label it.
+"""
+
+import argparse
+import asyncio
+import bisect
+import json
+import time
+from collections import deque
+
+from monitor_service import parse_address
+
+DEFAULT_LISTEN = "127.0.0.1:8760"
+INGEST_QUEUE = 10000 # Messages waiting to be merged, across all monitors
+EVENT_HISTORY = 10000 # Events kept for "events" queries
+RECONNECT_DELAYS = (0.5, 1, 2, 5, 10) # Seconds, the last one repeats
+YIELD_EVERY = 16 # Lines a monitor's reader takes before letting the others in
+
+
+def parse_endpoint(spec):
+    """Returns (name, endpoint) from "name=endpoint" or a bare endpoint."""
+    name, _, endpoint = spec.rpartition("=")
+    return name or spec, endpoint
+
+
+async def open_endpoint(endpoint, limit=2 ** 20):
+    """Opens a stream to "host:port" or to a Unix socket path."""
+    if "/" in endpoint:
+        return await asyncio.open_unix_connection(endpoint, limit=limit)
+    host, port = parse_address(endpoint)
+    return await asyncio.open_connection(host, port, limit=limit)
+
+
+class MonitorLink:
+    """Connection state of one monitor."""
+
+    def __init__(self, name, endpoint):
+        self.name = name
+        self.endpoint = endpoint
+        self.connected = False
+        self.host = None
+        self.connects = 0
+        self.messages = 0
+        self.last_message = None
+        self.last_error = None
+
+    def summary(self):
+        return {"name": self.name, "endpoint": self.endpoint, "connected": self.connected,
+                "host": self.host, "connects": self.connects, "messages": self.messages,
+                "last_message": self.last_message, "last_error": self.last_error}
+
+
+class FleetAggregator:
+    """
+    Subscribes to many monitors and merges their racks into one view.
+
+    With record_latency, the delay from each message's send time to its
+    merge is kept in `latencies` (bounded), for benchmarking.
+    """
+
+    def __init__(self, endpoints, queue_size=INGEST_QUEUE, record_latency=False):
+        self.links = {}
+        for spec in endpoints:
+            name, endpoint = parse_endpoint(spec)
+            if name in self.links:
+                raise ValueError(f"Monitor {name} listed twice")
+            self.links[name] = MonitorLink(name, endpoint)
+
+        self.racks = {} # (monitor, rack) -> state dict
+        self.by_status = {} # status -> set of (monitor, rack)
+        # Sorted by t (monitors' events interleave on arrival), with the times
+        # alongside for bisecting; the oldest are dropped past EVENT_HISTORY
+        self.events = []
+        self._event_times = []
+        self.merged = 0
+        self.record_latency = record_latency
+        self.latencies = deque(maxlen=1000000)
+        self._queue = asyncio.Queue(queue_size)
+        self._tasks = []
+
+    # --- Ingest ---
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._merge_loop())]
+        self._tasks += [asyncio.create_task(self._follow(link)) for link in self.links.values()]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _follow(self, link):
+        attempt = 0
+        while True:
+            writer = None
+            try:
+                reader, writer = await open_endpoint(link.endpoint)
+                writer.write(b'{"cmd": "subscribe"}\n')
+                await writer.drain()
+                link.connected = True
+                link.connects += 1
+                link.last_error = None
+                attempt = 0
+                received = 0
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        raise ConnectionError("Monitor closed the stream")
+                    # Waits here when merging is behind, which stops reading from this monitor
+                    await self._queue.put((link, line))
+                    # Buffered lines never suspend readline() or put(); yield now and then
+                    # so one busy monitor cannot fill the queue ahead of the others
+                    received += 1
+                    if received % YIELD_EVERY == 0:
+                        await asyncio.sleep(0)
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ValueError) as e:
+                link.last_error = str(e)
+            finally:
+                link.connected = False
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(RECONNECT_DELAYS[min(attempt, len(RECONNECT_DELAYS) - 1)])
+            attempt += 1
+
+    async def _merge_loop(self):
+        while True:
+            link, line = await self._queue.get()
+            try:
+                self.merge(link, json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                link.last_error = f"Bad message: {e}"
+
+    def merge(self, link, message):
+        """Applies one stream message from `link` to the merged view."""
+        link.messages += 1
+        link.last_message = time.time()
+        self.merged += 1
+        if self.record_latency and "t" in message:
+            self.latencies.append(link.last_message - message["t"])
+
+        kind = message.get("type")
+        if kind == "sample":
+            for rack, (rate1, rate2, difference) in enumerate(
+                    zip(message["rate1"], message["rate2"], message["difference"])):
+                state = self.racks.get((link.name, rack))
+                if state is not None:
+                    state.update(rate1=rate1, rate2=rate2, difference=difference, updated=message["t"])
+        elif kind == "event":
+            self._set_rack(link, message["rack"], message["state"], message["t"])
+            self._add_event({"t": message["t"], "monitor": link.name, "rack": message["rack"],
+                             "name": message["state"]["name"], "event": message["event"]})
+        elif kind == "hello":
+            link.host = message.get("host")
+            for key in [key for key in self.racks if key[0] == link.name]:
+                self._remove_rack(key)
+            for rack, state in enumerate(message["racks"]):
+                self._set_rack(link, rack, state, message["t"])
+
+    def _set_rack(self, link, rack, state, t):
+        key = (link.name, rack)
+        self._remove_rack(key)
+        state = dict(state, monitor=link.name, rack=rack, updated=t)
+        self.racks[key] = state
+        self.by_status.setdefault(state["status"], set()).add(key)
+
+    def _add_event(self, event):
+        i = bisect.bisect_right(self._event_times, event["t"])
+        self._event_times.insert(i, event["t"])
+        self.events.insert(i, event)
+        if len(self.events) > EVENT_HISTORY:
+            del self._event_times[0], self.events[0]
+
+    def _remove_rack(self, key):
+        state = self.racks.pop(key, None)
+        if state is not None:
+            self.by_status.get(state["status"], set()).discard(key)
+
+    # --- Queries ---
+
+    def fleet(self):
+        return [self.racks[key] for key in sorted(self.racks)]
+
+    def racks_with_status(self, status):
+        return [self.racks[key] for key in sorted(self.by_status.get(status, ()))]
+
+    def events_since(self, since=0.0):
+        return self.events[bisect.bisect_right(self._event_times, since):]
+
+    def handle(self, request):
+        """Answers one query and returns the reply dict."""
+        cmd = request.get("cmd")
+        if cmd == "fleet":
+            return {"ok": True, "racks": self.fleet()}
+        if cmd == "racks":
+            return {"ok": True, "racks": self.racks_with_status(request["status"])}
+        if cmd == "events":
+            return {"ok": True, "events": self.events_since(float(request.get("since", 0.0)))}
+        if cmd == "monitors":
+            return {"ok": True, "monitors": [link.summary() for link in self.links.values()]}
+        raise ValueError(f"Unknown command: {cmd}")
+
+    async def _serve_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                try:
+                    reply = self.handle(json.loads(line))
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, address=DEFAULT_LISTEN):
+        """Starts answering queries on "host:port"; returns the asyncio server."""
+        host, port = parse_address(address)
+        return await asyncio.start_server(self._serve_client, host, port)
+
+
+async def main(args):
+    aggregator = FleetAggregator(args.endpoints)
+    await aggregator.start()
+    server = await aggregator.serve(args.listen)
+    print(f"Aggregating {len(aggregator.links)} monitor(s), queries on {args.listen}", flush=True)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merged status of many flow monitors")
+    parser.add_argument("endpoints", nargs="+", help="host:port, socket path, or name=either")
+    parser.add_argument("--listen", default=DEFAULT_LISTEN, help="host:port for queries")
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
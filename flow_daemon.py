@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless flow monitor.
+
+Runs pulse counting, leak detection and solenoid shutoff for every rack with
+no display server, Tk or matplotlib. The Tk window (FlowMonitor8-13.py)
+connects to it over the control socket when it is running.
+
+Usage: python3 flow_daemon.py [racks.json]
+"""
+
+import time
+STARTED = time.perf_counter()
+import signal
+import sys
+import threading
+
+from hardware import get_backend
+from instrumentation import METRICS, start_exporters
+from monitor_service import ControlServer, SOCKET_PATH, LISTEN_ADDRESS
+from racks import RackMonitor, find_racks, DEFAULT_HISTORY_DIR
+from telemetry import TELEMETRY_PATH
+
+SAMPLE_INTERVAL = 1.0 # Seconds between counter snapshots
+
+
+def log_shutoffs(monitor):
+    """Prints automatic shutoffs, so they show up in the service log."""
+    def listener(rack, event):
+        if event in ("leak", "watchdog"):
+            print(f"{event} shutoff: {monitor.names[rack]}", flush=True)
+    monitor.event_listeners.append(listener)
+
+
+def main(argv):
+    racks = find_racks(argv[1] if len(argv) > 1 else None)
+
+    # FLOW_MONITOR_BACKEND=sim runs against the pulse simulator instead of the board
+    backend = get_backend()
+    monitor = RackMonitor(racks, backend, interval=SAMPLE_INTERVAL, history_dir=DEFAULT_HISTORY_DIR,
+                          telemetry_path=TELEMETRY_PATH)
+    monitor.setup_gpio()
+    log_shutoffs(monitor)
+    server = ControlServer(monitor, SOCKET_PATH, LISTEN_ADDRESS)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    monitor.start()
+    print(f"Armed {len(racks)} rack(s) in {(time.perf_counter() - STARTED) * 1000:.0f} ms", flush=True)
+    server.start()
+    start_exporters(METRICS)
+    print(f"Control socket at {SOCKET_PATH}", flush=True)
+    if LISTEN_ADDRESS:
+        print(f"Fleet listener (status and subscribe only) on {LISTEN_ADDRESS}", flush=True)
+
+    try:
+        while not stop.wait(1.0):
+            pass
+    finally:
+        server.stop()
+        monitor.stop()
+        time.sleep(1)
+        backend.cleanup()
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental matplotlib renderer for the flow difference graph.
+
+The axes, labels and legend are drawn once and cached as a background. Each
+update only moves the existing Line2D with set_data and blits it over the
+cached background. A full redraw happens only when the axis limits have to
+change or the window is resized.
+
+Long spans are drawn from the engine's downsampled tiers (history_tiers.py):
+the graph reads the finest history that covers the visible span in at most
+MAX_POINTS points, so a week costs about as much to draw as 100 seconds.
+Tier buckets are drawn as their min-max range, so short spikes stay visible.
+"""
+
+import time
+
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+from instrumentation import METRICS
+
+MIN_Y_LIMIT = 0.001 # gal/s, keeps the axis readable while there is no flow
+MAX_POINTS = 1500 # Points drawn at most, about a screen width
+
+
+class FlowGraph:
+    """
+    Plots the newest `points` flow differences of one rack from the sampling
+    engine's RingBuffer history.
+
+    `tiers` is a list of (bucket seconds, buffer) from coarser histories,
+    finest first (TieredHistory.sources()). set_span() then zooms out to
+    spans the raw history could not draw cheaply.
+
+    Redraws are capped at max_fps and skipped entirely when no new samples
+    have arrived, so the plotting rate is independent of the sampling rate.
+    """
+
+    def __init__(self, master, history, points=100, sample_interval=1.0, max_fps=1.0,
+                 figsize=(6, 5), rack=0, tiers=()):
+        self.history = history
+        self.rack = rack
+        self.points = points
+        self.sources = [(sample_interval, history)] + list(tiers)
+        self.span = points * sample_interval
+        self.min_period = 1.0 / max_fps
+        self.frames_drawn = 0
+        self.full_redraws = 0
+        self._redraw_timer = METRICS.timer("graph_full_redraw", "canvas.draw() of the whole figure")
+        self._blit_timer = METRICS.timer("graph_blit", "Redrawing the line over the cached background")
+
+        self.figure = Figure(figsize=figsize)
+        self.ax = self.figure.add_subplot()
+        (self.line,) = self.ax.plot([], [], label="Flow Rate Difference (gal/s)", animated=True)
+        self.ax.set_xlabel("Time (s)")
+        self.ax.set_ylabel("Flow difference (gal/s)")
+        self.ax.set_xlim(0, points * sample_interval)
+        self.ax.set_ylim(0, MIN_Y_LIMIT)
+        self.ax.legend(loc="upper right")
+
+        self.canvas = FigureCanvasTkAgg(self.figure, master=master)
+        self.canvas.get_tk_widget().pack()
+        self.canvas.mpl_connect("draw_event", self._on_draw)
+
+        self._background = None
+        self._drawn = None
+        self._last_draw = float("-inf")
+
+    def _on_draw(self, event):
+        # Every full draw (including resizes) refreshes the cached background
+        self._background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self.ax.draw_artist(self.line)
+
+    def set_rack(self, rack):
+        """Switches the graph to another rack and forces a redraw."""
+        self.rack = rack
+        self._drawn = None
+        self._last_draw = float("-inf")
+        self.update()
+
+    def set_span(self, seconds):
+        """Shows the newest `seconds` of history, switching tiers as needed."""
+        self.span = seconds
+        self.line.set_data([], [])
+        self.ax.set_xlim(0, seconds)
+        with self._redraw_timer:
+            self.canvas.draw()
+        self.full_redraws += 1
+        self._drawn = None
+        self._last_draw = float("-inf")
+        self.update()
+
+    def _source(self):
+        """
+        (bucket seconds, buffer) of the finest history that shows the span in
+        at most MAX_POINTS points. While a tier is still filling up, a finer
+        one that holds fewer points in total is used instead.
+        """
+        for width, source in self.sources:
+            if min(self.span / width, source.total_appended) <= MAX_POINTS:
+                return width, source
+        return self.sources[-1]
+
+    def _read(self, width, source):
+        """Time stamps and values to plot from one source."""
+        n = max(int(round(self.span / width)), 1)
+        if source is self.history:
+            return source.window(n, ("t", "difference"), column=self.rack)
+        # One vertical stroke per bucket, from its min to its max
+        time_stamps, low, high = source.window(n, ("t", "difference_min", "difference_max"), column=self.rack)
+        return np.repeat(time_stamps, 2), np.column_stack((low, high)).ravel()
+
+    def _rescale(self, normalized_t, differences):
+        """Adjusts the axis limits if the data left them. Returns True if they changed."""
+        changed = False
+        top = self.ax.get_ylim()[1]
+        # Samples taken while a rack was settling are NaN
+        valid = differences[~np.isnan(differences)]
+        peak = float(valid.max()) if len(valid) else 0.0
+        # Grow straight away, shrink only once the data is well below the limit
+        if peak > top or (top > MIN_Y_LIMIT and peak < top / 4):
+            self.ax.set_ylim(0, max(peak * 1.25, MIN_Y_LIMIT))
+            changed = True
+
+        span = float(normalized_t[-1])
+        if span > self.ax.get_xlim()[1]:
+            self.ax.set_xlim(0, span)
+            changed = True
+        return changed
+
+    def update(self, now=None):
+        """
+        Redraws the line if new samples arrived and the frame budget allows.
+        Returns True when a frame was drawn.
+        """
+        now = time.monotonic() if now is None else now
+        if now - self._last_draw < self.min_period:
+            return False
+        width, source = self._source()
+        drawn = (width, source.total_appended)
+        if drawn == self._drawn:
+            return False
+
+        time_stamps, differences = self._read(width, source)
+        if not len(time_stamps):
+            return False
+        self._drawn = drawn
+        self._last_draw = now
+
+        normalized_t = time_stamps - time_stamps[0]
+        self.line.set_data(normalized_t, differences)
+
+        if self._rescale(normalized_t, differences) or self._background is None:
+            with self._redraw_timer:
+                self.canvas.draw()
+            self.full_redraws += 1
+        else:
+            with self._blit_timer:
+                self.canvas.restore_region(self._background)
+                self.ax.draw_artist(self.line)
+                self.canvas.blit(self.figure.bbox)
+        self.frames_drawn += 1
+        return True
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+"""
+Hardware abstraction for the flow monitor and the AD5592R scripts.
+
+Everything the monitor needs from the board goes through a backend:
+
+    setup_pulse_input(pin, callback)  flow sensor pulses -> callback(pin)
+    setup_edge_inputs({pin: on_edges})  the same, in batches of edge times
+                                      (only where batched_edges is True)
+    setup_output(pin) / output(pin, value)  solenoids, SYNC line
+    open_spi(bus, device, max_speed_hz, mode)  spidev.SpiDev-like device
+    cleanup()
+
+RPiBackend wraps RPi.GPIO and spidev. GpiodBackend reads the flow sensor
+edges from the kernel's GPIO character device instead: the kernel timestamps
+and queues the edges, and one reader thread hands them over in batches, so
+Python wakes up once per batch rather than once per pulse. SimulatedBackend
+generates flow pulses from rate profiles (or replays recorded traces) and
+emulates the AD5592R, so the detector and acquisition paths can be run and
+profiled on any Linux box.
+
+Pick one with get_backend(), or the FLOW_MONITOR_BACKEND environment variable
+("rpi" or "sim"). FLOW_MONITOR_EDGES chooses how pulses arrive: "callback"
+(one RPi.GPIO callback per pulse), "batched" (gpiod, or batches from the
+simulator) or "auto" (the default: gpiod on the board when its 2.x Python
+bindings are installed, otherwise callbacks).
+"""
+
+import bisect
+import csv
+import math
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+HIGH = 1
+LOW = 0
+EDGE_MODE = os.environ.get("FLOW_MONITOR_EDGES", "auto").lower()
+GPIO_CHIP = os.environ.get("FLOW_MONITOR_GPIOCHIP", "/dev/gpiochip0")
+EDGE_BATCH_INTERVAL = 0.01 # Seconds the gpiod reader lets edges queue up in the kernel
+EDGE_BUFFER = 4096 # Edges the kernel queues per request before it starts dropping
+
+
+class Backend:
+    """Interface shared by all backends."""
+
+    HIGH = HIGH
+    LOW = LOW
+    batched_edges = False
+
+    def setup_pulse_input(self, pin, callback):
+        raise NotImplementedError
+
+    def setup_edge_inputs(self, handlers):
+        """
+        Configures rising-edge inputs from {pin: on_edges}. on_edges is called
+        from a backend thread with an int64 array of edge times (monotonic ns),
+        oldest first.
+        """
+        raise NotImplementedError
+
+    def setup_output(self, pin, initial=None):
+        raise NotImplementedError
+
+    def output(self, pin, value):
+        raise NotImplementedError
+
+    def open_spi(self, bus, device, max_speed_hz=1000000, mode=0b00):
+        raise NotImplementedError
+
+    def cleanup(self):
+        pass
+
+
+class RPiBackend(Backend):
+    """The real board: RPi.GPIO in BCM numbering and spidev."""
+
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_pulse_input(self, pin, callback):
+        self.GPIO.setup(pin, self.GPIO.IN)
+        self.GPIO.add_event_detect(pin, self.GPIO.RISING, callback=callback)
+
+    def setup_output(self, pin, initial=None):
+        if initial is None:
+            self.GPIO.setup(pin, self.GPIO.OUT)
+        else:
+            self.GPIO.setup(pin, self.GPIO.OUT, initial=initial)
+
+    def output(self, pin, value):
+        self.GPIO.output(pin, value)
+
+    def open_spi(self, bus, device, max_speed_hz=1000000, mode=0b00):
+        import spidev
+        spi = spidev.SpiDev()
+        spi.open(bus, device)
+        spi.max_speed_hz = max_speed_hz
+        spi.mode = mode
+        return spi
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+
+
+class GpiodBackend(RPiBackend):
+    """
+    RPiBackend with the flow sensor edges read through libgpiod 2.x.
+
+    All edge inputs share one line request and one reader thread. The reader
+    sleeps EDGE_BATCH_INTERVAL between reads so edges collect in the kernel
+    queue, then hands each pin's edges to its handler as one array. Edges the
+    kernel had to drop (a full queue) are counted in lost_edges from the gaps
+    in the per-line sequence numbers.
+    Raises ImportError when the gpiod 2.x bindings are missing and OSError
+    when `chip` is not a GPIO character device.
+    """
+
+    batched_edges = True
+
+    def __init__(self, chip=GPIO_CHIP, batch_interval=EDGE_BATCH_INTERVAL):
+        import gpiod
+        if not hasattr(gpiod, "request_lines"):
+            raise ImportError("gpiod 2.x Python bindings are required for batched edges")
+        if not gpiod.is_gpiochip_device(chip):
+            raise OSError(f"{chip} is not a GPIO character device")
+        super().__init__()
+        self.gpiod = gpiod
+        self.chip = chip
+        self.batch_interval = batch_interval
+        self.lost_edges = 0
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def setup_pulse_input(self, pin, callback):
+        self.setup_edge_inputs({pin: lambda times: [callback(pin) for _ in range(len(times))]})
+
+    def setup_edge_inputs(self, handlers):
+        from gpiod.line import Clock, Direction, Edge
+        settings = self.gpiod.LineSettings(direction=Direction.INPUT, edge_detection=Edge.RISING,
+                                           event_clock=Clock.MONOTONIC)
+        request = self.gpiod.request_lines(self.chip, consumer="flow-monitor",
+                                           config={tuple(handlers): settings}, event_buffer_size=EDGE_BUFFER)
+        thread = threading.Thread(target=self._read_edges, args=(request, dict(handlers)),
+                                  name="gpio-edges", daemon=True)
+        self._threads.append(thread)
+        thread.start()
+
+    def _read_edges(self, request, handlers):
+        last_seqno = {}
+        try:
+            while not self._stop_event.is_set():
+                if not request.wait_edge_events(0.1):
+                    continue
+                events = request.read_edge_events(EDGE_BUFFER)
+                # One pass over the event objects; everything after is array work
+                edges = np.array([(event.line_offset, event.timestamp_ns, event.line_seqno) for event in events],
+                                 dtype=np.int64).reshape(-1, 3)
+                for pin, on_edges in handlers.items():
+                    mine = edges[edges[:, 0] == pin]
+                    if not len(mine):
+                        continue
+                    first = last_seqno.get(pin, mine[0, 2] - 1)
+                    self.lost_edges += int(mine[-1, 2] - first) - len(mine)
+                    last_seqno[pin] = mine[-1, 2]
+                    on_edges(mine[:, 1])
+                self._stop_event.wait(self.batch_interval)
+        finally:
+            request.release()
+
+    def cleanup(self):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+        super().cleanup()
+
+
+# --- Flow profiles for the simulator ---
+# A profile is a function of simulated time (seconds) returning pulses per second.
+
+def constant(pulses_per_second):
+    return lambda t: pulses_per_second
+
+
+def gallons_per_minute(gpm, pulses_per_gallon=2840):
+    """Constant flow given in gallons per minute."""
+    return constant(gpm * pulses_per_gallon / 60.0)
+
+
+def step(before, after, at):
+    """Switches from one profile to another at time `at`, e.g. a leak starting."""
+    return lambda t: before(t) if t < at else after(t)
+
+
+def ramp(profile, extra_per_second, start=0.0):
+    """Adds a slowly growing rate on top of a profile, e.g. a creeping leak."""
+    return lambda t: profile(t) + max(0.0, t - start) * extra_per_second
+
+
+def noisy(profile, relative_jitter=0.05, seed=None):
+    """Multiplies a profile by random jitter around 1."""
+    rng = random.Random(seed)
+    return lambda t: max(0.0, profile(t) * rng.gauss(1.0, relative_jitter))
+
+
+def replay(times, totals):
+    """
+    Piecewise-constant profile from a recorded trace of cumulative pulse
+    counts, so a capture from DataCollection.py can be played back.
+    """
+    times = list(times)
+    rates = []
+    for i in range(1, len(times)):
+        dt = times[i] - times[i - 1]
+        rates.append((totals[i] - totals[i - 1]) / dt if dt > 0 else 0.0)
+    start = times[0] if times else 0.0
+
+    def profile(t):
+        t += start
+        if not rates or t < times[0] or t >= times[-1]:
+            return 0.0
+        return rates[bisect.bisect_right(times, t) - 1]
+    return profile
+
+
+def load_trace(path):
+    """
+    Reads a CSV capture with a 't' column and one cumulative 'countN' column
+    per sensor. Returns a list of replay profiles, one per count column.
+    """
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    if not rows:
+        raise ValueError(f"Empty trace: {path}")
+    times = [float(row["t"]) for row in rows]
+    columns = sorted((name for name in rows[0] if name.startswith("count")), key=lambda name: int(name[5:]))
+    return [replay(times, [int(row[name]) for row in rows]) for name in columns]
+
+
+class SimulatedAD5592R:
+    """
+    Minimal spidev.SpiDev stand-in that answers like an AD5592R: writes to
+    ADC_SEQ select the channels, and every following frame returns the next
+    conversion tagged with its channel address in bits 14:12. A readback
+    request returns the register's value on the next frame; SW_RESET clears
+    the registers.
+    `adc_value(channel, t)` supplies the 12-bit codes.
+    """
+
+    def __init__(self, adc_value=None):
+        self.adc_value = adc_value or (lambda channel, t: 1024 + channel * 256 + int(200 * math.sin(t)))
+        self.max_speed_hz = 0
+        self.mode = 0
+        self.transfers = 0
+        self.registers = {}
+        self._sequence = []
+        self._position = 0
+        self._pending = None
+
+    def open(self, bus, device):
+        pass
+
+    def close(self):
+        pass
+
+    def xfer2(self, data):
+        self.transfers += 1
+        words = [(data[i] << 8) | data[i + 1] for i in range(0, len(data) - 1, 2)]
+        out = []
+        for word in words:
+            result = self._pending if self._pending is not None else 0
+            out += [(result >> 8) & 0xFF, result & 0xFF]
+            address = (word >> 11) & 0xF
+            if (word & 0x8000) == 0 and address == 0xF: # SW_RESET
+                self.registers = {}
+                self._sequence = []
+                self._pending = None
+            elif (word & 0x8000) == 0 and address == 0x7 and word & (1 << 6): # Readback request
+                self._pending = self.registers.get((word >> 2) & 0xF, 0)
+            elif (word & 0x8000) == 0 and address != 0:
+                self.registers[address] = word & 0x7FF
+                if address == 0x2: # ADC_SEQ
+                    self._sequence = [ch for ch in range(8) if word & (1 << ch)]
+                    self._position = 0
+                self._pending = None
+            elif self._sequence:
+                # A NOP frame clocks out the previous conversion and starts the next
+                channel = self._sequence[self._position % len(self._sequence)]
+                self._position += 1
+                self._pending = (channel << 12) | self.adc_value(channel, time.monotonic())
+        return out + [0] * (len(data) - len(out))
+
+
+class SimulatedBackend(Backend):
+    """
+    Generates flow pulses from profiles on a background thread.
+
+    speedup multiplies simulated time, so a profile written in real-world
+    gallons per minute produces pulses `speedup` times faster (100x makes a
+    normal rack look like a very high-flow one). Pulses for a sensor stop
+    while the solenoid it is linked to is closed (HIGH).
+
+    With batch_edges, inputs set up with setup_edge_inputs() get each tick's
+    pulses as one array of edge times spread over the tick, like GpiodBackend.
+    """
+
+    def __init__(self, speedup=1.0, tick=0.001, default_profile=None, adc_value=None, batch_edges=False):
+        self.speedup = speedup
+        self.batched_edges = batch_edges
+        self.tick = tick
+        self.default_profile = default_profile or gallons_per_minute(1.0)
+        self.adc_value = adc_value
+        self.outputs = {}
+        self.pulses_fired = 0
+        self._inputs = {} # pin -> [callback, profile, solenoid_pin, fractional pulses, batched]
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._start_time = None
+
+    def set_profile(self, pin, profile, solenoid_pin=None):
+        """Sets the pulse rate profile of a sensor pin, optionally gated by a solenoid."""
+        with self._lock:
+            entry = self._inputs.setdefault(pin, [None, None, None, 0.0, False])
+            entry[1] = profile
+            entry[2] = solenoid_pin
+
+    def setup_pulse_input(self, pin, callback):
+        with self._lock:
+            entry = self._inputs.setdefault(pin, [None, self.default_profile, None, 0.0, False])
+            entry[0] = callback
+            entry[4] = False
+        self._start()
+
+    def setup_edge_inputs(self, handlers):
+        if not self.batched_edges:
+            raise RuntimeError("Create the SimulatedBackend with batch_edges=True")
+        with self._lock:
+            for pin, on_edges in handlers.items():
+                entry = self._inputs.setdefault(pin, [None, self.default_profile, None, 0.0, True])
+                entry[0] = on_edges
+                entry[4] = True
+        self._start()
+
+    def setup_output(self, pin, initial=None):
+        self.outputs[pin] = LOW if initial is None else initial
+
+    def output(self, pin, value):
+        self.outputs[pin] = value
+
+    def open_spi(self, bus, device, max_speed_hz=1000000, mode=0b00):
+        spi = SimulatedAD5592R(self.adc_value)
+        spi.max_speed_hz = max_speed_hz
+        spi.mode = mode
+        return spi
+
+    def sim_time(self):
+        """Seconds of simulated time since the first pulse input was set up."""
+        if self._start_time is None:
+            return 0.0
+        return (time.monotonic() - self._start_time) * self.speedup
+
+    def cleanup(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._start_time = time.monotonic()
+            self._thread = threading.Thread(target=self._run, name="pulse-simulator", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        last = time.monotonic()
+        while not self._stop_event.wait(self.tick):
+            now = time.monotonic()
+            previous, last = last, now
+            dt = (now - previous) * self.speedup
+            t = self.sim_time()
+            with self._lock:
+                inputs = list(self._inputs.items())
+            for pin, entry in inputs:
+                callback, profile, solenoid_pin = entry[0], entry[1], entry[2]
+                if callback is None or profile is None:
+                    continue
+                if solenoid_pin is not None and self.outputs.get(solenoid_pin) == HIGH:
+                    continue
+                due = entry[3] + profile(t) * dt
+                pulses = int(due)
+                entry[3] = due - pulses
+                if entry[4]:
+                    if pulses:
+                        # Evenly spaced over the tick that just ended
+                        step_ns = (now - previous) * 1e9 / pulses
+                        callback(int(now * 1e9) - (np.arange(pulses - 1, -1, -1) * step_ns).astype(np.int64))
+                else:
+                    for _ in range(pulses):
+                        callback(pin)
+                self.pulses_fired += pulses
+
+
+def get_backend(name=None, edges=None):
+    """
+    Returns a backend by name ("rpi" or "sim"), defaulting to FLOW_MONITOR_BACKEND
+    or "rpi". edges is "auto", "batched" or "callback" (default FLOW_MONITOR_EDGES).
+    """
+    name = (name or os.environ.get("FLOW_MONITOR_BACKEND", "rpi")).lower()
+    edges = (edges or EDGE_MODE).lower()
+    if edges not in ("auto", "batched", "callback"):
+        raise ValueError(f"Unknown edge mode: {edges}")
+    if name == "rpi":
+        if edges == "batched":
+            return GpiodBackend()
+        if edges == "auto":
+            try:
+                return GpiodBackend()
+            except (ImportError, OSError):
+                pass # No usable gpiod: one RPi.GPIO callback per pulse, as before
+        return RPiBackend()
+    if name == "sim":
+        return SimulatedBackend(speedup=float(os.environ.get("FLOW_MONITOR_SIM_SPEEDUP", "1")),
+                                batch_edges=edges == "batched")
+    raise ValueError(f"Unknown hardware backend: {name}")
@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only on-disk history of the flow samples.
+
+Every sample stores its wall-clock time, the length of its counting window and
+the pulse count of every sensor. Rates and differences are derived from those
+exactly when queried, so nothing is lost by not storing them.
+
+Layout of a store directory:
+
+    meta.json           channel count and pulses per gallon of each rack
+    seg-<t_ms>.fts      segment files, rotated by size
+
+A segment is a sequence of chunk records:
+
+    magic "FTS1" | payload length u32 | crc32 u32 | min t_ms i64 | max t_ms i64 | samples u32
+    payload: one column after another (t_ms, window_ms, count of each sensor),
+             each zigzag delta-encoded as varints
+
+Samples are buffered in memory and written a chunk at a time (by default ten
+minutes of per-second samples) from a writer thread, with fsync batched per
+chunk. That keeps SD-card writes large and rare. After a power loss the tail
+of the last segment is checked and anything after the last complete chunk is
+truncated, so at most one unwritten chunk is lost. When a rack trips, the
+buffered samples (including the one that tripped) are written straight away,
+so the minutes before a shutoff are on disk even if the power goes next.
+
+Chunk headers carry their time range and are kept in memory as the time
+index, so a query only reads the chunks it overlaps, and decodes them all
+in one vectorized NumPy pass (a month of 1 Hz samples in well under a
+second; `python3 benchmarks/run_suite.py --only history`). Times are
+wall-clock, which can step backwards (a Pi without an RTC syncing NTP): the
+index is kept sorted by chunk start with the latest end seen so far, so
+chunks overlapping in time are still found, and query results are sorted.
+
+A failed write (disk full, I/O error) is reported and counted, the chunk is
+dropped and the segment cut back to its last complete chunk; the writer
+keeps going, so flush() and close() never wait on a dead thread.
+"""
+
+import bisect
+import glob
+import itertools
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from instrumentation import METRICS
+
+MAGIC = b"FTS1"
+HEADER = struct.Struct("<4sIIqqI")
+DEFAULT_CHUNK_SIZE = 600
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+
+_write_errors = METRICS.counter("history_write_errors", "History chunks lost to failed writes")
+
+
+# --- Varint column encoding ---
+
+def encode_column(values, out):
+    """Appends values as zigzag-encoded deltas in varint form."""
+    previous = 0
+    for value in values:
+        delta = value - previous
+        previous = value
+        n = (delta << 1) ^ (delta >> 63)
+        while n >= 0x80:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+
+def _varints(buf, total):
+    """
+    The first `total` varints of a uint8 array as uint64, and the bytes they
+    take. Bytes below 0x80 end a varint. Each varint starts as its last
+    7-bit group; the earlier groups are shifted in one byte position at a
+    time, only for the varints that long (most deltas take a single byte).
+    """
+    if total == 0:
+        return np.empty(0, dtype=np.uint64), 0
+    ends = np.flatnonzero(buf < 0x80)[:total]
+    if len(ends) < total:
+        raise ValueError("Truncated varint column")
+    buf = buf[:ends[-1] + 1]
+    starts = np.empty(total, dtype=np.intp)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    groups = buf & 0x7F
+    n = groups[ends].astype(np.uint64)
+    longer = np.flatnonzero(ends > starts)
+    position = 1
+    while len(longer):
+        # Group `position` from the end of every varint that has one
+        n[longer] = (n[longer] << np.uint64(7)) | groups[ends[longer] - position]
+        position += 1
+        longer = longer[ends[longer] - position >= starts[longer]]
+    return n, len(buf)
+
+
+def _unzigzag(n):
+    return ((n >> np.uint64(1)) ^ (np.uint64(0) - (n & np.uint64(1)))).view(np.int64)
+
+
+def decode_columns(data, pos, columns, count):
+    """
+    Decodes `columns` consecutive columns of `count` values each, written by
+    encode_column. Returns (int64 array of columns x count, new_pos).
+    """
+    n, used = _varints(np.frombuffer(data, dtype=np.uint8, offset=pos), columns * count)
+    return np.cumsum(_unzigzag(n).reshape(columns, count), axis=1), pos + used
+
+
+def decode_chunks(data, columns, counts):
+    """
+    Decodes chunk payloads laid end to end, chunk k holding counts[k] values
+    of each of `columns` columns, in one pass. Returns the rows of all chunks
+    (samples x columns, int64), in chunk order.
+    """
+    counts = np.asarray(counts, dtype=np.intp)
+    samples = int(counts.sum())
+    if samples == 0:
+        return np.empty((0, columns), dtype=np.int64)
+    n, _ = _varints(np.frombuffer(data, dtype=np.uint8), columns * samples)
+    deltas = _unzigzag(n)
+    if (counts == counts[0]).all():
+        # The usual case, full chunks only: one reshape does it
+        values = np.cumsum(deltas.reshape(len(counts), columns, counts[0]), axis=2)
+        return values.transpose(0, 2, 1).reshape(samples, columns)
+
+    # Every column of every chunk is a run of deltas from 0: a cumulative sum
+    # over everything, minus the sum reached before each run starts
+    runs = np.repeat(counts, columns)
+    run_starts = np.zeros(len(runs), dtype=np.intp)
+    np.cumsum(runs[:-1], out=run_starts[1:])
+    values = np.cumsum(deltas)
+    values -= np.repeat(values[run_starts] - deltas[run_starts], runs)
+
+    # Column-major within each chunk -> one row per sample
+    chunk = np.repeat(np.arange(len(counts)), counts)
+    first = np.zeros(len(counts), dtype=np.intp)
+    np.cumsum(counts[:-1], out=first[1:])
+    within = np.arange(samples) - first[chunk]
+    index = (columns * first[chunk] + within)[:, None] + np.arange(columns)[None, :] * counts[chunk][:, None]
+    return values[index]
+
+
+def decode_column(data, pos, count):
+    """Decodes `count` values written by encode_column. Returns (values, new_pos)."""
+    values, pos = decode_columns(data, pos, 1, count)
+    return values[0], pos
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class HistoryStore:
+    """
+    Chunked, append-only store of per-sensor pulse counts.
+
+    `pulses_per_gallon` has one entry per rack; channels are two per rack in
+    the same order the sampling engine reads them. Open with read_only=True
+    to query a store another process is writing; the tail is then left alone.
+    """
+
+    def __init__(self, path, pulses_per_gallon, chunk_size=DEFAULT_CHUNK_SIZE,
+                 segment_bytes=DEFAULT_SEGMENT_BYTES, fsync=True, read_only=False):
+        self.path = path
+        self.pulses_per_gallon = np.asarray(pulses_per_gallon, dtype=float)
+        self.channels = 2 * len(self.pulses_per_gallon)
+        self.chunk_size = chunk_size
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.read_only = read_only
+
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+            self._check_meta()
+
+        # Time index: one entry per chunk on disk, sorted by first_t_ms.
+        # _index_reach[i] is the latest last_t_ms of chunks 0..i.
+        self._index_first = []
+        self._index_reach = []
+        self._index = [] # (first_t_ms, last_t_ms, segment path, offset, length, samples)
+        self._index_lock = threading.Lock()
+        self._segment = None
+        self._segment_path = None
+        self._load_index()
+
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._flush_requested = False
+        self.write_errors = 0
+        self._queue = queue.Queue()
+        self._writer = None
+        if not read_only:
+            self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+            self._writer.start()
+
+    # --- Writing ---
+
+    def append(self, t, window, counts):
+        """
+        Adds one sample: wall-clock time t and window length in seconds, and
+        the pulse count of every channel. Cheap enough for the engine thread.
+        """
+        if self.read_only:
+            raise ValueError("History store was opened read-only")
+        row = [int(round(t * 1000)), int(round(window * 1000))]
+        row.extend(int(count) for count in counts)
+        with self._pending_lock:
+            self._pending.append(row)
+            if len(self._pending) < self.chunk_size and not self._flush_requested:
+                return
+            self._flush_requested = False
+            rows = self._pending
+            self._pending = []
+        self._queue.put(rows)
+
+    def record(self, sample):
+        """SamplingEngine listener: stores one engine Sample."""
+        self.append(time.time(), sample.elapsed, sample.counts)
+
+    def flush(self, wait=True):
+        """Writes any buffered samples as a (short) chunk; waits for the disk unless wait=False."""
+        with self._pending_lock:
+            rows = self._pending
+            self._pending = []
+        if rows:
+            self._queue.put(rows)
+        if wait and self._writer is not None and self._writer.is_alive():
+            self._queue.join()
+
+    def flush_soon(self):
+        """
+        Makes the next append() hand the buffered samples, that one included,
+        to the writer. Called when a rack trips, before the engine records the
+        tripping sample.
+        """
+        self._flush_requested = True
+
+    def close(self):
+        if self._writer is None:
+            return
+        self.flush()
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+
+    def _write_loop(self):
+        while True:
+            rows = self._queue.get()
+            try:
+                if rows is None:
+                    return
+                self._write_chunk(rows)
+            except Exception as e:
+                self.write_errors += 1
+                _write_errors.inc()
+                print(f"History: could not write {len(rows)} samples to {self.path}: {e}", file=sys.stderr, flush=True)
+            finally:
+                self._queue.task_done()
+
+    def _write_chunk(self, rows):
+        payload = bytearray()
+        for column in zip(*rows):
+            encode_column(column, payload)
+        # Min and max rather than first and last: the clock may have stepped back inside the chunk
+        times = [row[0] for row in rows]
+        first_t, last_t = min(times), max(times)
+        header = HEADER.pack(MAGIC, len(payload), zlib.crc32(payload), first_t, last_t, len(rows))
+
+        if self._segment is None or self._segment.tell() >= self.segment_bytes:
+            self._open_segment(first_t)
+        offset = self._segment.tell()
+        try:
+            self._segment.write(header + payload)
+            self._segment.flush()
+            if self.fsync:
+                os.fsync(self._segment.fileno())
+        except OSError:
+            # Cut off the partial chunk so later chunks are not hidden behind it on reopen
+            segment, self._segment = self._segment, None
+            try:
+                segment.truncate(offset)
+                segment.close()
+            except OSError:
+                pass
+            raise
+
+        with self._index_lock:
+            self._add_to_index((first_t, last_t, self._segment_path, offset, HEADER.size + len(payload), len(rows)))
+
+    def _add_to_index(self, chunk):
+        """Inserts a chunk in first_t order. Only a clock step makes it land anywhere but the end."""
+        i = bisect.bisect_right(self._index_first, chunk[0])
+        self._index_first.insert(i, chunk[0])
+        self._index.insert(i, chunk)
+        self._index_reach.insert(i, 0)
+        reach = self._index_reach[i - 1] if i else chunk[1]
+        for j in range(i, len(self._index)):
+            reach = max(reach, self._index[j][1])
+            self._index_reach[j] = reach
+
+    def _open_segment(self, first_t):
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_path = os.path.join(self.path, f"seg-{first_t:015d}.fts")
+        self._segment = open(self._segment_path, "ab")
+        if self.fsync:
+            _fsync_dir(self.path)
+
+    # --- Opening and recovery ---
+
+    def _check_meta(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        meta = {"channels": self.channels, "pulses_per_gallon": self.pulses_per_gallon.tolist()}
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                existing = json.load(f)
+            if existing["channels"] != self.channels:
+                raise ValueError(f"{self.path} holds {existing['channels']} channels, not {self.channels}")
+            return
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _load_index(self):
+        segments = sorted(glob.glob(os.path.join(self.path, "seg-*.fts")))
+        for i, segment_path in enumerate(segments):
+            last = i == len(segments) - 1 and not self.read_only
+            with open(segment_path, "rb") as f:
+                # Only the newest segment can have a torn tail, so only its
+                # payloads are checksummed on open
+                valid_end = self._scan_segment(f, segment_path, verify=last)
+            if last:
+                if valid_end < os.path.getsize(segment_path):
+                    with open(segment_path, "r+b") as f:
+                        f.truncate(valid_end)
+                self._segment_path = segment_path
+                self._segment = open(segment_path, "ab")
+
+    def _scan_segment(self, f, segment_path, verify):
+        offset = 0
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return offset
+            magic, length, crc, first_t, last_t, samples = HEADER.unpack(header)
+            if magic != MAGIC:
+                return offset
+            if verify:
+                payload = f.read(length)
+                if len(payload) < length or zlib.crc32(payload) != crc:
+                    return offset
+            else:
+                f.seek(length, os.SEEK_CUR)
+            self._add_to_index((first_t, last_t, segment_path, offset, HEADER.size + length, samples))
+            offset += HEADER.size + length
+
+    # --- Queries ---
+
+    def _decode(self, chunks):
+        """Rows of the given index entries, read one segment at a time and decoded together."""
+        payloads = []
+        for segment_path, run in itertools.groupby(chunks, key=lambda chunk: chunk[2]):
+            with open(segment_path, "rb") as f:
+                for chunk in run:
+                    f.seek(chunk[3] + HEADER.size)
+                    payloads.append(f.read(chunk[4] - HEADER.size))
+        return decode_chunks(b"".join(payloads), 2 + self.channels, [chunk[5] for chunk in chunks])
+
+    def query(self, start, end=None):
+        """
+        Returns the samples with start <= t < end (wall-clock seconds) as a
+        dict of NumPy arrays: t, window, counts (samples x channels),
+        rate1/rate2/difference (samples x racks, in gal/s).
+        """
+        start_ms = int(round(start * 1000))
+        end_ms = None if end is None else int(round(end * 1000))
+
+        with self._index_lock:
+            # Chunks are sorted by start; the first one that can reach start_ms
+            # is found on the running maximum of chunk ends
+            first = bisect.bisect_left(self._index_reach, start_ms)
+            last = len(self._index) if end_ms is None else bisect.bisect_left(self._index_first, end_ms)
+            chunks = [chunk for chunk in self._index[first:last] if chunk[1] >= start_ms]
+        blocks = [self._decode(chunks)]
+        with self._pending_lock:
+            if self._pending:
+                blocks.append(np.array(self._pending, dtype=np.int64))
+
+        rows = np.concatenate(blocks)
+        keep = rows[:, 0] >= start_ms
+        if end_ms is not None:
+            keep &= rows[:, 0] < end_ms
+        rows = rows[keep]
+        if len(rows) > 1 and np.any(np.diff(rows[:, 0]) < 0):
+            rows = rows[np.argsort(rows[:, 0], kind="stable")]
+        return self._derive(rows)
+
+    def query_before(self, t, seconds=600):
+        """Returns the `seconds` of history leading up to time t, e.g. a shutoff."""
+        return self.query(t - seconds, t)
+
+    def _derive(self, rows):
+        t = rows[:, 0] / 1000.0
+        window = rows[:, 1] / 1000.0
+        counts = rows[:, 2:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rates = counts.reshape(len(rows), len(self.pulses_per_gallon), 2) / (self.pulses_per_gallon[None, :, None] * window[:, None, None])
+        return {
+            "t": t,
+            "window": window,
+            "counts": counts,
+            "rate1": rates[:, :, 0],
+            "rate2": rates[:, :, 1],
+            "difference": np.abs(rates[:, :, 0] - rates[:, :, 1]),
+        }
+
+    def stored_bytes(self):
+        with self._index_lock:
+            return sum(chunk[4] for chunk in self._index)
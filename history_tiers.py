@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Downsampled tiers of the sampling engine's history, for long-horizon graphs.
+
+Next to the raw per-sample RingBuffer, every tier keeps one row per time
+bucket (10 s, 1 min and 10 min by default) with the min, max and mean of
+rate1, rate2 and difference of every rack. A graph showing a day or a week
+reads a tier instead of hundreds of thousands of raw samples.
+
+Tiers are updated incrementally: each sample is folded into the open bucket
+of every tier with a handful of NumPy operations on (tiers x columns) arrays,
+and a bucket becomes a row in its tier's RingBuffer once a sample from a
+later bucket arrives. The open bucket is not visible to readers.
+
+NaN values (racks that are settling) are left out of min, max and mean; a
+bucket without any finite value stores NaN.
+"""
+
+import numpy as np
+
+from ring_buffer import RingBuffer, capacity_for
+
+TIER_WIDTHS = (10.0, 60.0, 600.0) # Bucket length of each tier, seconds
+TIER_CAPACITY = 4320 # Rows per tier: 12 h of 10 s, 3 days of 1 min, 30 days of 10 min
+TIER_BUDGET = 16 * 1024 * 1024 # Bytes per tier; with many racks tiers keep fewer rows
+MIN_TIER_CAPACITY = 144 # A day of 10 min buckets
+QUANTITIES = ("rate1", "rate2", "difference")
+STATISTICS = ("min", "max", "mean")
+
+
+def tier_fields(racks):
+    """RingBuffer fields of a tier: bucket start time, then <quantity>_<statistic> per rack."""
+    return ["t"] + [(f"{quantity}_{statistic}", racks) for quantity in QUANTITIES for statistic in STATISTICS]
+
+
+class TieredHistory:
+    """
+    min/max/mean tiers of the samples appended to it. `buffers[i]` holds the
+    tier with bucket length `widths[i]`; sources() pairs them up for FlowGraph.
+    Each tier keeps `capacity` rows, by default TIER_CAPACITY or as many as
+    fit in TIER_BUDGET. Single writer (the sampling engine), like RingBuffer.
+    """
+
+    def __init__(self, racks=1, widths=TIER_WIDTHS, capacity=None):
+        self.racks = racks
+        self.widths = np.asarray(widths, dtype=float)
+        if capacity is None:
+            capacity = capacity_for(1 + len(QUANTITIES) * len(STATISTICS) * racks,
+                                    TIER_BUDGET, TIER_CAPACITY, MIN_TIER_CAPACITY)
+        self.buffers = [RingBuffer(tier_fields(racks), capacity) for _ in self.widths]
+
+        columns = len(QUANTITIES) * racks
+        tiers = len(self.widths)
+        self._bucket = np.full(tiers, np.nan) # Index of the open bucket of each tier
+        self._next_close = float("-inf") # Earliest time a sample lands outside an open bucket
+        self._min = np.full((tiers, columns), np.inf)
+        self._max = np.full((tiers, columns), -np.inf)
+        self._sum = np.zeros((tiers, columns))
+        self._count = np.zeros((tiers, columns))
+
+    def sources(self):
+        """(bucket seconds, buffer) of every tier, finest first."""
+        return list(zip(self.widths.tolist(), self.buffers))
+
+    def append(self, t, rate1, rate2, difference):
+        """Folds one sample (per-rack arrays) taken at time t into every tier."""
+        if t >= self._next_close:
+            buckets = np.floor(t / self.widths)
+            for tier in np.flatnonzero(buckets != self._bucket):
+                if self._bucket[tier] == self._bucket[tier]: # Not NaN: a bucket was open
+                    self._flush(tier)
+                self._bucket[tier] = buckets[tier]
+            self._next_close = float(np.min((self._bucket + 1) * self.widths))
+
+        values = np.concatenate((rate1, rate2, difference))
+        finite = values == values
+        self._min = np.fmin(self._min, values)
+        self._max = np.fmax(self._max, values)
+        self._sum += np.where(finite, values, 0.0)
+        self._count += finite
+
+    def _flush(self, tier):
+        count = self._count[tier]
+        empty = count == 0
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self._sum[tier] / count
+        low = np.where(empty, np.nan, self._min[tier])
+        high = np.where(empty, np.nan, self._max[tier])
+        row = [self._bucket[tier] * self.widths[tier]]
+        for i in range(len(QUANTITIES)):
+            columns = slice(i * self.racks, (i + 1) * self.racks)
+            row += [low[columns], high[columns], mean[columns]]
+        self.buffers[tier].append(*row)
+
+        self._min[tier] = np.inf
+        self._max[tier] = -np.inf
+        self._sum[tier] = 0.0
+        self._count[tier] = 0
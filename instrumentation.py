@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Low-overhead metrics for the monitor's hot paths.
+
+Components ask the registry for named timers, counters and gauges once, at
+construction, and then only touch those objects:
+
+    timer      stage durations in a LatencyHistogram (1% accuracy, fixed memory)
+    counter    monotonically increasing totals (pulses, dropped samples, ...)
+    gauge      a function evaluated only when metrics are exported
+
+With FLOW_MONITOR_METRICS=0 the registry hands out shared no-op timers and
+counters, so instrumented code costs one empty method call per use.
+
+Metrics are exported in the Prometheus text format: over HTTP
+(FLOW_MONITOR_METRICS_HTTP=host:port, path /metrics; a bare ":port" means
+127.0.0.1, like the control socket's TCP listener), as a snapshot file
+rewritten atomically (FLOW_MONITOR_METRICS_FILE, e.g. for node_exporter's
+textfile collector), or with the control socket's "metrics" command.
+
+Timers keep their start time on the object, so each timer must only be used
+from one thread at a time; every stage that is timed runs on a single thread.
+"""
+
+import os
+import threading
+import time
+
+from latency_histogram import LatencyHistogram
+
+PREFIX = "flow_monitor_"
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Timer:
+    """Context manager that records the duration of a `with` block."""
+
+    def __init__(self, histogram, description=""):
+        self.histogram = histogram
+        self.description = description
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.record(time.perf_counter() - self._start)
+
+    def record(self, seconds):
+        self.histogram.record(seconds)
+
+
+class Counter:
+    def __init__(self, description=""):
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def record(self, seconds):
+        pass
+
+
+class _NullCounter:
+    value = 0
+
+    def inc(self, amount=1):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+NULL_COUNTER = _NullCounter()
+
+
+class Registry:
+    """Named metrics of one process."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._timers = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def timer(self, name, description="", histogram=None):
+        """
+        Returns the timer for `name`, creating it if needed. An existing
+        histogram (e.g. one the engine keeps anyway) can be adopted.
+        """
+        if not self.enabled:
+            return NULL_TIMER
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None or histogram is not None:
+                timer = Timer(histogram or LatencyHistogram(), description)
+                self._timers[name] = timer
+            return timer
+
+    def counter(self, name, description=""):
+        if not self.enabled:
+            return NULL_COUNTER
+        with self._lock:
+            return self._counters.setdefault(name, Counter(description))
+
+    def gauge(self, name, function, description=""):
+        """Registers function() as the current value of `name`, replacing any earlier one."""
+        if self.enabled:
+            with self._lock:
+                self._gauges[name] = (function, description)
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        with self._lock:
+            timers = sorted(self._timers.items())
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+        lines = []
+        for name, counter in counters:
+            metric = f"{PREFIX}{name}_total"
+            lines += [f"# HELP {metric} {counter.description}", f"# TYPE {metric} counter",
+                      f"{metric} {counter.value}"]
+        for name, (function, description) in gauges:
+            metric = f"{PREFIX}{name}"
+            try:
+                value = float(function())
+            except Exception:
+                continue # A gauge that cannot be read right now is left out
+            lines += [f"# HELP {metric} {description}", f"# TYPE {metric} gauge", f"{metric} {value:.9g}"]
+        for name, timer in timers:
+            metric = f"{PREFIX}{name}_seconds"
+            histogram = timer.histogram
+            lines += [f"# HELP {metric} {timer.description}", f"# TYPE {metric} summary"]
+            lines += [f'{metric}{{quantile="{quantile}"}} {histogram.percentile(quantile * 100):.9g}'
+                      for quantile in QUANTILES]
+            lines += [f"{metric}_sum {histogram.total:.9g}", f"{metric}_count {histogram.count}",
+                      f"# TYPE {metric}_max gauge", f"{metric}_max {histogram.max:.9g}"]
+        return "\n".join(lines) + "\n"
+
+    def write_snapshot(self, path):
+        """Writes render() to `path` atomically."""
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            f.write(self.render())
+        os.replace(temporary, path)
+
+
+def serve_http(registry, address):
+    """
+    Serves registry.render() at http://address/metrics from a daemon thread.
+    Rack names, rates and shutoffs are exported, so ":port" stays on localhost.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer # Only needed when exporting
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # Scrapes are not worth a log line each
+
+    host, _, port = address.rpartition(":")
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def write_snapshots(registry, path, interval=10.0, stop=None):
+    """Rewrites the snapshot file every `interval` seconds from a daemon thread."""
+    stop = stop or threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            try:
+                registry.write_snapshot(path)
+            except OSError:
+                pass # Try again next time; a missing directory should not stop the monitor
+    threading.Thread(target=loop, name="metrics-snapshot", daemon=True).start()
+    return stop
+
+
+def start_exporters(registry):
+    """Starts whichever exporters the FLOW_MONITOR_METRICS_* environment variables ask for."""
+    address = os.environ.get("FLOW_MONITOR_METRICS_HTTP")
+    path = os.environ.get("FLOW_MONITOR_METRICS_FILE")
+    if address and registry.enabled:
+        serve_http(registry, address)
+    if path and registry.enabled:
+        write_snapshots(registry, path)
+
+
+METRICS = Registry(enabled=os.environ.get("FLOW_MONITOR_METRICS", "1") != "0")
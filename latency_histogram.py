@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-memory latency histograms.
+
+Values are counted in log-linear buckets, like an HDR histogram: exact below
+256 units, then 128 buckets per power of two, so every recorded value is
+known to within 1% however large it is. Recording is a few integer
+operations and one array increment, cheap enough for the sampling thread.
+"""
+
+import numpy as np
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+
+def bucket_index(value):
+    """Bucket of a non-negative integer value."""
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_bounds(index):
+    """Lowest and highest integer value counted in a bucket."""
+    if index < 2 * SUB_BUCKETS:
+        return index, index
+    shift = index // SUB_BUCKETS - 1
+    low = (index - shift * SUB_BUCKETS) << shift
+    return low, low + (1 << shift) - 1
+
+
+class LatencyHistogram:
+    """
+    Histogram of durations in seconds, stored as integer multiples of
+    `resolution` (1 us by default) up to `highest` seconds; larger values are
+    clamped into the top bucket but still counted in max.
+    """
+
+    def __init__(self, highest=60.0, resolution=1e-6):
+        self.resolution = resolution
+        self.highest = int(highest / resolution)
+        self.counts = np.zeros(bucket_index(self.highest) + 1, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        value = int(seconds / self.resolution) if seconds > 0 else 0
+        self.counts[bucket_index(min(value, self.highest))] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def reset(self):
+        self.counts[:] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percent):
+        """Upper bound of the bucket holding the given percentile, in seconds."""
+        if not self.count:
+            return 0.0
+        rank = max(1, int(np.ceil(percent / 100.0 * self.count)))
+        index = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(bucket_bounds(index)[1] * self.resolution, self.max)
+
+    def summary(self):
+        """Count, mean, p50/p99/p99.9 and max, in milliseconds."""
+        return {
+            "count": self.count,
+            "mean_ms": self.mean() * 1000,
+            "p50_ms": self.percentile(50) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "p999_ms": self.percentile(99.9) * 1000,
+            "max_ms": self.max * 1000,
+        }
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Leak detection rules used by the flow monitor.
+
+A detector is fed the flow imbalance of every rack (rate1 - rate2, gal/s)
+once per sample and answers which racks should have their solenoid shut off.
+The sign is kept so that noise can cancel out in the streaming rules; a leak
+in either direction counts. All racks are
+evaluated together with NumPy, so the cost per sample barely grows with the
+number of racks.
+
+Every detector has the same interface: update(t, difference) -> trip array,
+reset(rack=None), and per-rack `tolerance` (accepted difference, gal/s) and
+`duration_threshold` (seconds) arrays that the monitor can change while
+running. The streaming detectors derive their defaults from those two
+settings, so a rack keeps its configuration when switched between rules:
+
+    threshold   difference above tolerance, held for duration_threshold
+    cusum       excess volume above an allowance accumulates; trips on enough evidence
+    ewma        exponentially smoothed imbalance above tolerance
+    volume      net imbalance volume over a sliding window above a limit
+
+All of them are O(1) per sample.
+"""
+
+from collections import deque
+
+import numpy as np
+
+
+def _per_rack(value, racks):
+    return np.array(np.broadcast_to(np.asarray(value, dtype=float), (racks,)))
+
+
+def _option(value, default, racks):
+    """An explicit per-rack option, or the default derived from the current settings."""
+    return default if value is None else _per_rack(value, racks)
+
+
+class ThresholdDetector:
+    """
+    The original monitor rule: trips once the difference between the two
+    sensors of a rack has stayed above its tolerance for duration_threshold
+    seconds.
+
+    tolerance and duration_threshold may be scalars (shared by all racks) or
+    per-rack sequences.
+    """
+
+    def __init__(self, tolerance=0, duration_threshold=10, racks=1):
+        self.tolerance = _per_rack(tolerance, racks)
+        self.duration_threshold = _per_rack(duration_threshold, racks)
+        # NaN means the rack is currently within tolerance
+        self.start_time = np.full(racks, np.nan)
+
+    def update(self, t, difference):
+        """
+        Feeds one sample of per-rack imbalances taken at monotonic time t (seconds).
+        Returns a boolean array of the racks whose shutoff should fire.
+        """
+        over = np.abs(difference) > np.abs(self.tolerance)
+        start_time = np.where(over, np.fmin(self.start_time, t), np.nan)
+        trip = over & (t - start_time >= self.duration_threshold)
+        start_time[trip] = np.nan
+        self.start_time = start_time
+        return trip
+
+    def reset(self, rack=None):
+        if rack is None:
+            self.start_time[:] = np.nan
+        else:
+            self.start_time[rack] = np.nan
+
+
+class _StreamingDetector:
+    """Shared state of the detectors that integrate over time."""
+
+    def __init__(self, tolerance=0, duration_threshold=10, racks=1):
+        self.racks = racks
+        self.tolerance = _per_rack(tolerance, racks)
+        self.duration_threshold = _per_rack(duration_threshold, racks)
+        self.last_time = None
+
+    def _step(self, t, difference):
+        """Returns the seconds since the previous sample and the imbalance with NaN as 0."""
+        dt = 0.0 if self.last_time is None else max(t - self.last_time, 0.0)
+        self.last_time = t
+        return dt, np.nan_to_num(np.asarray(difference, dtype=float))
+
+
+class CusumDetector(_StreamingDetector):
+    """
+    Two-sided CUSUM on the flow imbalance. Imbalance beyond `allowance`
+    (gal/s) in one direction adds its excess volume to that direction's
+    evidence, anything less drains it, never below zero; the rack trips once
+    either evidence reaches `threshold` gallons.
+
+    Noise cancels out instead of restarting a timer, and a leak of any size
+    above the allowance is caught eventually, faster the bigger it is.
+    Defaults: allowance = tolerance / 4 and threshold = 3/4 * tolerance *
+    duration_threshold, so a step of exactly `tolerance` trips after
+    duration_threshold seconds, like the threshold rule.
+
+    A threshold of zero (the default for a tolerance of 0) would trip on the
+    first sample with any imbalance; such a rack instead trips once its
+    evidence has stayed above zero for duration_threshold seconds, which is
+    what the threshold rule does with a tolerance of 0.
+    """
+
+    def __init__(self, tolerance=0, duration_threshold=10, racks=1, allowance=None, threshold=None):
+        super().__init__(tolerance, duration_threshold, racks)
+        self.allowance = allowance
+        self.threshold = threshold
+        self.evidence = np.zeros((2, racks)) # Sensor 1 high, sensor 2 high
+        self.rising_since = np.full((2, racks), np.nan) # Start of the current run of nonzero evidence
+
+    def update(self, t, difference):
+        dt, difference = self._step(t, difference)
+        tolerance = np.abs(self.tolerance)
+        allowance = _option(self.allowance, tolerance / 4, self.racks)
+        threshold = _option(self.threshold, 0.75 * tolerance * self.duration_threshold, self.racks)
+
+        excess = np.stack([difference, -difference]) - allowance
+        self.evidence = np.maximum(self.evidence + excess * dt, 0.0)
+        # The first sample has no elapsed time yet, so a positive excess starts the run
+        rising = (self.evidence > 0) | ((excess > 0) & (dt == 0))
+        self.rising_since = np.where(rising, np.fmin(self.rising_since, t), np.nan)
+        held = np.nanmax(np.where(rising, t - self.rising_since, -np.inf), axis=0)
+        evidence = self.evidence.max(axis=0)
+        trip = np.where(threshold > 0, evidence >= threshold, held >= self.duration_threshold)
+        self.reset(trip)
+        return trip
+
+    def reset(self, rack=None):
+        if rack is None:
+            self.evidence[:] = 0.0
+            self.rising_since[:] = np.nan
+        else:
+            self.evidence[:, rack] = 0.0
+            self.rising_since[:, rack] = np.nan
+
+
+class EwmaDetector(_StreamingDetector):
+    """
+    Exponentially weighted moving average of the imbalance, tripping when
+    the average is further than the tolerance from zero. `time_constant` (seconds, default
+    duration_threshold / 3) sets how much noise is smoothed away; the weight
+    of each sample follows the real time between samples.
+    """
+
+    def __init__(self, tolerance=0, duration_threshold=10, racks=1, time_constant=None):
+        super().__init__(tolerance, duration_threshold, racks)
+        self.time_constant = time_constant
+        self.average = np.zeros(racks)
+
+    def update(self, t, difference):
+        dt, difference = self._step(t, difference)
+        time_constant = _option(self.time_constant, self.duration_threshold / 3, self.racks)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            weight = -np.expm1(-dt / time_constant)
+        weight = np.where(time_constant > 0, weight, 1.0)
+
+        self.average += weight * (difference - self.average)
+        trip = np.abs(self.average) > np.abs(self.tolerance)
+        self.average[trip] = 0.0
+        return trip
+
+    def reset(self, rack=None):
+        if rack is None:
+            self.average[:] = 0.0
+        else:
+            self.average[rack] = 0.0
+
+
+class VolumeDetector(_StreamingDetector):
+    """
+    Integrates the net imbalance volume (imbalance times elapsed time) over
+    the last `window` seconds (default 12 * duration_threshold) and trips once
+    it is more than `volume` gallons either way (default 3 * tolerance *
+    duration_threshold). Because the window is longer than the delay this
+    catches slow leaks below the tolerance, down to volume / window (a
+    quarter of the tolerance), while counting noise sums to roughly zero.
+    The limit is wide enough that 20% flow jitter on a healthy rack stays
+    below it (benchmarks/detector_latency.py); a step of exactly `tolerance`
+    trips after about 3 * duration_threshold.
+
+    Every rack has its own window (an explicit `window` may be per rack).
+    The detector keeps a queue of sample times with the cumulative net
+    volume before each sample, and one start pointer per distinct window
+    length, so each sample costs one push, (amortized) one pop and one
+    subtraction per distinct window: racks sharing a delay share a pointer.
+    """
+
+    def __init__(self, tolerance=0, duration_threshold=10, racks=1, window=None, volume=None):
+        super().__init__(tolerance, duration_threshold, racks)
+        self.window = window
+        self.volume = volume
+        self.total = np.zeros(racks) # Net volume inside each rack's window
+        self._net = np.zeros(racks) # Net volume since the start
+        self._times = deque()
+        self._before = deque() # _net before each queued sample
+        self._first = 0 # Sample number of _times[0]
+        self._starts = {} # Window length -> sample number of its oldest sample
+
+    def update(self, t, difference):
+        dt, difference = self._step(t, difference)
+        volume = _option(self.volume, 3 * np.abs(self.tolerance) * self.duration_threshold, self.racks)
+        window = _option(self.window, 12 * self.duration_threshold, self.racks)
+
+        self._times.append(t)
+        self._before.append(self._net.copy())
+        self._net += difference * dt
+
+        end = self._first + len(self._times)
+        starts = {}
+        for length in np.unique(window).tolist():
+            start = max(self._starts.get(length, self._first), self._first)
+            # The newest sample always counts, even for a window of 0
+            while start < end - 1 and self._times[start - self._first] <= t - length:
+                start += 1
+            starts[length] = start
+            racks = window == length
+            self.total[racks] = self._net[racks] - self._before[start - self._first][racks]
+        self._starts = starts
+        oldest = min(starts.values())
+        while self._first < oldest:
+            self._times.popleft()
+            self._before.popleft()
+            self._first += 1
+
+        trip = np.abs(self.total) > volume
+        if trip.any():
+            self.reset(trip)
+        return trip
+
+    def reset(self, rack=None):
+        if rack is None:
+            self._times.clear()
+            self._before.clear()
+            self._first = 0
+            self._starts = {}
+            self._net[:] = 0.0
+            self.total[:] = 0.0
+            return
+        # Forget the rack's volume: every queued sample starts from where it is now
+        for before in self._before:
+            before[rack] = self._net[rack]
+        self.total[rack] = 0.0
+
+
+class MixedDetector:
+    """
+    Runs a different rule per rack. Every rule is evaluated for all racks
+    (they are vectorized, so this is cheap) and each rack takes the trips of
+    its own rule. The tolerance and duration arrays are shared with the rules,
+    so changing a rack's settings reaches whichever rule it uses.
+    """
+
+    def __init__(self, kinds, tolerance=0, duration_threshold=10):
+        racks = len(kinds)
+        self.kinds = list(kinds)
+        self.tolerance = _per_rack(tolerance, racks)
+        self.duration_threshold = _per_rack(duration_threshold, racks)
+        self.detectors = {}
+        for kind in dict.fromkeys(self.kinds):
+            detector = DETECTORS[kind](self.tolerance, self.duration_threshold, racks)
+            detector.tolerance = self.tolerance
+            detector.duration_threshold = self.duration_threshold
+            self.detectors[kind] = detector
+        self._masks = {kind: np.array([k == kind for k in self.kinds]) for kind in self.detectors}
+
+    def update(self, t, difference):
+        trip = np.zeros(len(self.kinds), dtype=bool)
+        for kind, detector in self.detectors.items():
+            trip |= detector.update(t, difference) & self._masks[kind]
+        return trip
+
+    def reset(self, rack=None):
+        for detector in self.detectors.values():
+            detector.reset(rack)
+
+
+DETECTORS = {
+    "threshold": ThresholdDetector,
+    "cusum": CusumDetector,
+    "ewma": EwmaDetector,
+    "volume": VolumeDetector,
+}
+
+
+def make_detector(kinds, tolerance=0, duration_threshold=10, **options):
+    """
+    Builds the detector for a rack table. `kinds` holds one rule name per
+    rack (see DETECTORS); options are passed on when all racks use one rule.
+    """
+    kinds = list(kinds)
+    unknown = sorted(set(kinds) - set(DETECTORS))
+    if unknown:
+        raise ValueError(f"Unknown leak detector: {', '.join(unknown)}")
+    if len(set(kinds)) == 1:
+        return DETECTORS[kinds[0]](tolerance, duration_threshold, racks=len(kinds), **options)
+    return MixedDetector(kinds, tolerance, duration_threshold)
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""
+Local control socket for the flow monitor.
+
+The headless daemon (flow_daemon.py) owns the GPIO, detection and shutoff.
+Clients such as the Tk window talk to it over a Unix domain socket using one
+JSON object per line:
+
+    request:  {"cmd": "activate", "rack": 0}
+    reply:    {"ok": true, ...}  or  {"ok": false, "error": "..."}
+
+Commands: status, activate, deactivate, configure, check_password, history,
+latency, metrics, subscribe. "metrics" returns the Prometheus text of instrumentation.METRICS.
+"history" reads the raw samples, or with "tier": N the Nth downsampled tier
+listed by "status" (min/max/mean fields, see history_tiers.py), at most
+MAX_HISTORY_POINTS per request.
+
+The socket is bound inside a private 0700 directory, made 0660 and only then
+renamed into place, so only the daemon's user and group can ever connect. The daemon also checks the peer's
+credentials: activate, deactivate and configure are refused unless the peer
+runs as root or as the daemon's user or group. configure additionally needs
+the admin password ("password"; "new_password" changes it), which starts as
+FLOW_MONITOR_ADMIN_PASSWORD.
+
+"subscribe" turns the connection into a stream: a "hello" message with the
+current status of every rack, then one "sample" message per engine sample and
+an "event" message whenever a rack trips, is switched or is reconfigured.
+Each subscriber has a bounded queue. Samples are dropped when it is full;
+if even an event no longer fits, the subscriber is disconnected so it can
+reconnect and start again from a fresh "hello". A slow subscriber therefore
+never holds up the monitor.
+
+The monitor can also listen on TCP (FLOW_MONITOR_LISTEN=host:port, host
+defaulting to 127.0.0.1) for the fleet aggregator. That listener has no
+authentication, so it only answers status and subscribe; nothing on it can
+switch a valve or change a setting.
+"""
+
+import hmac
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from instrumentation import METRICS
+
+SOCKET_PATH = os.environ.get("FLOW_MONITOR_SOCKET", "/tmp/flow_monitor.sock")
+LISTEN_ADDRESS = os.environ.get("FLOW_MONITOR_LISTEN") # "host:port", or unset for no TCP listener
+TCP_COMMANDS = {"status", "subscribe"} # All the unauthenticated TCP listener answers
+PRIVILEGED_COMMANDS = {"activate", "deactivate", "configure", "check_password"}
+ADMIN_PASSWORD = os.environ.get("FLOW_MONITOR_ADMIN_PASSWORD", "admin123") # The Tk window's default
+MAX_HISTORY_POINTS = 10000 # Rows one "history" reply may carry
+SUBSCRIBER_QUEUE = 256 # Messages a subscriber may fall behind by
+
+
+def parse_address(address):
+    """Splits "host:port" into (host, port); a bare ":port" means 127.0.0.1."""
+    host, _, port = address.rpartition(":")
+    return host or "127.0.0.1", int(port)
+
+
+def _finite(values):
+    # NaN is not valid JSON; settling racks are sent as null
+    return [None if value != value else float(value) for value in values]
+
+
+def sample_message(t, rate1, rate2, difference):
+    """The "sample" stream message for one engine sample taken at wall-clock time t."""
+    return {"type": "sample", "t": t, "rate1": _finite(rate1), "rate2": _finite(rate2),
+            "difference": _finite(difference)}
+
+
+def event_message(t, rack, event, state):
+    """The "event" stream message; state is the rack's summary() entry."""
+    return {"type": "event", "t": t, "rack": rack, "event": event, "state": state}
+
+
+class MonitorError(Exception):
+    """Raised by the client when the service rejects a request."""
+
+
+# --- Server side ---
+
+def _peer_trusted(connection):
+    """True when the process on the other end of a Unix socket runs as root or as our user or group."""
+    try:
+        credentials = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    except (AttributeError, OSError):
+        return False # No SO_PEERCRED (not Linux)
+    _, uid, gid = struct.unpack("3i", credentials)
+    return uid in (0, os.geteuid()) or gid == os.getegid()
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        control = self.server.control
+        trusted = self.server.commands is None and _peer_trusted(self.connection)
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if self.server.commands is not None and request.get("cmd") not in self.server.commands:
+                    raise ValueError(f"{request.get('cmd')} is not allowed on this connection")
+                if request.get("cmd") in PRIVILEGED_COMMANDS and not trusted:
+                    raise PermissionError(f"{request.get('cmd')} is not allowed for this user")
+                if request.get("cmd") == "subscribe":
+                    control.stream(self.wfile)
+                    return
+                reply = control.handle(request)
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    commands = None # Every command
+
+
+class _TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    commands = TCP_COMMANDS
+
+
+_dropped_samples = METRICS.counter("dropped_samples", "Samples not sent to a subscriber whose queue was full")
+
+
+class _Subscription:
+    """Bounded queue of encoded stream messages for one subscriber."""
+
+    def __init__(self, size=SUBSCRIBER_QUEUE):
+        self.queue = queue.Queue(size)
+        self.dropped = 0
+        self.overflowed = False
+
+    def offer(self, line, droppable):
+        if self.overflowed:
+            return
+        try:
+            self.queue.put_nowait(line)
+        except queue.Full:
+            if droppable:
+                self.dropped += 1
+                _dropped_samples.inc()
+            else:
+                self.overflowed = True # The sender notices and disconnects
+
+
+class ControlServer:
+    """
+    Serves a RackMonitor on a Unix socket, and status and subscribe only on
+    TCP when an `address` ("host:port") is given. Each client connection gets its own
+    thread, so a slow client never holds up the sampling engine.
+    """
+
+    def __init__(self, monitor, path=SOCKET_PATH, address=None, admin_password=ADMIN_PASSWORD):
+        self.monitor = monitor
+        self.path = path
+        self.address = address
+        self.admin_password = admin_password
+        self._servers = []
+        self._subscriptions = []
+        self._subscriptions_lock = threading.Lock()
+
+    def start(self):
+        # Bound where nobody else can reach it, then renamed over any stale socket
+        # from a previous run. The process umask is left alone: other threads
+        # are already creating files.
+        staging = tempfile.mkdtemp(prefix=".flow_monitor-", dir=os.path.dirname(os.path.abspath(self.path)))
+        staged = os.path.join(staging, "socket")
+        try:
+            unix_server = _UnixServer(staged, _ControlHandler)
+            os.chmod(staged, 0o660)
+            os.rename(staged, self.path)
+        finally:
+            if os.path.lexists(staged):
+                os.unlink(staged)
+            os.rmdir(staging)
+        self._servers = [unix_server]
+        if self.address:
+            self._servers.append(_TcpServer(parse_address(self.address), _ControlHandler))
+
+        self.monitor.engine.listeners.append(self._publish_sample)
+        self.monitor.event_listeners.append(self._publish_event)
+        for server in self._servers:
+            server.control = self
+            threading.Thread(target=server.serve_forever, name="control-server", daemon=True).start()
+
+    def stop(self):
+        if not self._servers:
+            return
+        self.monitor.engine.listeners.remove(self._publish_sample)
+        self.monitor.event_listeners.remove(self._publish_event)
+        with self._subscriptions_lock:
+            for subscription in self._subscriptions:
+                subscription.offer(None, droppable=False)
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    # --- Streaming ---
+
+    def _broadcast(self, message, droppable):
+        # Encoded once, however many subscribers there are
+        with self._subscriptions_lock:
+            if not self._subscriptions:
+                return
+            line = json.dumps(message).encode() + b"\n"
+            for subscription in self._subscriptions:
+                subscription.offer(line, droppable)
+
+    # Engine listener: runs on the sampling thread
+    def _publish_sample(self, sample):
+        difference = np.where(sample.t < self.monitor.engine.settle_until, np.nan, sample.difference)
+        self._broadcast(sample_message(time.time(), sample.rate1, sample.rate2, difference), droppable=True)
+
+    def _publish_event(self, rack, event):
+        state = self.monitor.summary()[rack]
+        self._broadcast(event_message(time.time(), rack, event, state), droppable=False)
+
+    def stream(self, wfile):
+        """Sends the subscription stream to one client until it disconnects or falls too far behind."""
+        subscription = _Subscription()
+        with self._subscriptions_lock:
+            # Registered before the hello is built, so no event can fall in between
+            self._subscriptions.append(subscription)
+        try:
+            hello = {"type": "hello", "ok": True, "host": socket.gethostname(),
+                     "racks": self.monitor.summary(), "t": time.time()}
+            wfile.write(json.dumps(hello).encode() + b"\n")
+            while not subscription.overflowed:
+                try:
+                    line = subscription.queue.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+                if line is None:
+                    return
+                wfile.write(line)
+        except OSError:
+            pass # Subscriber went away
+        finally:
+            with self._subscriptions_lock:
+                self._subscriptions.remove(subscription)
+
+    def _rack(self, request):
+        rack = int(request["rack"])
+        if not 0 <= rack < len(self.monitor.racks):
+            raise ValueError(f"No rack {rack}")
+        return rack
+
+    def _check_password(self, request):
+        if not hmac.compare_digest(str(request.get("password", "")).encode(), self.admin_password.encode()):
+            raise PermissionError("Incorrect admin password")
+
+    def handle(self, request):
+        """
+        Runs one request and returns the reply dict. Who may send which
+        command is checked by the connection handler.
+        """
+        cmd = request.get("cmd")
+        monitor = self.monitor
+
+        if cmd == "status":
+            tiers = monitor.engine.tiers
+            return {"ok": True, "racks": monitor.summary(),
+                    "samples": monitor.engine.history.total_appended,
+                    "tiers": [{"seconds": width, "samples": buffer.total_appended}
+                              for width, buffer in tiers.sources()]}
+        if cmd == "activate":
+            monitor.activate(self._rack(request))
+            return {"ok": True}
+        if cmd == "deactivate":
+            monitor.deactivate(self._rack(request))
+            return {"ok": True}
+        if cmd == "check_password":
+            self._check_password(request)
+            return {"ok": True}
+        if cmd == "configure":
+            self._check_password(request)
+            if request.get("new_password"):
+                self.admin_password = str(request["new_password"])
+            monitor.configure(self._rack(request), name=request.get("name"),
+                              tolerance=request.get("tolerance"),
+                              duration_threshold=request.get("duration_threshold"))
+            return {"ok": True}
+        if cmd == "history":
+            # "tier": 0 (default) is every sample, 1.. the downsampled tiers from "status"
+            tier = int(request.get("tier") or 0)
+            if not 0 <= tier <= len(monitor.engine.tiers.buffers):
+                raise ValueError(f"No history tier {tier}")
+            history = monitor.engine.tiers.buffers[tier - 1] if tier else monitor.engine.history
+            points = min(int(request.get("points") or MAX_HISTORY_POINTS), MAX_HISTORY_POINTS)
+            fields = request.get("fields", ["t", "difference"])
+            views = history.window(points, fields, column=self._rack(request))
+            return {"ok": True, "samples": history.total_appended,
+                    "fields": {name: _finite(view) for name, view in zip(fields, views)}}
+        if cmd == "latency":
+            return {"ok": True, "latency": monitor.watchdog.report()}
+        if cmd == "metrics":
+            return {"ok": True, "metrics": METRICS.render()}
+        raise ValueError(f"Unknown command: {cmd}")
+
+
+# --- Client side ---
+
+class RemoteHistory:
+    """
+    Stands in for the engine's RingBuffer on the client side, so FlowGraph
+    can draw from a remote monitor. total_appended is updated by
+    MonitorClient.refresh(); window() fetches the data on demand. With
+    `tier`, it stands in for one of the engine's downsampled tiers.
+    """
+
+    def __init__(self, client, tier=0):
+        self.client = client
+        self.tier = tier
+        self.total_appended = 0
+
+    def window(self, n=None, fields=None, column=0):
+        fields = list(fields or ("t", "difference"))
+        reply = self.client.request("history", rack=column, points=n, fields=fields, tier=self.tier)
+        return tuple(np.array(reply["fields"][name], dtype=float) for name in fields)
+
+
+class MonitorClient:
+    """
+    Connects to a running monitor service. Exposes the same per-rack
+    attributes and methods the Tk window uses on a local RackMonitor.
+    """
+
+    def __init__(self, path=SOCKET_PATH, timeout=2.0):
+        self.path = path
+        self.timeout = timeout
+        self.names = []
+        self.status = []
+        self.last_shutoff_date = []
+        self.racks = []
+        self.history = RemoteHistory(self)
+        self.tiers = [] # (bucket seconds, RemoteHistory), like TieredHistory.sources()
+        self._sock = None
+        self._file = None
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def close(self):
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = None
+            self._file = None
+
+    def request(self, cmd, **args):
+        """Sends one command and returns the reply. Reconnects if needed."""
+        message = json.dumps(dict(args, cmd=cmd)).encode() + b"\n"
+        with self._lock:
+            try:
+                if self._sock is None:
+                    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self._sock.settimeout(self.timeout)
+                    self._sock.connect(self.path)
+                    self._file = self._sock.makefile("rb")
+                self._sock.sendall(message)
+                line = self._file.readline()
+                if not line:
+                    raise ConnectionError("Monitor service closed the connection")
+            except OSError:
+                self.close()
+                raise
+        reply = json.loads(line)
+        if not reply.get("ok"):
+            raise MonitorError(reply.get("error", "Request failed"))
+        return reply
+
+    def refresh(self):
+        """Pulls the current state of every rack from the service."""
+        reply = self.request("status")
+        self.racks = reply["racks"]
+        self.names = [rack["name"] for rack in self.racks]
+        self.status = [rack["status"] for rack in self.racks]
+        self.last_shutoff_date = [rack["last_shutoff_date"] for rack in self.racks]
+        self.history.total_appended = reply["samples"]
+        if not self.tiers:
+            self.tiers = [(tier["seconds"], RemoteHistory(self, index + 1))
+                          for index, tier in enumerate(reply.get("tiers", []))]
+        for (_, history), tier in zip(self.tiers, reply.get("tiers", [])):
+            history.total_appended = tier["samples"]
+
+    def tolerance(self, rack):
+        return self.racks[rack]["tolerance"]
+
+    def duration_threshold(self, rack):
+        return self.racks[rack]["duration_threshold"]
+
+    def activate(self, rack):
+        self.request("activate", rack=rack)
+        self.refresh()
+
+    def deactivate(self, rack):
+        self.request("deactivate", rack=rack)
+        self.refresh()
+
+    def check_password(self, password):
+        """True when the service accepts `password` as the admin password."""
+        try:
+            self.request("check_password", password=password)
+        except MonitorError:
+            return False
+        return True
+
+    def configure(self, rack, name=None, tolerance=None, duration_threshold=None, password=None,
+                  new_password=None):
+        self.request("configure", rack=rack, name=name, tolerance=tolerance,
+                     duration_threshold=duration_threshold, password=password, new_password=new_password)
+        self.refresh()
+
+
+def connect(path=SOCKET_PATH):
+    """Returns a MonitorClient if a service is listening on `path`, else None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        return MonitorClient(path)
+    except OSError:
+        return None
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+"""
+Rack table and the multi-rack monitor.
+
+A rack is one pair of flow sensors (supply and return) plus the solenoid that
+shuts its cooling off. One RackMonitor runs the pulse counting, leak
+detection and shutoff for every rack in the table from a single process and a
+single sampling thread.
+"""
+
+import datetime
+import json
+import os
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from engine_watchdog import Watchdog
+from history_store import HistoryStore
+from leak_detector import make_detector
+from pulse_counter import PulseCounter, CounterReader, TimestampedCounter, PeriodRateReader
+from sampling_engine import SamplingEngine, PULSES_PER_GALLON
+from telemetry import TelemetryWriter, LEAK, MANUAL, WATCHDOG
+
+SETTLE_TIME = 10 # Seconds of history skipped after a rack is switched on
+
+Rack = namedtuple(
+    "Rack",
+    ["name", "sensor1_pin", "sensor2_pin", "solenoid_pin",
+     "tolerance", "duration_threshold", "pulses_per_gallon", "detector"],
+    defaults=(0, 10, PULSES_PER_GALLON, "threshold"),
+)
+
+# The original single-rack wiring
+DEFAULT_RACKS = [Rack("Flow Monitor 1", 17, 18, 27)]
+DEFAULT_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "racks.json")
+# Where sample history is persisted; FLOW_MONITOR_HISTORY overrides it
+DEFAULT_HISTORY_DIR = os.environ.get(
+    "FLOW_MONITOR_HISTORY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "flow_history"))
+# How rates are measured: "count" (pulses per sample window) or "period" (from edge timestamps)
+RATE_ESTIMATOR = os.environ.get("FLOW_MONITOR_RATE_ESTIMATOR", "count")
+
+
+def load_racks(path):
+    """
+    Reads the rack table from a JSON file. The file holds either a list of
+    racks or an object with a "racks" list; each rack uses the Rack field names.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    entries = config["racks"] if isinstance(config, dict) else config
+    racks = [Rack(**entry) for entry in entries]
+    if not racks:
+        raise ValueError(f"No racks defined in {path}")
+
+    pins = [pin for rack in racks for pin in (rack.sensor1_pin, rack.sensor2_pin, rack.solenoid_pin)]
+    duplicates = sorted({pin for pin in pins if pins.count(pin) > 1})
+    if duplicates:
+        raise ValueError(f"GPIO pins used more than once in {path}: {duplicates}")
+    return racks
+
+
+def find_racks(path=None):
+    """
+    Returns the rack table from `path`, or from racks.json next to this module.
+    Falls back to DEFAULT_RACKS when no config file exists.
+    """
+    path = path or DEFAULT_CONFIG
+    return load_racks(path) if os.path.exists(path) else DEFAULT_RACKS
+
+
+def now_string():
+    return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+class RackMonitor:
+    """
+    Owns the counters, detector, sampling engine and per-rack control state
+    for a table of racks. `backend` is a hardware.Backend (the real board or
+    the simulator). With `history_dir`, every sample is also persisted to a
+    HistoryStore there; with `telemetry_path`, samples, rack states and
+    shutoffs are published there for local readers (see telemetry.py).
+
+    Functions in `event_listeners` are called as listener(rack, event) when a
+    rack trips ("leak"), is shut off by the watchdog ("watchdog"), is shut off
+    or switched on by hand ("shutoff", "activate") or reconfigured ("configure"). They may run on the sampling
+    thread and must return quickly.
+
+    A Watchdog closes every solenoid if the sampling engine stalls for more
+    than `watchdog_timeout` seconds (default: two sample intervals).
+
+    rate_estimator "period" timestamps every pulse and measures rates from
+    the pulse periods, which is much finer than one pulse per window at low
+    flow.
+    """
+
+    def __init__(self, racks, backend, interval=1.0, history_capacity=None,
+                 history_dir=None, telemetry_path=None, rate_estimator=RATE_ESTIMATOR,
+                 watchdog_timeout=None):
+        self.racks = list(racks)
+        self.backend = backend
+        count = len(self.racks)
+
+        self.names = [rack.name for rack in self.racks]
+        self.status = ["Inactive"] * count
+        self.last_shutoff_date = ["No shutoff recorded"] * count
+
+        # Two counters per rack, in the order the engine expects
+        if rate_estimator not in ("count", "period"):
+            raise ValueError(f"Unknown rate estimator: {rate_estimator}")
+        counter = TimestampedCounter if rate_estimator == "period" else PulseCounter
+        self.counters = [counter() for _ in range(2 * count)]
+        self.detector = make_detector(
+            [rack.detector for rack in self.racks],
+            [rack.tolerance for rack in self.racks],
+            [rack.duration_threshold for rack in self.racks],
+        )
+        self.engine = SamplingEngine(
+            CounterReader(self.counters).read, self.detector, self._shutoff_detected,
+            interval=interval,
+            pulses_per_gallon=[rack.pulses_per_gallon for rack in self.racks],
+            history_capacity=history_capacity,
+            racks=count,
+            read_rates=PeriodRateReader(self.counters).read if rate_estimator == "period" else None,
+        )
+
+        self.event_listeners = []
+        self.watchdog = Watchdog(self.engine, self._fail_safe, timeout=watchdog_timeout)
+
+        self.store = None
+        if history_dir is not None:
+            self.store = HistoryStore(history_dir, [rack.pulses_per_gallon for rack in self.racks])
+            self.engine.listeners.append(self.store.record)
+
+        self.telemetry = None
+        if telemetry_path is not None:
+            self.telemetry = TelemetryWriter(telemetry_path, self.names)
+            self.engine.listeners.append(self._publish)
+
+    def setup_gpio(self):
+        """Configures every rack's pins and attaches the pulse counters."""
+        backend = self.backend
+        for rack in self.racks:
+            backend.setup_output(rack.solenoid_pin)
+        pins = [pin for rack in self.racks for pin in (rack.sensor1_pin, rack.sensor2_pin)]
+        if backend.batched_edges:
+            # One reader for every sensor, delivering edges in batches
+            backend.setup_edge_inputs({pin: counter.add_edges for pin, counter in zip(pins, self.counters)})
+        else:
+            for pin, counter in zip(pins, self.counters):
+                backend.setup_pulse_input(pin, counter.pulse)
+
+    def start(self):
+        self.engine.start()
+        self.watchdog.start()
+
+    def stop(self):
+        self.watchdog.stop()
+        self.engine.stop()
+        self.close_all()
+        if self.store is not None:
+            self.store.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+
+    # Runs on the sampling thread, so only GPIO and plain state are touched here
+    def _shutoff_detected(self, rack, sample):
+        self.backend.output(self.racks[rack].solenoid_pin, self.backend.HIGH)
+        self.last_shutoff_date[rack] = now_string()
+        self.status[rack] = "Inactive"
+        if self.store is not None:
+            self.store.flush_soon() # The minutes before the shutoff go to disk with this sample
+        if self.telemetry is not None:
+            self.telemetry.shutoff(rack, LEAK)
+        self._event(rack, "leak")
+
+    # Runs on the watchdog thread when the engine has stalled: close everything first
+    def _fail_safe(self):
+        self.close_all()
+        if self.store is not None:
+            self.store.flush(wait=False) # The engine has stalled, so no sample will follow
+        for rack, status in enumerate(self.status):
+            if status != "Active":
+                continue
+            self.status[rack] = "Inactive"
+            self.last_shutoff_date[rack] = now_string()
+            if self.telemetry is not None:
+                self.telemetry.shutoff(rack, WATCHDOG)
+            self._event(rack, "watchdog")
+
+    def _event(self, rack, event):
+        for listener in self.event_listeners:
+            listener(rack, event)
+
+    # Publishes what the graph shows: no difference while a rack is settling
+    def _publish(self, sample):
+        difference = np.where(sample.t < self.engine.settle_until, np.nan, sample.difference)
+        self.telemetry.publish(time.time(), sample.rate1, sample.rate2, difference)
+
+    # Open solenoid to send monitored cooling
+    def activate(self, rack):
+        self.backend.output(self.racks[rack].solenoid_pin, self.backend.LOW)
+        self.status[rack] = "Active"
+        self.engine.settle_until[rack] = self.engine.clock() + SETTLE_TIME
+        self.detector.reset(rack) # Evidence from before the shutoff no longer counts
+        if self.telemetry is not None:
+            self.telemetry.set_status(rack, True)
+        self._event(rack, "activate")
+
+    # Close solenoid, no more monitored cooling
+    def deactivate(self, rack):
+        self.backend.output(self.racks[rack].solenoid_pin, self.backend.HIGH)
+        self.status[rack] = "Inactive"
+        self.last_shutoff_date[rack] = now_string()
+        if self.telemetry is not None:
+            self.telemetry.shutoff(rack, MANUAL)
+        self._event(rack, "shutoff")
+
+    def close_all(self):
+        for rack in self.racks:
+            self.backend.output(rack.solenoid_pin, self.backend.HIGH)
+
+    def tolerance(self, rack):
+        return float(self.detector.tolerance[rack])
+
+    def duration_threshold(self, rack):
+        return float(self.detector.duration_threshold[rack])
+
+    def configure(self, rack, name=None, tolerance=None, duration_threshold=None):
+        """Changes a rack's name and detection settings while running."""
+        if name is not None:
+            self.names[rack] = name
+            if self.telemetry is not None:
+                self.telemetry.set_name(rack, name)
+        if tolerance is not None:
+            self.detector.tolerance[rack] = float(tolerance)
+        if duration_threshold is not None:
+            self.detector.duration_threshold[rack] = float(duration_threshold)
+        self._event(rack, "configure")
+
+    def summary(self):
+        """Returns one dict per rack with its settings, state and newest rates."""
+        sample = self.engine.latest
+        rows = []
+        for i in range(len(self.racks)):
+            rows.append({
+                "name": self.names[i],
+                "status": self.status[i],
+                "last_shutoff_date": self.last_shutoff_date[i],
+                "tolerance": self.tolerance(i),
+                "duration_threshold": self.duration_threshold(i),
+                "rate1": None if sample is None else float(sample.rate1[i]),
+                "rate2": None if sample is None else float(sample.rate2[i]),
+                "difference": None if sample is None else float(sample.difference[i]),
+            })
+        return rows
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-capacity history store for per-sample monitor data.
+
+Samples are rows of a NumPy array that is twice the capacity long, and every
+row is written to both halves. Any window of up to `capacity` samples is
+therefore one contiguous slice, so windows come back as views without copying
+and appends stay O(1).
+
+A field can be wider than one column (e.g. one column per rack), so a single
+append stores a whole sample for every rack at once.
+
+The buffer expects a single writer (the sampling engine). Readers can take
+views at any time; a view stays valid until the writer has wrapped around
+over the samples it covers, so copy it if you need to keep it.
+"""
+
+import numpy as np
+
+# Two days of one-per-second samples, about 2.8 MB per float64 column
+DEFAULT_CAPACITY = 2 * 24 * 3600
+MIN_CAPACITY = 1024
+
+
+def capacity_for(columns, budget, limit=DEFAULT_CAPACITY, minimum=MIN_CAPACITY, dtype=np.float64):
+    """
+    Rows of a (mirrored) RingBuffer with `columns` columns that fit in
+    `budget` bytes, clamped to minimum..limit. Wide buffers (many racks) get
+    fewer rows instead of growing with the column count.
+    """
+    rows = budget // (2 * columns * np.dtype(dtype).itemsize)
+    return int(max(minimum, min(limit, rows)))
+
+
+class RingBuffer:
+    """
+    Append-only ring of samples with named float fields.
+
+    fields is a sequence of names, or (name, width) pairs for fields that hold
+    several columns. Single-column fields are returned as 1-D views, wider
+    fields as (samples, width) views.
+    """
+
+    def __init__(self, fields=("value",), capacity=DEFAULT_CAPACITY, dtype=np.float64):
+        if capacity <= 0:
+            raise ValueError("capacity must be positive")
+        self.capacity = capacity
+        self.fields = []
+        self._columns = {}
+        column = 0
+        for field in fields:
+            name, width = (field, None) if isinstance(field, str) else field
+            if width is None:
+                self._columns[name] = column
+                column += 1
+            else:
+                self._columns[name] = slice(column, column + width)
+                column += width
+            self.fields.append(name)
+        self.fields = tuple(self.fields)
+        self._data = np.zeros((2 * capacity, column), dtype=dtype)
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def total_appended(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return self._data.nbytes
+
+    def append(self, *values):
+        """Appends one sample, with a value (or array of values) for every field in order."""
+        slot = self._count % self.capacity
+        row = self._data[slot]
+        mirror = self._data[slot + self.capacity]
+        for name, value in zip(self.fields, values):
+            column = self._columns[name]
+            row[column] = value
+            mirror[column] = value
+        # Publish the sample only after both copies are written
+        self._count += 1
+
+    def clear(self):
+        self._count = 0
+
+    def _bounds(self, n):
+        count = self._count
+        size = min(count, self.capacity)
+        if n is None or n > size:
+            n = size
+        end = count % self.capacity + self.capacity
+        return end - n, end
+
+    def _views(self, start, end, fields, column=None):
+        names = self.fields if fields is None else fields
+        views = []
+        for name in names:
+            columns = self._columns[name]
+            if column is not None and isinstance(columns, slice):
+                columns = columns.start + column
+            views.append(self._data[start:end, columns])
+        return tuple(views)
+
+    def window(self, n=None, fields=None, column=None):
+        """
+        Returns zero-copy views of the newest n samples (all by default),
+        one array per requested field, oldest first. With `column`, wide
+        fields are narrowed to that single column (e.g. one rack).
+        """
+        start, end = self._bounds(n)
+        return self._views(start, end, fields, column)
+
+    def field(self, name, n=None):
+        """Returns a view of the newest n values of a single field."""
+        start, end = self._bounds(n)
+        return self._data[start:end, self._columns[name]]
+
+    def between(self, t_start, t_end=None, time_field="t", fields=None, column=None):
+        """
+        Returns views of the samples whose time_field lies in [t_start, t_end).
+        The time field must be a single non-decreasing column, which holds for
+        the monotonic timestamps written by the sampling engine.
+        """
+        start, end = self._bounds(None)
+        times = self._data[start:end, self._columns[time_field]]
+        first = start + int(np.searchsorted(times, t_start, side="left"))
+        last = end if t_end is None else start + int(np.searchsorted(times, t_end, side="left"))
+        return self._views(first, last, fields, column)
+
+    def last(self):
+        """Returns the newest sample as a dict, or None when empty."""
+        if self._count == 0:
+            return None
+        row = self._data[(self._count - 1) % self.capacity]
+        return {name: row[column].tolist() for name, column in self._columns.items()}
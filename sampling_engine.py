@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Fixed-rate sampling engine for the flow sensors.
+
+The engine runs on its own thread and snapshots the pulse counters on a
+monotonic-clock deadline. Rates are divided by the real time elapsed since the
+previous snapshot, so a slow GUI redraw can no longer stretch the sampling
+window or delay a shutoff.
+
+Every rack is sampled in the same pass: the counts arrive as one flat list
+(two sensors per rack) and rates, differences and detection are computed for
+all racks with a handful of NumPy operations.
+"""
+
+import threading
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from instrumentation import METRICS
+from history_tiers import TIER_WIDTHS, TieredHistory
+from latency_histogram import LatencyHistogram
+from ring_buffer import RingBuffer, capacity_for
+
+PULSES_PER_GALLON = 2840
+# Bytes for the raw per-sample history, whatever the number of racks. One
+# rack keeps two days; with many racks the raw window shortens and longer
+# spans come from the downsampled tiers.
+HISTORY_BUDGET = 64 * 1024 * 1024
+
+# rate1, rate2 and difference hold one value per rack; counts is the flat
+# per-sensor pulse count of the window, in read_counts() order
+Sample = namedtuple("Sample", ["t", "elapsed", "rate1", "rate2", "difference", "counts"])
+
+
+class SamplingEngine(threading.Thread):
+    """
+    Samples the flow sensors every `interval` seconds and runs the detector.
+
+    read_counts() must return the pulse counts since the previous call as a
+    flat sequence: sensor 1 and sensor 2 of rack 0, then of rack 1, and so on.
+    on_trip(rack, sample) is called from the engine thread for every rack the
+    detector decides to shut off, so it must not touch Tk widgets.
+
+    With `read_rates`, the rates come from it instead of from the counts:
+    it returns the current pulses per second of every sensor in the same
+    order (e.g. pulse_counter.PeriodRateReader). Counts are still read and
+    recorded.
+
+    Functions in `listeners` are called with every Sample after detection has
+    run (e.g. to persist or publish it). They run on the engine thread and
+    must return quickly.
+
+    `history` holds every sample (as many as fit in HISTORY_BUDGET unless
+    `history_capacity` is given); `tiers` (history_tiers.TieredHistory) the
+    min, max and mean per `tier_widths` bucket, for graphs spanning hours or days.
+
+    `heartbeat` is the clock time the last cycle finished, for the watchdog.
+    Latency histograms: `lateness` (cycle start after its deadline),
+    `cycle_time` (counter read, detection and listeners) and `trip_latency`
+    (end of the window until on_trip has returned, i.e. the solenoid is driven).
+    These, the per-stage timers and the pulse and missed-deadline counters
+    are also exported through instrumentation.METRICS.
+    """
+
+    def __init__(self, read_counts, detector, on_trip, interval=1.0,
+                 pulses_per_gallon=PULSES_PER_GALLON, clock=time.monotonic,
+                 history_capacity=None, racks=1, read_rates=None, tier_widths=TIER_WIDTHS):
+        super().__init__(name="sampling-engine", daemon=True)
+        self.read_counts = read_counts
+        self.read_rates = read_rates
+        self.detector = detector
+        self.on_trip = on_trip
+        self.interval = interval
+        self.racks = racks
+        self.pulses_per_gallon = np.array(np.broadcast_to(np.asarray(pulses_per_gallon, dtype=float), (racks,)))
+        self.clock = clock
+
+        # Differences are not recorded for a rack until its settle time has
+        # passed (e.g. right after the water is turned on)
+        self.settle_until = np.zeros(racks)
+        self.latest = None
+        self.missed_deadlines = 0
+        self.listeners = []
+        self.heartbeat = clock()
+        self.lateness = LatencyHistogram()
+        self.cycle_time = LatencyHistogram()
+        self.trip_latency = LatencyHistogram()
+        METRICS.timer("engine_lateness", "Cycle start after its deadline", self.lateness)
+        METRICS.timer("engine_cycle", "Counter read, detection and listeners", self.cycle_time)
+        METRICS.timer("trip_latency", "End of the window until the solenoid is driven", self.trip_latency)
+        self._read_timer = METRICS.timer("engine_read_counts", "Reading the pulse counters")
+        self._detect_timer = METRICS.timer("engine_detect", "Rates and leak detection for every rack")
+        self._listeners_timer = METRICS.timer("engine_listeners", "History, telemetry and subscribers")
+        self._pulses = METRICS.counter("pulses", "Flow sensor pulses counted")
+        self._missed = METRICS.counter("missed_deadlines", "Sample slots skipped because a cycle overran")
+
+        # Written only by the engine thread; readers take windowed views
+        if history_capacity is None:
+            history_capacity = capacity_for(1 + 3 * racks, HISTORY_BUDGET)
+        self.history = RingBuffer(
+            ["t", ("rate1", racks), ("rate2", racks), ("difference", racks)], history_capacity)
+        # min/max/mean of the same samples over 10 s, 1 min and 10 min, for long graphs
+        self.tiers = TieredHistory(racks, tier_widths)
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        last_time = self.clock()
+        self.read_counts()  # Discard anything counted before the first window
+        deadline = last_time + self.interval
+        self.heartbeat = last_time
+
+        while not self._stop_event.is_set():
+            delay = deadline - self.clock()
+            if delay > 0 and self._stop_event.wait(delay):
+                break
+
+            now = self.clock()
+            self.lateness.record(now - deadline)
+            self.sample(now, now - last_time)
+            last_time = now
+            self.heartbeat = self.clock()
+            self.cycle_time.record(self.heartbeat - now)
+
+            deadline += self.interval
+            if deadline <= self.clock():
+                # We fell behind; skip the missed slots rather than bursting
+                missed = int((self.clock() - deadline) // self.interval) + 1
+                self.missed_deadlines += missed
+                self._missed.inc(missed)
+                deadline += missed * self.interval
+
+    def sample(self, now, elapsed):
+        """Takes one snapshot of the counters and runs the detector on it."""
+        with self._read_timer:
+            counts = np.asarray(self.read_counts(), dtype=np.int64)
+        if elapsed <= 0:
+            return None
+        self._pulses.inc(int(counts.sum()))
+
+        with self._detect_timer:
+            sample, tripped = self._detect(now, elapsed, counts)
+        for rack in tripped:
+            self.on_trip(int(rack), sample)
+            self.trip_latency.record(self.clock() - now)
+        with self._listeners_timer:
+            for listener in self.listeners:
+                listener(sample)
+        return sample
+
+    def _detect(self, now, elapsed, counts):
+        """Computes the rates and runs the detector; returns the Sample and the racks to shut off."""
+        if self.read_rates is None:
+            rates = counts.reshape(self.racks, 2) / (self.pulses_per_gallon[:, None] * elapsed)
+        else:
+            pulse_rates = np.asarray(self.read_rates(), dtype=float).reshape(self.racks, 2)
+            rates = pulse_rates / self.pulses_per_gallon[:, None]
+        rate1 = rates[:, 0]
+        rate2 = rates[:, 1]
+        difference = np.abs(rate1 - rate2)
+        sample = Sample(now, elapsed, rate1, rate2, difference, counts)
+        self.latest = sample
+
+        recorded = np.where(now < self.settle_until, np.nan, difference)
+        self.history.append(now, rate1, rate2, recorded)
+        self.tiers.append(now, rate1, rate2, recorded)
+
+        # Detectors get the signed imbalance so noise can cancel out
+        return sample, np.flatnonzero(self.detector.update(now, rate1 - rate2))
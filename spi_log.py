@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Level-filtered logging for the SPI drivers.
+
+Messages below the current level return before any formatting or I/O happens.
+Enabled messages are formatted and printed by a background thread, so the
+caller never waits on the console; if the writer falls LOG_QUEUE messages
+behind, further messages are dropped and counted instead of queued. SPI
+transactions can additionally be recorded as raw numbers in a fixed-size
+ring (no string formatting) and dumped after a fault.
+
+Descriptions may be a plain string or a lazy (format, *args) tuple, which is
+only %-formatted when it is printed.
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+from array import array
+
+from instrumentation import METRICS
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LOG_QUEUE = 1024 # Messages waiting for the writer thread before new ones are dropped
+
+LEVEL_NAMES = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+# The message types used by the AD5592R scripts, mapped to levels
+MESSAGE_LEVELS = {
+    'command': DEBUG,
+    'result': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR,
+}
+
+COLORS = {
+    'info': '\033[90m',    # Grey
+    'command': '\033[92m', # Green
+    'result': '\033[94m',  # Blue
+    'warning': '\033[93m', # Yellow
+    'error': '\033[91m',   # Red
+    'reset': '\033[0m'     # Reset color
+}
+
+# Transaction directions stored in the trace ring
+TX = 0
+RX = 1
+
+_dropped_messages = METRICS.counter("spi_log_dropped", "SPI log messages dropped because the writer fell behind")
+
+
+def describe(description):
+    """Text of a transaction description: a string, a (format, *args) tuple or None."""
+    if isinstance(description, tuple):
+        return description[0] % description[1:]
+    return description or ""
+
+
+class TraceRing:
+    """
+    Binary ring of the most recent SPI transactions. Each entry is a
+    monotonic timestamp, a direction (TX/RX), the 16-bit word and a reference
+    to the caller's description; nothing is formatted until dump().
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self._times = array('d', bytes(8 * capacity))
+        self._kinds = array('B', bytes(capacity))
+        self._words = array('H', bytes(2 * capacity))
+        self._descriptions = [None] * capacity
+        self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def record(self, kind, word, description=None):
+        i = self._count % self.capacity
+        self._times[i] = time.monotonic()
+        self._kinds[i] = kind
+        self._words[i] = word & 0xFFFF
+        self._descriptions[i] = description
+        self._count += 1
+
+    def entries(self):
+        """Yields (time, kind, word, description) from oldest to newest."""
+        first = self._count - len(self)
+        for n in range(first, self._count):
+            i = n % self.capacity
+            yield self._times[i], self._kinds[i], self._words[i], self._descriptions[i]
+
+
+class SpiLogger:
+    """
+    Logger used by the SPI helpers. `level` filters console output; `trace`
+    turns the transaction ring on or off.
+    """
+
+    def __init__(self, level=INFO, trace=True, trace_capacity=4096, stream=None):
+        self.level = level
+        self.trace = trace
+        self.ring = TraceRing(trace_capacity)
+        self.stream = stream
+        self._queue = queue.Queue(LOG_QUEUE)
+        self._writer = None
+        self.dropped = 0
+
+    def set_level(self, level):
+        self.level = LEVEL_NAMES[level] if isinstance(level, str) else level
+
+    def enabled(self, message_type):
+        return MESSAGE_LEVELS.get(message_type, INFO) >= self.level
+
+    @property
+    def recording(self):
+        """True when transaction() keeps or prints anything, i.e. descriptions are worth building."""
+        return self.trace or self.level <= DEBUG
+
+    def log(self, message_type, message, *args):
+        """
+        Queues a message for the console. `message` is only %-formatted with
+        args (on the writer thread) if the message type's level is enabled.
+        """
+        if MESSAGE_LEVELS.get(message_type, INFO) < self.level:
+            return
+        self._start_writer()
+        try:
+            self._queue.put_nowait((message_type, message, args))
+        except queue.Full:
+            self.dropped += 1
+            _dropped_messages.inc()
+
+    def transaction(self, kind, word, description):
+        """Records one SPI transaction; does nothing unless tracing or DEBUG is on."""
+        if self.trace:
+            self.ring.record(kind, word, description)
+        if self.level <= DEBUG:
+            if kind == TX:
+                self.log('command', "Sending SPI Command: 0x%04X (%s) - %s", word, format(word, '016b'), describe(description))
+            else:
+                self.log('result', "Received SPI Data: 0x%04X (%s) - %s", word, format(word, '016b'), describe(description))
+
+    def flush(self):
+        """Blocks until every queued message has been printed."""
+        if self._writer is not None:
+            self._queue.join()
+
+    def dump_trace(self, stream=None):
+        """Prints the transaction ring, oldest first, e.g. after an SPI fault."""
+        self.flush()
+        stream = stream or self.stream or sys.stdout
+        entries = list(self.ring.entries())
+        if not entries:
+            return
+        start = entries[0][0]
+        stream.write(f"--- Last {len(entries)} SPI transactions ---\n")
+        for t, kind, word, description in entries:
+            direction = "TX" if kind == TX else "RX"
+            stream.write(f"{(t - start) * 1000:10.3f} ms {direction} 0x{word:04X} ({word:016b}) {describe(description)}\n")
+        stream.flush()
+
+    def _start_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="spi-log", daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            message_type, message, args = self._queue.get()
+            try:
+                text = message % args if args else message
+                stream = self.stream or sys.stdout
+                stream.write(f"{COLORS.get(message_type, COLORS['reset'])}{text}{COLORS['reset']}\n")
+                stream.flush()
+            finally:
+                self._queue.task_done()
+
+
+def logger_from_env(default="info"):
+    """Returns an SpiLogger whose level comes from the SPI_LOG_LEVEL environment variable."""
+    return SpiLogger(level=LEVEL_NAMES.get(os.environ.get("SPI_LOG_LEVEL", default).lower(), INFO))
@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""
+Live telemetry published through a memory-mapped file.
+
+The monitor writes its newest rates and differences, the state of every rack
+and recent shutoff events into one file (in /dev/shm by default, so it never
+touches the SD card). Local readers such as dashboards or plotting scripts
+map the same file and read it directly: after opening there are no syscalls
+and no requests to the monitor, and a reader can never hold up the sampling
+thread.
+
+Consistency uses a sequence lock. The writer makes the sequence counter odd,
+updates the data and makes it even again; a reader notes the counter, reads,
+and retries if the counter was odd or has changed meanwhile.
+
+Layout (little-endian):
+
+    header     magic "FTM1" | version | racks | capacity | event capacity | writer pid
+               then u64 sequence, u64 samples written, u64 events written, f64 last update
+    status     i64 per rack (1 = Active)
+    shutoff    f64 per rack, wall-clock time of the last shutoff (NaN if none)
+    names      32 bytes of UTF-8 per rack
+    samples    2 x capacity rows of t, rate1[racks], rate2[racks], difference[racks],
+               every row written to both halves like ring_buffer.RingBuffer
+    events     event capacity rows of t, rack, kind
+
+Run this module to print the live state of a running monitor.
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+MAGIC = b"FTM1"
+VERSION = 1
+HEADER = struct.Struct("<4sIIIII")
+HEADER_SIZE = 64
+SEQUENCE_OFFSET = 32 # u64 sequence, samples, events, then f64 update time
+NAME_BYTES = 32
+
+DEFAULT_CAPACITY = 3600 # One hour of one-per-second samples
+DEFAULT_EVENT_CAPACITY = 64
+
+# Event kinds
+MANUAL = 0
+LEAK = 1
+WATCHDOG = 2
+EVENT_KINDS = {MANUAL: "manual", LEAK: "leak", WATCHDOG: "watchdog"}
+
+_shm = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+TELEMETRY_PATH = os.environ.get("FLOW_MONITOR_TELEMETRY", os.path.join(_shm, "flow_monitor.telemetry"))
+
+
+def _layout(racks, capacity, event_capacity):
+    """Returns the byte offsets of every section and the total file size."""
+    offsets = {}
+    position = HEADER_SIZE
+    for name, size in (("status", 8 * racks),
+                       ("shutoff", 8 * racks),
+                       ("names", NAME_BYTES * racks),
+                       ("samples", 8 * 2 * capacity * (1 + 3 * racks)),
+                       ("events", 8 * 3 * event_capacity)):
+        offsets[name] = position
+        position += size
+    return offsets, position
+
+
+class _Views:
+    """NumPy views onto the sections of a mapped telemetry file."""
+
+    def __init__(self, buffer, racks, capacity, event_capacity):
+        offsets, _ = _layout(racks, capacity, event_capacity)
+        self.counters = np.ndarray(3, np.uint64, buffer, SEQUENCE_OFFSET)
+        self.updated = np.ndarray(1, np.float64, buffer, SEQUENCE_OFFSET + 24)
+        self.status = np.ndarray(racks, np.int64, buffer, offsets["status"])
+        self.shutoff = np.ndarray(racks, np.float64, buffer, offsets["shutoff"])
+        self.names = np.ndarray(racks, f"S{NAME_BYTES}", buffer, offsets["names"])
+        self.samples = np.ndarray((2 * capacity, 1 + 3 * racks), np.float64, buffer, offsets["samples"])
+        self.events = np.ndarray((event_capacity, 3), np.float64, buffer, offsets["events"])
+
+
+class TelemetryWriter:
+    """
+    Publishes monitor state to the telemetry file at `path`. The file is
+    built under a temporary name and moved into place, so readers still
+    mapping a previous run's file are never handed a half-written one.
+
+    Updates may come from several threads (the sampling engine, control
+    requests); they are serialized with a lock that readers never take.
+    """
+
+    def __init__(self, path, names, capacity=DEFAULT_CAPACITY, event_capacity=DEFAULT_EVENT_CAPACITY):
+        self.path = path
+        self.racks = len(names)
+        self.capacity = capacity
+        self.event_capacity = event_capacity
+        self._lock = threading.Lock()
+
+        _, size = _layout(self.racks, capacity, event_capacity)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w+b") as f:
+            f.truncate(size)
+            self._map = mmap.mmap(f.fileno(), size)
+        self._map[:HEADER.size] = HEADER.pack(MAGIC, VERSION, self.racks, capacity, event_capacity, os.getpid())
+        self._views = _Views(self._map, self.racks, capacity, event_capacity)
+        self._views.shutoff[:] = np.nan
+        for rack, name in enumerate(names):
+            self._views.names[rack] = self._encode_name(name)
+        os.replace(temporary, path)
+
+    @staticmethod
+    def _encode_name(name):
+        return name.encode("utf-8")[:NAME_BYTES]
+
+    def _begin(self):
+        self._views.counters[0] += 1
+
+    def _end(self):
+        self._views.updated[0] = time.time()
+        self._views.counters[0] += 1
+
+    def publish(self, t, rate1, rate2, difference):
+        """Appends one sample (wall-clock t and one value per rack for the rest)."""
+        racks = self.racks
+        with self._lock:
+            views = self._views
+            if views is None:
+                return
+            total = int(views.counters[1])
+            slot = total % self.capacity
+            self._begin()
+            for row in (views.samples[slot], views.samples[slot + self.capacity]):
+                row[0] = t
+                row[1:1 + racks] = rate1
+                row[1 + racks:1 + 2 * racks] = rate2
+                row[1 + 2 * racks:] = difference
+            views.counters[1] = total + 1
+            self._end()
+
+    def set_status(self, rack, active):
+        with self._lock:
+            if self._views is None:
+                return
+            self._begin()
+            self._views.status[rack] = 1 if active else 0
+            self._end()
+
+    def set_name(self, rack, name):
+        with self._lock:
+            if self._views is None:
+                return
+            self._begin()
+            self._views.names[rack] = self._encode_name(name)
+            self._end()
+
+    def shutoff(self, rack, kind=MANUAL, t=None):
+        """Records that a rack was shut off, by hand (MANUAL), by the detector (LEAK) or the watchdog."""
+        t = time.time() if t is None else t
+        with self._lock:
+            views = self._views
+            if views is None:
+                return
+            total = int(views.counters[2])
+            self._begin()
+            views.status[rack] = 0
+            views.shutoff[rack] = t
+            views.events[total % self.event_capacity] = (t, rack, kind)
+            views.counters[2] = total + 1
+            self._end()
+
+    def close(self):
+        """Marks the file as no longer updated. The last published state stays readable."""
+        with self._lock:
+            if self._map is None:
+                return
+            self._begin()
+            struct.pack_into("<I", self._map, HEADER.size - 4, 0)
+            self._end()
+            self._views = None
+            self._map.close()
+            self._map = None
+
+
+class TelemetryReader:
+    """
+    Reads a telemetry file written by TelemetryWriter, from any process.
+    Readers only ever read the mapping, so there can be any number of them.
+    """
+
+    def __init__(self, path=TELEMETRY_PATH, retries=10000):
+        self.path = path
+        self.retries = retries
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.racks, self.capacity, self.event_capacity, _ = HEADER.unpack_from(self._map)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a flow monitor telemetry file")
+        self._views = _Views(self._map, self.racks, self.capacity, self.event_capacity)
+
+    def close(self):
+        self._views = None
+        self._map.close()
+
+    def writer_pid(self):
+        """PID of the monitor writing the file, or 0 once it has stopped."""
+        return HEADER.unpack_from(self._map)[5]
+
+    def _consistent(self, read):
+        """Runs read() until it sees no concurrent update, and returns its result."""
+        sequence = self._views.counters
+        for attempt in range(self.retries):
+            before = int(sequence[0])
+            if not before & 1:
+                result = read()
+                if int(sequence[0]) == before:
+                    return result
+            if attempt > 100:
+                time.sleep(0) # Let a preempted writer finish
+        raise TimeoutError(f"Telemetry in {self.path} kept changing while being read")
+
+    def _sample_bounds(self, total, n):
+        size = min(total, self.capacity)
+        if n is None or n > size:
+            n = size
+        end = total % self.capacity + self.capacity
+        return end - n, end
+
+    def snapshot(self, n=None, copy=True):
+        """
+        Returns a consistent snapshot as a dict: samples (number written), t,
+        rate1, rate2, difference (the newest n samples, oldest first, rates
+        as samples x racks), names, status, last_shutoff and updated.
+
+        With copy=False the sample arrays are views into the mapping instead.
+        They were consistent when returned, but the writer overwrites them
+        once it wraps around, possibly while they are being used: call
+        still_valid(snapshot) after using them, and read again if it is False.
+        """
+        views = self._views
+        racks = self.racks
+
+        def read():
+            total = int(views.counters[1])
+            start, end = self._sample_bounds(total, n)
+            rows = views.samples[start:end]
+            if copy:
+                rows = rows.copy()
+            return total, rows, views.status.copy(), views.shutoff.copy(), views.names.copy(), float(views.updated[0])
+
+        total, rows, status, shutoff, names, updated = self._consistent(read)
+        return {
+            "samples": total,
+            "t": rows[:, 0],
+            "rate1": rows[:, 1:1 + racks],
+            "rate2": rows[:, 1 + racks:1 + 2 * racks],
+            "difference": rows[:, 1 + 2 * racks:],
+            "names": [name.decode("utf-8", "replace") for name in names],
+            "status": ["Active" if value else "Inactive" for value in status],
+            "last_shutoff": shutoff,
+            "updated": updated,
+        }
+
+    def still_valid(self, snapshot):
+        """
+        True if none of the samples of a snapshot(copy=False) has been
+        overwritten yet, so what was read from its views was not torn.
+        """
+        # The writer reuses the slot of sample i for sample i + capacity, and
+        # counters[1] is the sample it is writing (or will write next)
+        oldest = snapshot["samples"] - len(snapshot["t"])
+        return int(self._views.counters[1]) < oldest + self.capacity
+
+    def events(self):
+        """Returns the retained shutoff events, oldest first, as (t, rack, kind name) tuples."""
+        views = self._views
+
+        def read():
+            return int(views.counters[2]), views.events.copy()
+
+        total, events = self._consistent(read)
+        first = max(total - self.event_capacity, 0)
+        return [(float(events[i % self.event_capacity, 0]), int(events[i % self.event_capacity, 1]),
+                 EVENT_KINDS.get(int(events[i % self.event_capacity, 2]), "unknown"))
+                for i in range(first, total)]
+
+
+if __name__ == "__main__":
+    import sys
+    reader = TelemetryReader(sys.argv[1] if len(sys.argv) > 1 else TELEMETRY_PATH)
+    try:
+        while True:
+            state = reader.snapshot(1)
+            for rack, name in enumerate(state["names"]):
+                line = f"{name}: {state['status'][rack]}"
+                if state["samples"]:
+                    line += (f"  rate1 {state['rate1'][-1, rack]:.4f}  rate2 {state['rate2'][-1, rack]:.4f}"
+                             f"  difference {state['difference'][-1, rack]:.4f} gal/s")
+                print(line)
+            if not reader.writer_pid():
+                print("Monitor has stopped")
+                break
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline sweep of the shutoff rule's tolerance and activation delay.
+
+Replays recorded flow against a whole grid of (tolerance, delay) settings and
+reports, for each one, what the monitor's original rule (ThresholdDetector,
+the start_time/elapsed logic of monitor_sensor_values()) would have done:
+
+    trips            shutoffs fired, counting re-arms within one excursion
+    incidents        excursions above tolerance that fired at least once
+    false_trips      trips before --leak-at (all trips when no leak is given)
+    latency_s        seconds from --leak-at to the first trip after it
+    leaked_gallons   imbalance that flowed during excursions before their
+                     first trip (whole excursion when it never tripped)
+
+The rule only fires inside a run of consecutive samples above tolerance, so
+the sweep works on those runs instead of stepping through samples: per
+tolerance, every (run, delay) pair that lasts long enough to trip is found
+with one searchsorted over the sample times. Tolerances are spread over a
+process pool with --workers. The results match stepping ThresholdDetector
+sample by sample exactly.
+
+Traces are DataCollection.py captures (resampled to the monitor's sample
+interval) or a HistoryStore directory (e.g. flow_history/, one rack).
+
+Usage: python3 tolerance_sweep.py TRACE [--rack N] [--interval 1.0]
+                                  [--tolerance 0.001:0.05:50] [--delay 0:60:61]
+                                  [--leak-at SECONDS] [--workers N] [--csv FILE]
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from sampling_engine import PULSES_PER_GALLON
+
+MAX_PAIRS = 4000000 # (run, delay) pairs handled per vectorized step, bounds memory
+
+
+# --- Traces ---
+
+def capture_trace(path, interval=1.0, pulses_per_gallon=PULSES_PER_GALLON):
+    """
+    Returns (t, difference) from a DataCollection.py capture, read the way
+    the sampling engine reads its counters: every `interval` seconds.
+    """
+    from DataCollection import load_capture
+    t, count1, count2 = load_capture(path)
+    reads = np.searchsorted(t, np.arange(t[0], t[-1] + interval / 2, interval), side="right") - 1
+    reads = np.unique(reads)
+    elapsed = np.diff(t[reads])
+    rate1 = np.diff(count1[reads]) / (pulses_per_gallon * elapsed)
+    rate2 = np.diff(count2[reads]) / (pulses_per_gallon * elapsed)
+    return t[reads][1:], np.abs(rate1 - rate2)
+
+
+def history_trace(path, rack=0, start=0.0, end=None):
+    """Returns (t, difference) of one rack from a HistoryStore directory."""
+    from history_store import HistoryStore
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    store = HistoryStore(path, meta["pulses_per_gallon"], read_only=True)
+    try:
+        samples = store.query(start, end)
+    finally:
+        store.close()
+    return samples["t"], samples["difference"][:, rack]
+
+
+def load_trace(path, rack=0, interval=1.0):
+    if os.path.isdir(path):
+        return history_trace(path, rack)
+    return capture_trace(path, interval)
+
+
+# --- Sweep ---
+
+def _first_reach(t, starts, delays):
+    """
+    Index of the first sample j >= start with t[j] - t[start] >= delay, for
+    each (start, delay) pair; len(t) when there is none. Uses the same
+    subtraction as the detector, so rounding cannot move a trip by a sample.
+    """
+    j = np.searchsorted(t, t[starts] + delays, side="left")
+    back = (j > starts) & (t[np.maximum(j - 1, 0)] - t[starts] >= delays)
+    j[back] -= 1
+    inside = j < len(t)
+    ahead = inside & (t[np.minimum(j, len(t) - 1)] - t[starts] < delays)
+    j[ahead] += 1
+    return np.maximum(j, starts)
+
+
+def sweep_tolerance(t, difference, tolerance, delays, leak_start=None):
+    """One row of the grid: metrics for every delay at one tolerance."""
+    delays = np.asarray(delays, dtype=float)
+    nd = len(delays)
+    # Volume of imbalance per sample, over the time since the previous sample
+    dt = np.diff(t, prepend=t[0] - (np.median(np.diff(t)) if len(t) > 1 else 1.0))
+    cumulative = np.concatenate(([0.0], np.cumsum(np.nan_to_num(difference) * dt)))
+
+    over = np.abs(difference) > abs(tolerance) # NaN (settling) is never over
+    steps = np.diff(over.astype(np.int8), prepend=0, append=0)
+    run_starts = np.flatnonzero(steps == 1)
+    run_ends = np.flatnonzero(steps == -1) # Exclusive
+    over_volume = float(np.sum(cumulative[run_ends] - cumulative[run_starts]))
+
+    trips = np.zeros(nd, dtype=np.int64)
+    incidents = np.zeros(nd, dtype=np.int64)
+    false_trips = np.zeros(nd, dtype=np.int64)
+    first_after_leak = np.full(nd, np.inf)
+    leaked = np.full(nd, over_volume)
+
+    # Only runs lasting at least the delay can trip
+    spans = t[run_ends - 1] - t[run_starts]
+    order = np.argsort(delays)
+    per_chunk = max(1, MAX_PAIRS // max(len(run_starts), 1))
+    for chunk in np.array_split(order, max(1, -(-nd // per_chunk))):
+        delay_index, run = np.nonzero(spans[None, :] >= delays[chunk, None])
+        delay_index = chunk[delay_index]
+        starts = run_starts[run]
+        ends = run_ends[run]
+        first = True
+        while len(starts):
+            j = _first_reach(t, starts, delays[delay_index])
+            tripped = j < ends
+            delay_index, starts, ends, j = delay_index[tripped], starts[tripped], ends[tripped], j[tripped]
+            trips += np.bincount(delay_index, minlength=nd)
+            if first:
+                incidents += np.bincount(delay_index, minlength=nd)
+                # After its first trip an excursion no longer counts as leaked
+                leaked -= np.bincount(delay_index, weights=cumulative[ends] - cumulative[j + 1], minlength=nd)
+                first = False
+            trip_times = t[j]
+            if leak_start is None:
+                false_trips += np.bincount(delay_index, minlength=nd)
+            else:
+                before = trip_times < leak_start
+                false_trips += np.bincount(delay_index[before], minlength=nd)
+                np.minimum.at(first_after_leak, delay_index[~before], trip_times[~before])
+            # The rule re-arms: the next sample starts a new wait
+            starts = j + 1
+            remaining = (starts < ends) & (t[ends - 1] - t[np.minimum(starts, len(t) - 1)] >= delays[delay_index])
+            delay_index, starts, ends = delay_index[remaining], starts[remaining], ends[remaining]
+
+    latency = first_after_leak - leak_start if leak_start is not None else np.full(nd, np.nan)
+    latency[np.isinf(latency)] = np.nan
+    return {"trips": trips, "incidents": incidents, "false_trips": false_trips,
+            "latency_s": latency, "leaked_gallons": leaked}
+
+
+def _sweep_rows(args):
+    t, difference, tolerances, delays, leak_start = args
+    return [sweep_tolerance(t, difference, tolerance, delays, leak_start) for tolerance in tolerances]
+
+
+def sweep(t, difference, tolerances, delays, leak_start=None, workers=1):
+    """
+    Evaluates every (tolerance, delay) pair. Returns a dict of
+    len(tolerances) x len(delays) arrays, keyed by metric.
+    """
+    t = np.asarray(t, dtype=float)
+    difference = np.asarray(difference, dtype=float)
+    tolerances = np.asarray(tolerances, dtype=float)
+    delays = np.asarray(delays, dtype=float)
+    if workers > 1 and len(tolerances) > 1:
+        parts = [(t, difference, part, delays, leak_start)
+                 for part in np.array_split(tolerances, min(workers, len(tolerances)))]
+        with ProcessPoolExecutor(workers) as pool:
+            rows = [row for part in pool.map(_sweep_rows, parts) for row in part]
+    else:
+        rows = _sweep_rows((t, difference, tolerances, delays, leak_start))
+    return {name: np.array([row[name] for row in rows]) for name in rows[0]}
+
+
+def parse_grid(spec):
+    """ "start:stop:count" (inclusive, evenly spaced) or "a,b,c" -> array."""
+    if ":" in spec:
+        start, stop, count = spec.split(":")
+        return np.linspace(float(start), float(stop), int(count))
+    return np.array([float(value) for value in spec.split(",")])
+
+
+def write_csv(path, tolerances, delays, results, hours):
+    with open(path, "w") as f:
+        f.write("tolerance,delay," + ",".join(results) + ",trips_per_day\n")
+        for i, tolerance in enumerate(tolerances):
+            for k, delay in enumerate(delays):
+                values = [f"{results[name][i, k]:g}" for name in results]
+                f.write(f"{tolerance:g},{delay:g}," + ",".join(values) + f",{results['trips'][i, k] / hours * 24:g}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("trace", help="DataCollection.py capture (CSV) or HistoryStore directory")
+    parser.add_argument("--rack", type=int, default=0, help="rack to replay from a HistoryStore")
+    parser.add_argument("--interval", type=float, default=1.0, help="sample interval for captures, seconds")
+    parser.add_argument("--tolerance", default="0.001:0.05:50", help="gal/s, start:stop:count or a,b,c")
+    parser.add_argument("--delay", default="0:60:61", help="seconds, start:stop:count or a,b,c")
+    parser.add_argument("--leak-at", type=float, help="seconds into the trace where a known leak starts")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--csv", help="write every setting's metrics to this file")
+    args = parser.parse_args()
+
+    t, difference = load_trace(args.trace, args.rack, args.interval)
+    if len(t) < 2:
+        raise SystemExit(f"{args.trace} holds fewer than two samples")
+    leak_start = t[0] + args.leak_at if args.leak_at is not None else None
+    tolerances = parse_grid(args.tolerance)
+    delays = parse_grid(args.delay)
+    results = sweep(t, difference, tolerances, delays, leak_start, args.workers)
+    hours = (t[-1] - t[0]) / 3600.0
+
+    print(f"{len(t)} samples over {hours:.1f} h, {len(tolerances)} tolerances x {len(delays)} delays")
+    shown = np.unique(np.linspace(0, len(delays) - 1, min(len(delays), 10)).round().astype(int))
+    # With a known leak, only the time before it says anything about false trips
+    clean_hours = (leak_start - t[0]) / 3600.0 if leak_start is not None else hours
+    print("false trips per day (latency s)" if leak_start is not None else "trips per day")
+    print(f"{'tolerance':>10}" + "".join(f"{delays[k]:>12g}" for k in shown))
+    for i, tolerance in enumerate(tolerances):
+        cells = []
+        for k in shown:
+            cell = f"{results['false_trips'][i, k] / max(clean_hours, 1e-9) * 24:.1f}"
+            if leak_start is not None:
+                latency = results["latency_s"][i, k]
+                cell += " (-)" if np.isnan(latency) else f" ({latency:.0f})"
+            cells.append(f"{cell:>12}")
+        print(f"{tolerance:>10.4g}" + "".join(cells))
+    if args.csv:
+        write_csv(args.csv, tolerances, delays, results, hours)
+        print(f"Wrote {args.csv}")